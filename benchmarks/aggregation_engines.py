@@ -0,0 +1,118 @@
+"""Build time and storage of the DuckDB aggregation engine vs the materialized views.
+
+DuckDB: every aggregate of the aggregation flow, built in memory straight from
+the parquet files in DATA_FILES_PATH, once per --threads value.
+Materialized views (with --postgres, using the flow's DB_* variables): a
+REFRESH of each view over the ingested trip tables, plus the size of those trip
+tables and of the views. The Spark ingestion the views depend on isn't timed.
+
+Needs the flow's dependencies; from the repository root:
+    DATA_FILES_PATH=data/ python benchmarks/aggregation_engines.py --threads 1 4
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "prefect_flows")
+)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "shared"))
+
+import duckdb_engine  # noqa: E402
+import psycopg2  # noqa: E402
+from main import (  # noqa: E402
+    DATA_FILES_PATH,
+    DB_HOST,
+    DB_NAME,
+    DB_PASSWORD,
+    DB_PORT,
+    DB_USER,
+    generate_aggregation_queries,
+    get_files_to_process,
+    list_trip_tables,
+)
+
+
+def time_duckdb(threads, queries):
+    con = duckdb_engine.connect(threads)
+    start = time.perf_counter()
+    for table_name in list_trip_tables():
+        files = [
+            (
+                os.path.join(DATA_FILES_PATH, file_data["file_name"]),
+                file_data["start_time"],
+                file_data["end_time"],
+            )
+            for file_data in get_files_to_process(table_name, None)
+            if os.path.exists(os.path.join(DATA_FILES_PATH, file_data["file_name"]))
+        ]
+        if files:
+            duckdb_engine.register_trip_table(con, table_name, files)
+    duckdb_engine.load_zone_lookup(con, [])
+    seconds, rows = {}, {}
+    for name, query in queries.items():
+        query_start = time.perf_counter()
+        rows[name] = duckdb_engine.build_table(con, name, query)
+        seconds[name] = time.perf_counter() - query_start
+    total = time.perf_counter() - start
+    con.close()
+    return total, seconds, rows
+
+
+def time_mat_views(queries):
+    conn = psycopg2.connect(
+        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+    )
+    cursor = conn.cursor()
+    cursor.execute("SELECT matviewname FROM pg_matviews")
+    existing = {row[0] for row in cursor.fetchall()}
+    seconds, sizes = {}, {}
+    for name in queries:
+        if name not in existing:
+            continue
+        start = time.perf_counter()
+        cursor.execute(f"REFRESH MATERIALIZED VIEW {name}")
+        conn.commit()
+        seconds[name] = time.perf_counter() - start
+        cursor.execute("SELECT pg_total_relation_size(%s)", (name,))
+        sizes[name] = cursor.fetchone()[0]
+    raw_sizes = {}
+    for table_name in list_trip_tables():
+        cursor.execute("SELECT to_regclass(%s)", (table_name,))
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("SELECT pg_total_relation_size(%s)", (table_name,))
+            raw_sizes[table_name] = cursor.fetchone()[0]
+    cursor.close()
+    conn.close()
+    return seconds, sizes, raw_sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[os.cpu_count()])
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    queries, _ = generate_aggregation_queries(include_archived=False)
+    for threads in args.threads:
+        total, seconds, rows = time_duckdb(threads, queries)
+        print(f"\nDuckDB, {threads} threads: {total:.2f} s")
+        for name in queries:
+            print(f"  {name:<28} {seconds[name]:8.2f} s {rows[name]:>12} rows")
+
+    if args.postgres:
+        seconds, sizes, raw_sizes = time_mat_views(queries)
+        print(f"\nMaterialized view refresh: {sum(seconds.values()):.2f} s")
+        for name in seconds:
+            print(f"  {name:<28} {seconds[name]:8.2f} s {sizes[name] / 1e6:10.1f} MB")
+        # The DuckDB engine stores tables with the views' rows, but no trips
+        view_mb, raw_mb = sum(sizes.values()) / 1e6, sum(raw_sizes.values()) / 1e6
+        print(f"\nStorage with materialized views: {raw_mb + view_mb:.1f} MB")
+        print(f"  trip tables {raw_mb:.1f} MB, views {view_mb:.1f} MB")
+        print(f"Storage with DuckDB results only: {view_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""CPU time of the date-filter stage for one date-range change on the dashboard.
+
+Before: every callback fired by the date picker rebuilt its DataFrames from the
+browser-posted store records and ran its own query() filter (15 of each).
+After: one memoized filter stage per (date range, data version), slicing the
+mapped snapshot with binary searches.
+
+Run from the repository root:
+    python benchmarks/filter_stage.py --years 2 --interactions 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "front_end"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "shared"))
+
+from figure_cache import VersionedLRUCache  # noqa: E402
+from utils import filter_date_range  # noqa: E402
+
+SERVICES = ["fhvhv", "fhv", "yellow", "green"]
+
+# Callbacks fired by one date-range change and the services each one filtered
+BASELINE_CALLBACKS = {
+    "update_stats": SERVICES,
+    "update_summed_metrics": SERVICES,
+    "update_avg_metrics": SERVICES,
+    "update_price_contributors": ["fhvhv", "yellow", "green"],
+}
+
+
+def synthetic_hourly_table(hours, seed):
+    rng = np.random.default_rng(seed)
+    pickup_hours = pd.date_range("2024-01-01", periods=hours, freq="h")
+    df = pd.DataFrame(
+        {
+            "hour_of_day": pickup_hours.hour.astype(float),
+            "day_of_week": ((pickup_hours.dayofweek + 1) % 7).astype(float),
+            "day_of_month": pickup_hours.day.astype(float),
+            "month": pickup_hours.month.astype(float),
+            "pickup_hour": pickup_hours,
+            "num_trips": rng.integers(100, 20000, hours),
+            "avg_trip_time_min": rng.gamma(5, 4, hours),
+            "avg_trip_miles": rng.gamma(2, 2, hours),
+        }
+    )
+    for col in range(10):
+        df[f"total_{col}"] = rng.random(hours) * 1e4
+    return df
+
+
+def random_date_ranges(n, days, seed):
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, days - 1, n)
+    ends = starts + rng.integers(1, days - starts)
+    base = pd.Timestamp("2024-01-01")
+    return [
+        (
+            (base + pd.Timedelta(days=int(start))).strftime("%Y-%m-%d"),
+            (base + pd.Timedelta(days=int(end))).strftime("%Y-%m-%d"),
+        )
+        for start, end in zip(starts, ends)
+    ]
+
+
+def baseline_interaction(store, start_date, end_date):
+    for services in BASELINE_CALLBACKS.values():
+        for service in services:
+            df = pd.DataFrame(store[f"{service}_data"])
+            df.query("@start_date<=pickup_hour<=@end_date")
+
+
+def shared_stage_interaction(cache, data_version, datasets, start_date, end_date):
+    # Each of the four callbacks asks the shared stage for the same slice
+    for _ in BASELINE_CALLBACKS:
+        cache.get_or_build(
+            (start_date, end_date),
+            data_version,
+            lambda: {
+                service: filter_date_range(df, start_date, end_date)
+                for service, df in datasets.items()
+            },
+        )
+
+
+def cpu_ms_per_interaction(run, date_ranges):
+    started = time.process_time()
+    for start_date, end_date in date_ranges:
+        run(start_date, end_date)
+    return 1000 * (time.process_time() - started) / len(date_ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--interactions", type=int, default=30)
+    args = parser.parse_args()
+
+    hours = args.years * 366 * 24
+    datasets = {
+        service: synthetic_hourly_table(hours, seed)
+        for seed, service in enumerate(SERVICES)
+    }
+    # What the browser used to post back: JSON records with ISO timestamp strings
+    store = {
+        f"{service}_data": df.assign(
+            pickup_hour=df["pickup_hour"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+        ).to_dict("records")
+        for service, df in datasets.items()
+    }
+    date_ranges = random_date_ranges(args.interactions, args.years * 366, seed=42)
+
+    before = cpu_ms_per_interaction(
+        lambda start, end: baseline_interaction(store, start, end), date_ranges
+    )
+    cache = VersionedLRUCache(name="filtered_slices", max_size=16, ttl_seconds=3600)
+    after = cpu_ms_per_interaction(
+        lambda start, end: shared_stage_interaction(cache, "v1", datasets, start, end),
+        date_ranges,
+    )
+    print(f"{hours} hourly rows per service, {args.interactions} date-range changes")
+    print(f"before: {before:9.2f} ms CPU per interaction (15 rebuilds + filters)")
+    print(f"after:  {after:9.2f} ms CPU per interaction (1 shared filter stage)")
+    print(f"speedup: {before / after:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
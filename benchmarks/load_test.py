@@ -0,0 +1,552 @@
+"""Concurrent-user load test of the dashboard.
+
+Each simulated analyst logs in through /login, loads the page, polls
+/data-version like a browser tab does, and then replays
+interactions: date-range changes, metric dropdowns, time-series zooms and
+downloads. Each interaction fires the same _dash-update-component requests the
+Dash renderer would. The callbacks and their inputs come from the app's own
+/_dash-dependencies and layout, and chained outputs fire their dependants in turn.
+
+For every serving configuration, the harness starts the server against the
+given database, runs the users for a fixed time and reports throughput,
+p50/p95/p99 latency and the server's memory (PSS and RSS summed over its
+processes). Seed a SQLite stand-in first, then run from the repository root:
+    python benchmarks/seed_hourly_tables.py --db-url sqlite:///loadtest.db --years 2
+    python benchmarks/load_test.py --db-url sqlite:///loadtest.db \\
+        --users 10 50 --configs dev gunicorn:4:4
+Use --url to load an already running server instead (--server-pid for memory).
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FRONT_END_DIR = os.path.join(BENCHMARKS_DIR, "..", "src", "front_end")
+
+LOADTEST_USER = "loadtest"
+LOADTEST_PASSWORD = "loadtest"
+
+# Relative frequency of each interaction in a simulated session
+INTERACTION_WEIGHTS = {
+    "date_range": 5,
+    "summed_metric": 2,
+    "avg_metric": 1,
+    "time_series": 1,
+    "zoom": 1,
+    "download": 1,
+}
+
+DATE_RANGE_START = date(2024, 1, 1)
+DATE_RANGE_DAYS = 365
+
+# Browsers run at most six requests to one host at a time
+BROWSER_CONNECTIONS = 6
+
+
+def parse_outputs(output):
+    # "..a.children...b.figure.." for multi-output callbacks, "a.children" otherwise
+    if output.startswith(".."):
+        output = output[2:-2]
+    # Duplicate outputs carry an "@<hash>" suffix on the property
+    return [tuple(part.split("@")[0].rsplit(".", 1)) for part in output.split("...")]
+
+
+def layout_props(node, props):
+    if isinstance(node, list):
+        for child in node:
+            layout_props(child, props)
+    elif isinstance(node, dict) and "props" in node:
+        component_props = node["props"]
+        if "id" in component_props:
+            for prop, value in component_props.items():
+                props[(component_props["id"], prop)] = value
+        for value in component_props.values():
+            layout_props(value, props)
+    return props
+
+
+class SimulatedBrowser:
+    def __init__(self, base_url, rng, stats):
+        self.base_url = base_url
+        self.rng = rng
+        self.stats = stats
+        self.session = requests.Session()
+        self.pool = ThreadPoolExecutor(max_workers=BROWSER_CONNECTIONS)
+        self.state = {}
+        self.callbacks = []
+
+    def record(self, kind, name, started, response):
+        self.stats.record(
+            kind,
+            name,
+            time.perf_counter() - started,
+            response.status_code,
+            len(response.content),
+        )
+
+    def open_dashboard(self):
+        started = time.perf_counter()
+        response = self.session.post(
+            f"{self.base_url}/login",
+            data=dict(username=LOADTEST_USER, password=LOADTEST_PASSWORD),
+        )
+        self.record("page", "login", started, response)
+        layout = self.session.get(f"{self.base_url}/dashboard/_dash-layout").json()
+        dependencies = self.session.get(
+            f"{self.base_url}/dashboard/_dash-dependencies"
+        ).json()
+        self.state = layout_props(layout, {})
+        # Set in the browser by clientside callbacks
+        self.state[("time-series-view", "data")] = dict(width=1200, x_range=None)
+        self.state[("data-version", "data")] = None
+        self.callbacks = [
+            dict(dependency, outputs=parse_outputs(dependency["output"]))
+            for dependency in dependencies
+            if not dependency.get("clientside_function")
+        ]
+        self.fire(initial=True)
+
+    def callback_body(self, callback, changed):
+        def values(specs):
+            return [
+                dict(spec, value=self.state.get((spec["id"], spec["property"])))
+                for spec in specs
+            ]
+
+        outputs = [dict(id=id, property=prop) for id, prop in callback["outputs"]]
+        return dict(
+            output=callback["output"],
+            # The renderer sends a single output as an object, not a list
+            outputs=outputs if callback["output"].startswith("..") else outputs[0],
+            inputs=values(callback["inputs"]),
+            state=values(callback["state"]),
+            changedPropIds=[f"{id}.{prop}" for id, prop in changed],
+        )
+
+    def call(self, callback, changed):
+        name = ".".join(callback["outputs"][0])
+        started = time.perf_counter()
+        response = self.session.post(
+            f"{self.base_url}/dashboard/_dash-update-component",
+            json=self.callback_body(callback, changed),
+        )
+        self.record("callback", name, started, response)
+        if response.status_code != 200:
+            return set()
+        updated = set()
+        for id, props in response.json().get("response", {}).items():
+            for prop, value in props.items():
+                self.state[(id, prop)] = value
+                updated.add((id, prop))
+        return updated
+
+    def triggered_by(self, changed):
+        return [
+            callback
+            for callback in self.callbacks
+            if any((i["id"], i["property"]) in changed for i in callback["inputs"])
+        ]
+
+    def fire(self, changed=(), initial=False):
+        # Fires the callbacks the changed props feed, in waves like the Dash
+        # renderer: a callback waits while another pending one still produces
+        # one of its inputs, and outputs that change fire their dependants
+        if initial:
+            pending = [cb for cb in self.callbacks if not cb["prevent_initial_call"]]
+        else:
+            pending = self.triggered_by(set(changed))
+        changed = set(changed)
+        while pending:
+            pending_outputs = {output for cb in pending for output in cb["outputs"]}
+            ready = [
+                cb
+                for cb in pending
+                if not any(
+                    (i["id"], i["property"]) in pending_outputs
+                    and (i["id"], i["property"]) not in cb["outputs"]
+                    for i in cb["inputs"]
+                )
+            ] or pending
+            wave_changed = changed
+            updates = list(
+                self.pool.map(lambda callback: self.call(callback, wave_changed), ready)
+            )
+            changed = set().union(*updates)
+            waiting = [cb for cb in pending if cb not in ready]
+            pending = waiting + [
+                cb for cb in self.triggered_by(changed) if cb not in waiting
+            ]
+
+    def choose(self, component_id, prop="value"):
+        options = self.state[(component_id, "options")]
+        value = self.rng.choice(options)
+        self.state[(component_id, prop)] = value
+        return {(component_id, prop)}
+
+    def interact(self, interaction):
+        if interaction == "date_range":
+            start = self.rng.randrange(DATE_RANGE_DAYS - 1)
+            end = self.rng.randrange(start + 1, DATE_RANGE_DAYS)
+            self.state[("date-range", "start_date")] = str(
+                DATE_RANGE_START + timedelta(days=start)
+            )
+            self.state[("date-range", "end_date")] = str(
+                DATE_RANGE_START + timedelta(days=end)
+            )
+            self.fire({("date-range", "start_date"), ("date-range", "end_date")})
+        elif interaction == "summed_metric":
+            self.fire(
+                self.choose(
+                    self.rng.choice(["summed-metric", "summed-metric-time-unit"])
+                )
+            )
+        elif interaction == "avg_metric":
+            self.fire(self.choose("avg-metric"))
+        elif interaction == "time_series":
+            self.fire(
+                self.choose(
+                    self.rng.choice(["time-series-service", "time-series-metric"])
+                )
+            )
+        elif interaction == "zoom":
+            start = date.fromisoformat(self.state[("date-range", "start_date")][:10])
+            end = date.fromisoformat(self.state[("date-range", "end_date")][:10])
+            days = max(1, (end - start).days)
+            zoom_start = start + timedelta(days=self.rng.randrange(days))
+            zoom_end = zoom_start + timedelta(days=self.rng.randint(1, 14))
+            self.state[("time-series-view", "data")] = dict(
+                width=1200, x_range=[str(zoom_start), str(zoom_end)]
+            )
+            self.fire({("time-series-view", "data")})
+        elif interaction == "download":
+            href = self.state.get(
+                (f"{self.rng.choice(['fhvhv', 'yellow'])}-download-link", "href")
+            )
+            if href:
+                started = time.perf_counter()
+                response = self.session.get(f"{self.base_url}{href}")
+                self.record("download", "download", started, response)
+
+    def poll_data_version(self, stop, poll_seconds):
+        # As the dashboard's clientside callback does, revalidating its ETag
+        etag = None
+        while not stop.wait(poll_seconds):
+            started = time.perf_counter()
+            try:
+                response = self.session.get(
+                    f"{self.base_url}/data-version",
+                    headers={"If-None-Match": etag} if etag else {},
+                    timeout=5,
+                )
+            except requests.RequestException:
+                continue
+            self.record("poll", "data-version", started, response)
+            etag = response.headers.get("ETag", etag)
+
+    def run(self, stop, think_time, poll_seconds):
+        try:
+            self.open_dashboard()
+        except (requests.RequestException, ValueError) as e:
+            self.stats.record("page", "login", 0, 599, 0)
+            print(f"Simulated user could not open the dashboard: {e}")
+            return
+        if poll_seconds:
+            threading.Thread(
+                target=self.poll_data_version, args=(stop, poll_seconds), daemon=True
+            ).start()
+        interactions = list(INTERACTION_WEIGHTS)
+        weights = list(INTERACTION_WEIGHTS.values())
+        while not stop.is_set():
+            interaction = self.rng.choices(interactions, weights)[0]
+            started = time.perf_counter()
+            try:
+                self.interact(interaction)
+                self.stats.record_interaction(time.perf_counter() - started)
+            except requests.RequestException as e:
+                self.stats.record("callback", interaction, 0, 599, 0)
+                print(f"Request failed: {e}")
+            stop.wait(self.rng.expovariate(1 / think_time) if think_time else 0)
+        self.pool.shutdown()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.interactions = []
+
+    def record(self, kind, name, seconds, status, size):
+        with self.lock:
+            self.requests.append((kind, name, seconds, status, size))
+
+    def record_interaction(self, seconds):
+        with self.lock:
+            self.interactions.append(seconds)
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child_pid in pids:
+        try:
+            with open(f"/proc/{child_pid}/task/{child_pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return pids
+
+
+def memory_kb(pid):
+    # PSS splits shared pages (the mapped data snapshot, code) between the
+    # processes sharing them, so its sum is the tree's real footprint
+    pss = rss = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+                    elif line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return pss, rss
+
+
+def sample_memory(pid, stop, samples):
+    while not stop.is_set():
+        samples.append(memory_kb(pid))
+        stop.wait(0.5)
+
+
+def server_command(config, port):
+    if config == "dev":
+        return [sys.executable, os.path.join(BENCHMARKS_DIR, "loadtest_app.py")], {}
+    _, workers, threads = config.split(":")
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-c",
+        "gunicorn.conf.py",
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--pythonpath",
+        BENCHMARKS_DIR,
+        "--access-logfile",
+        "/dev/null",
+        "loadtest_app:server",
+    ]
+    return command, dict(DASH_WORKERS=workers, DASH_THREADS=threads)
+
+
+def start_server(config, db_url, port, work_dir):
+    command, config_env = server_command(config, port)
+    env = dict(
+        os.environ,
+        DB_URL=db_url,
+        DASHBOARD_USER=LOADTEST_USER,
+        DASHBOARD_PASSWORD=LOADTEST_PASSWORD,
+        SERVER_SECRET_KEY="loadtest",
+        DATA_PLANE_DIR=os.path.join(work_dir, "data_plane"),
+        EXPORT_DIR=os.path.join(work_dir, "exports"),
+        LOADTEST_PORT=str(port),
+        **config_env,
+    )
+    if config != "dev":
+        env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(work_dir, "prometheus")
+    log = open(os.path.join(work_dir, "server.log"), "w")
+    process = subprocess.Popen(
+        command, cwd=FRONT_END_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited, see {log.name}")
+        try:
+            requests.get(f"{base_url}/login", timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError(f"Server did not start, see {log.name}")
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_load(base_url, users, duration, ramp_up, think_time, poll_seconds, seed):
+    stats = Stats()
+    stop = threading.Event()
+    browsers = [
+        SimulatedBrowser(base_url, random.Random(seed + user), stats)
+        for user in range(users)
+    ]
+    threads = []
+    started = time.perf_counter()
+    for user, browser in enumerate(browsers):
+        thread = threading.Thread(
+            target=browser.run, args=(stop, think_time, poll_seconds), daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+        time.sleep(ramp_up / users)
+    stop.wait(max(0, duration - (time.perf_counter() - started)))
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=60)
+    return stats, time.perf_counter() - started
+
+
+def percentiles_ms(seconds):
+    if not seconds:
+        return dict(p50=None, p95=None, p99=None)
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) * 1000
+    return dict(p50=round(p50, 1), p95=round(p95, 1), p99=round(p99, 1))
+
+
+def summarize(config, users, stats, elapsed, memory_samples):
+    callbacks = [r for r in stats.requests if r[0] == "callback"]
+    by_callback = {}
+    for _, name, seconds, _, _ in callbacks:
+        by_callback.setdefault(name, []).append(seconds)
+    pss = [sample[0] for sample in memory_samples]
+    rss = [sample[1] for sample in memory_samples]
+    return dict(
+        config=config,
+        users=users,
+        seconds=round(elapsed, 1),
+        requests=len(stats.requests),
+        errors=sum(1 for r in stats.requests if r[3] >= 400),
+        requests_per_second=round(len(stats.requests) / elapsed, 1),
+        interactions_per_second=round(len(stats.interactions) / elapsed, 1),
+        callback_latency_ms=percentiles_ms([r[2] for r in callbacks]),
+        interaction_latency_ms=percentiles_ms(stats.interactions),
+        response_mb=round(sum(r[4] for r in stats.requests) / 2**20, 1),
+        peak_pss_mb=round(max(pss) / 1024, 1) if pss else None,
+        peak_rss_mb=round(max(rss) / 1024, 1) if rss else None,
+        error_requests=sorted(
+            {f"{r[1]} {r[3]}" for r in stats.requests if r[3] >= 400}
+        ),
+        callbacks={
+            name: dict(count=len(seconds), **percentiles_ms(seconds))
+            for name, seconds in sorted(by_callback.items())
+        },
+    )
+
+
+def print_summary(summary):
+    callback = summary["callback_latency_ms"]
+    interaction = summary["interaction_latency_ms"]
+    print(
+        f"{summary['config']:>16} {summary['users']:>5} "
+        f"{summary['requests_per_second']:>8} {summary['interactions_per_second']:>8} "
+        f"{callback['p50']!s:>8} {callback['p95']!s:>8} {callback['p99']!s:>8} "
+        f"{interaction['p95']!s:>9} {summary['errors']:>6} "
+        f"{summary['peak_pss_mb']!s:>8} {summary['peak_rss_mb']!s:>8}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument("--db-url", help="database the started servers read")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["dev", "gunicorn:4:16"],
+        help="dev (Flask development server) or gunicorn:<workers>:<threads>",
+    )
+    parser.add_argument("--url", help="load a running server instead")
+    parser.add_argument("--server-pid", type=int, help="running server's pid")
+    parser.add_argument("--users", type=int, nargs="+", default=[10])
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--ramp-up", type=float, default=10)
+    parser.add_argument("--think-time", type=float, default=2, help="mean seconds")
+    parser.add_argument(
+        "--poll-seconds", type=float, default=30, help="data version; 0 disables"
+    )
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.url is None and args.db_url is None:
+        parser.error("either --db-url or --url is required")
+    if args.url is not None:
+        global LOADTEST_USER, LOADTEST_PASSWORD
+        LOADTEST_USER = os.getenv("DASHBOARD_USER", LOADTEST_USER)
+        LOADTEST_PASSWORD = os.getenv("DASHBOARD_PASSWORD", LOADTEST_PASSWORD)
+
+    print(
+        f"{'config':>16} {'users':>5} {'req/s':>8} {'inter/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'int p95':>9} {'errors':>6} "
+        f"{'PSS MB':>8} {'RSS MB':>8}"
+    )
+    results = []
+    for config in [args.url] if args.url else args.configs:
+        for users in args.users:
+            work_dir = tempfile.mkdtemp(prefix="loadtest-")
+            process = None
+            try:
+                if args.url:
+                    base_url, server_pid = args.url.rstrip("/"), args.server_pid
+                else:
+                    process, base_url = start_server(
+                        config, args.db_url, args.port, work_dir
+                    )
+                    server_pid = process.pid
+                memory_samples = []
+                stop_sampling = threading.Event()
+                if server_pid:
+                    threading.Thread(
+                        target=sample_memory,
+                        args=(server_pid, stop_sampling, memory_samples),
+                        daemon=True,
+                    ).start()
+                stats, elapsed = run_load(
+                    base_url,
+                    users,
+                    args.duration,
+                    args.ramp_up,
+                    args.think_time,
+                    args.poll_seconds,
+                    args.seed,
+                )
+                stop_sampling.set()
+                summary = summarize(config, users, stats, elapsed, memory_samples)
+                print_summary(summary)
+                results.append(summary)
+            finally:
+                if process is not None:
+                    stop_server(process)
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""WSGI entry point for load tests: the dashboard, plus DATE_PART on SQLite.
+
+The dashboard's hourly query uses Postgres' DATE_PART, so a SQLite stand-in seeded
+with seed_hourly_tables.py needs an equivalent registered on each connection.
+Against Postgres this module is just main:server.
+"""
+
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "front_end"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "shared"))
+
+
+def date_part(part, value):
+    timestamp = datetime.fromisoformat(str(value))
+    return {
+        "hour": timestamp.hour,
+        "dow": timestamp.isoweekday() % 7,
+        "day": timestamp.day,
+        "month": timestamp.month,
+    }[part]
+
+
+@event.listens_for(Engine, "connect")
+def register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("DATE_PART", 2, date_part)
+
+
+from main import app, server  # noqa: E402
+
+if __name__ == "__main__":
+    # The development server configuration of the load test
+    app.run(host="127.0.0.1", port=int(os.getenv("LOADTEST_PORT", 8053)))
@@ -0,0 +1,119 @@
+"""Bytes read, load rate and table size of each ingestion projection profile.
+
+For every trip table and profile: the compressed parquet bytes of the
+profile's columns (all a column-pruned scan reads), and the rows/s of decoding
+them with DuckDB. With --postgres (using the flow's DB_* variables), the rows
+are also COPY-loaded into a scratch table whose size is reported, then dropped.
+
+Needs the flow's dependencies; from the repository root:
+    DATA_FILES_PATH=data/ python benchmarks/projection_profiles.py --month 2024-01
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "prefect_flows")
+)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "shared"))
+
+import duckdb_engine  # noqa: E402
+import psycopg2  # noqa: E402
+from main import (  # noqa: E402
+    DATA_FILES_PATH,
+    DB_HOST,
+    DB_NAME,
+    DB_PASSWORD,
+    DB_PORT,
+    DB_USER,
+    PROJECTION_PROFILES,
+    get_table_size,
+    list_trip_tables,
+    profile_columns,
+)
+
+
+def measure_profile(con, table_name, file_path, profile, cursor):
+    duckdb_engine.register_trip_table(con, "trips", [(file_path, None, None)])
+    columns = [row[0] for row in con.execute("DESCRIBE trips").fetchall()]
+    selected = profile_columns(profile, table_name, columns)
+    column_list = ", ".join(f'"{column}"' for column in selected)
+
+    # The file's own names, before the ingestion renames the time columns
+    source_columns = [
+        row[0]
+        for row in con.execute(
+            f"DESCRIBE SELECT * FROM read_parquet({duckdb_engine.sql_string(file_path)})"
+        ).fetchall()
+    ]
+    source_names = dict(zip(columns, source_columns))
+    column_bytes = duckdb_engine.parquet_column_bytes(con, file_path)
+    read_bytes = sum(column_bytes[source_names[column]] for column in selected)
+
+    start = time.perf_counter()
+    con.execute(f"CREATE OR REPLACE TABLE profiled AS SELECT {column_list} FROM trips")
+    seconds = time.perf_counter() - start
+    num_rows = con.execute("SELECT COUNT(*) FROM profiled").fetchone()[0]
+
+    size = None
+    if cursor is not None:
+        scratch = f"{table_name}_{profile}_profile"
+        cursor.execute(f"DROP TABLE IF EXISTS {scratch}")
+        cursor.execute(
+            f"CREATE TABLE {scratch}"
+            f" ({duckdb_engine.postgres_column_defs(con, 'profiled')})"
+        )
+        duckdb_engine.copy_query_to_postgres(
+            con, cursor, "SELECT * FROM profiled", scratch, selected
+        )
+        size = get_table_size(cursor, scratch)
+        cursor.execute(f"DROP TABLE {scratch}")
+    return len(selected), len(columns), read_bytes, num_rows / seconds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--month", default="2024-01", help="YYYY-MM")
+    parser.add_argument("--profiles", nargs="+", default=PROJECTION_PROFILES)
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    conn, cursor = None, None
+    if args.postgres:
+        conn = psycopg2.connect(
+            host=DB_HOST,
+            port=DB_PORT,
+            dbname=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+        )
+        conn.autocommit = True
+        cursor = conn.cursor()
+
+    con = duckdb_engine.connect()
+    for table_name in sorted(list_trip_tables()):
+        file_path = os.path.join(DATA_FILES_PATH, f"{table_name}_{args.month}.parquet")
+        if not os.path.exists(file_path):
+            continue
+        print(f"\n{table_name} {args.month}")
+        for profile in args.profiles:
+            selected, total, read_bytes, rows_per_second, size = measure_profile(
+                con, table_name, file_path, profile, cursor
+            )
+            line = (
+                f"  {profile:<10} {selected:>3}/{total} columns"
+                f" {read_bytes / 1e6:8.1f} MB read {rows_per_second:12.0f} rows/s"
+            )
+            if size is not None:
+                line += f" {size / 1e6:8.1f} MB in Postgres"
+            print(line)
+    con.close()
+    if conn is not None:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
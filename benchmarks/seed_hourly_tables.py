@@ -0,0 +1,93 @@
+"""Seed a database with synthetic *_hourly_tripdata tables for benchmarking.
+
+The tables have the columns of the aggregation flow's hourly materialized views,
+so the dashboard runs against them unchanged. Works with Postgres or SQLite:
+    python benchmarks/seed_hourly_tables.py --db-url sqlite:///loadtest.db --years 2
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+PRICE_COLUMNS = {
+    "fhvhv": [
+        "total_base_fare_amount",
+        "total_tolls",
+        "total_black_car_fund",
+        "total_tax",
+        "total_congestion_surcharge",
+        "total_airport_fees",
+        "total_tips",
+        "total_driver_pay",
+    ],
+    "fhv": [],
+    "yellow": [
+        "total_base_fare_amount",
+        "total_extra",
+        "total_tax",
+        "total_tips",
+        "total_tolls",
+        "total_improvement_surcharge",
+        "total_congestion_surcharge",
+        "total_airport_fees",
+    ],
+    "green": [
+        "total_base_fare_amount",
+        "total_extra",
+        "total_tax",
+        "total_tips",
+        "total_tolls",
+        "total_improvement_surcharge",
+        "total_congestion_surcharge",
+    ],
+}
+
+
+def synthetic_hourly_table(service, start, hours, seed):
+    rng = np.random.default_rng(seed)
+    pickup_hours = pd.date_range(start, periods=hours, freq="h")
+    # Daily and weekly seasonality, so the plots look like trip data
+    shape = 1.5 + np.sin(2 * np.pi * (pickup_hours.hour - 8) / 24)
+    shape *= 1 + 0.2 * (pickup_hours.dayofweek < 5)
+    df = pd.DataFrame(
+        {
+            "pickup_hour": pickup_hours,
+            "num_trips": rng.poisson(4000 * shape),
+            "avg_trip_time_min": rng.gamma(5, 4, hours),
+        }
+    )
+    if service == "fhvhv":
+        df["avg_request_to_on_scene_time_min"] = rng.gamma(2, 2, hours)
+    if service != "fhv":
+        df["avg_trip_miles"] = rng.gamma(2, 2, hours)
+        for col in PRICE_COLUMNS[service]:
+            df[col] = df["num_trips"] * rng.gamma(2, 3, hours)
+        # The views' total excludes the driver pay, which is part of the fares
+        payed_cols = [
+            col for col in PRICE_COLUMNS[service] if col != "total_driver_pay"
+        ]
+        df["total_amount_payed"] = df[payed_cols].sum(axis=1)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db-url", required=True)
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--start", default="2024-01-01")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db_url)
+    hours = args.years * 365 * 24
+    for seed, service in enumerate(PRICE_COLUMNS):
+        table = f"{service}_hourly_tripdata"
+        df = synthetic_hourly_table(service, args.start, hours, seed)
+        df.to_sql(table, engine, if_exists="replace", index=False, chunksize=10000)
+        print(f"Seeded {table} with {len(df)} rows")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Ingestion throughput of Spark with 1 to N workers.
+
+For each worker count, reads the month files of a trip table the way the
+ingestion does and writes them either to Spark's no-op sink (parquet decoding
+and the ingestion's transforms only) or, with --postgres, to a scratch table
+through the ingestion's writer (SPARK_WRITE_METHOD), dropped afterwards.
+
+Workers are local-cluster[N,cores,memory] executors on this machine, or with
+--master a standalone cluster capped at N * cores cores. Needs the flow's
+dependencies and a Spark installation (SPARK_HOME, for local-cluster); from the
+repository root:
+    python benchmarks/spark_scaling.py --table fhvhv_tripdata --workers 1 2 4
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "src", "prefect_flows")
+)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "shared"))
+
+import psycopg2  # noqa: E402
+import spark_cluster  # noqa: E402
+from main import (  # noqa: E402
+    DATA_FILES_PATH,
+    DB_HOST,
+    DB_NAME,
+    DB_PASSWORD,
+    DB_PORT,
+    DB_URL,
+    DB_USER,
+    read_trip_file,
+)
+
+
+def run(workers, args, file_paths):
+    config = {"spark.executor.cores": str(args.cores)}
+    if args.master:
+        master = args.master
+        config["spark.cores.max"] = str(workers * args.cores)
+        config["spark.executor.memory"] = f"{args.memory_mb}m"
+    else:
+        master = f"local-cluster[{workers},{args.cores},{args.memory_mb}]"
+    spark = spark_cluster.build_session("SparkScalingBenchmark", config, master)
+    df = None
+    for file_path in file_paths:
+        month, _ = read_trip_file(spark, file_path, args.table)
+        df = month if df is None else df.unionByName(month, allowMissingColumns=True)
+    num_rows = df.count()
+
+    conn_params = dict(
+        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+    )
+    scratch = f"{args.table}_scaling"
+    start = time.perf_counter()
+    if args.postgres:
+        spark_cluster.write_trips(
+            df, scratch, DB_URL, DB_USER, DB_PASSWORD, conn_params
+        )
+    else:
+        df.write.format("noop").mode("overwrite").save()
+    seconds = time.perf_counter() - start
+    num_tasks = df.rdd.getNumPartitions()
+    spark.stop()
+
+    if args.postgres:
+        conn = psycopg2.connect(**conn_params)
+        cursor = conn.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {scratch}")
+        conn.commit()
+        cursor.close()
+        conn.close()
+    return num_rows, num_tasks, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", default="fhvhv_tripdata")
+    parser.add_argument("--months", nargs="+", default=["2024-01"], help="YYYY-MM")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--cores", type=int, default=1, help="per worker")
+    parser.add_argument("--memory-mb", type=int, default=2048, help="per worker")
+    parser.add_argument("--master", help="e.g. spark://spark-master:7077")
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    file_paths = [
+        os.path.join(DATA_FILES_PATH, f"{args.table}_{month}.parquet")
+        for month in args.months
+    ]
+    sink = "Postgres" if args.postgres else "no-op sink"
+    print(f"{args.table} {', '.join(args.months)} to the {sink}")
+    baseline = None
+    for workers in args.workers:
+        num_rows, num_tasks, seconds = run(workers, args, file_paths)
+        baseline = baseline or seconds
+        print(
+            f"  {workers:>3} workers x {args.cores} cores: {seconds:8.2f} s"
+            f" {num_rows / seconds:12.0f} rows/s {num_tasks:>4} tasks"
+            f"  speedup {baseline / seconds:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
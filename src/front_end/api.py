@@ -0,0 +1,47 @@
+import hashlib
+from datetime import datetime
+
+import pyarrow as pa
+
+API_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "json": "application/json",
+}
+
+
+def negotiate_format(request):
+    # An explicit ?format= wins, then the Accept header, then Arrow
+    if "format" in request.args:
+        api_format = request.args["format"]
+        return api_format if api_format in API_FORMATS else None
+    best = request.accept_mimetypes.best_match(list(API_FORMATS.values()))
+    for api_format, mimetype in API_FORMATS.items():
+        if mimetype == best:
+            return api_format
+    return "arrow"
+
+
+def parse_date_arg(value):
+    # Normalized so equivalent spellings of a date share one ETag
+    if not value:
+        return None
+    return datetime.fromisoformat(value).isoformat(sep=" ")
+
+
+def hourly_etag(data_version, service, start_date, end_date, columns, api_format):
+    # Strong: the same data version and arguments always give the same bytes
+    key = "|".join(
+        [data_version, service, str(start_date), str(end_date), api_format]
+        + list(columns)
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def serialize_hourly(df, api_format):
+    if api_format == "json":
+        return df.to_json(orient="records", date_format="iso")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
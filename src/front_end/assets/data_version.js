@@ -0,0 +1,18 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    data_version: {
+        poll: async function (nIntervals, current) {
+            // A conditional GET: the server answers 304 until a new version is
+            // published, and the browser hands back its cached body
+            try {
+                const response = await fetch("/data-version", {credentials: "same-origin"});
+                if (!response.ok) {
+                    return window.dash_clientside.no_update;
+                }
+                const {data_version} = await response.json();
+                return data_version === current ? window.dash_clientside.no_update : data_version;
+            } catch (e) {
+                return window.dash_clientside.no_update;
+            }
+        },
+    },
+});
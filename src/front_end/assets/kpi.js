@@ -0,0 +1,52 @@
+function decodeArray(encoded, ArrayType) {
+    const bytes = Uint8Array.from(atob(encoded), (c) => c.charCodeAt(0));
+    return new ArrayType(bytes.buffer);
+}
+
+function toEpochDay(date) {
+    return Date.parse(date.substring(0, 10)) / 86400000;
+}
+
+function sumRange(service, col, startDay, endDay) {
+    // Whole days from start_date up to end_date, plus the midnight hour of
+    // end_date, matching start_date <= pickup_hour <= end_date on the server
+    if (!service || !(col in service)) {
+        return 0;
+    }
+    const days = decodeArray(service.days, Int32Array);
+    const values = decodeArray(service[col], col === "num_trips" ? Float32Array : Float64Array);
+    const midnight = decodeArray(service["midnight_" + col], col === "num_trips" ? Float32Array : Float64Array);
+    let total = 0;
+    for (let i = 0; i < days.length; i++) {
+        if (days[i] >= startDay && days[i] < endDay) {
+            total += values[i];
+        } else if (days[i] === endDay) {
+            total += midnight[i];
+        }
+    }
+    return total;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    kpi: {
+        update_stats: function (startDate, endDate, payload) {
+            if (!payload || !startDate || !endDate) {
+                return Array(7).fill(window.dash_clientside.no_update);
+            }
+            const startDay = toEpochDay(startDate);
+            const endDay = toEpochDay(endDate);
+            const trips = (service) => Math.round(sumRange(payload[service], "num_trips", startDay, endDay));
+            const payed = (service) =>
+                Math.round(sumRange(payload[service], "total_amount_payed", startDay, endDay) * 100) / 100;
+            return [
+                trips("fhvhv"),
+                trips("fhv"),
+                trips("yellow"),
+                trips("green"),
+                payed("fhvhv"),
+                payed("yellow"),
+                payed("green"),
+            ];
+        },
+    },
+});
@@ -0,0 +1,37 @@
+function zoomedRange(relayoutData, currentRange) {
+    if (!relayoutData || relayoutData["xaxis.autorange"]) {
+        return null;
+    }
+    if ("xaxis.range[0]" in relayoutData && "xaxis.range[1]" in relayoutData) {
+        return [relayoutData["xaxis.range[0]"], relayoutData["xaxis.range[1]"]];
+    }
+    if ("xaxis.range" in relayoutData) {
+        return relayoutData["xaxis.range"].slice(0, 2);
+    }
+    // Resizes and y-only changes keep whatever x range was shown
+    return currentRange;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    time_series: {
+        // Tracks the plot's pixel width, which bounds how many points the
+        // server sends, and the zoomed x range it should re-query. Plotly fires
+        // relayoutData on first draw, on resize and on every zoom or pan.
+        update_view: function (relayoutData, startDate, endDate, service, metric, current) {
+            current = current || { width: null, x_range: null };
+            const triggered = window.dash_clientside.callback_context.triggered.map(
+                (t) => t.prop_id
+            );
+            const graph = document.getElementById("time-series");
+            const width = graph && graph.offsetWidth ? graph.offsetWidth : current.width;
+            // A new date range, service or metric starts from the full range
+            const xRange = triggered.includes("time-series.relayoutData")
+                ? zoomedRange(relayoutData, current.x_range)
+                : null;
+            if (width === current.width && JSON.stringify(xRange) === JSON.stringify(current.x_range)) {
+                return window.dash_clientside.no_update;
+            }
+            return { width: width, x_range: xRange };
+        },
+    },
+});
@@ -0,0 +1,183 @@
+import fcntl
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import pyarrow as pa
+from rollups import fetch_rollups
+from snapshots import (
+    SNAPSHOT_GRAINS,
+    SNAPSHOT_SERVICES,
+    publish_snapshot,
+    read_manifest,
+    snapshot_name,
+    snapshot_path,
+    snapshot_table,
+)
+from utils import fetch_data
+
+DATA_PLANE_DIR = os.getenv("DATA_PLANE_DIR", "/dev/shm/nyc_taxi")
+# Snapshots the aggregation flow writes after each refresh, in the same layout.
+# When one exists it is mapped as is, and the database is only read to build a
+# snapshot in DATA_PLANE_DIR when it doesn't.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+# Safety net only: refreshes normally happen when the aggregation flow notifies
+DATA_REFRESH_SECONDS = int(os.getenv("DATA_REFRESH_SECONDS", 3600))
+DATA_VERSION_CHANNEL = "data_version"
+
+
+def current_snapshot():
+    # The flow's snapshot if there is one, else the one built here, else None
+    if SNAPSHOT_DIR:
+        manifest = read_manifest(SNAPSHOT_DIR)
+        if manifest is not None:
+            return SNAPSHOT_DIR, manifest
+    manifest = read_manifest(DATA_PLANE_DIR)
+    if manifest is not None:
+        return DATA_PLANE_DIR, manifest
+    return None
+
+
+def open_lock_file(name):
+    os.makedirs(DATA_PLANE_DIR, exist_ok=True)
+    return open(os.path.join(DATA_PLANE_DIR, name), "w")
+
+
+@contextmanager
+def snapshot_lock():
+    with open_lock_file("snapshot.lock") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def write_snapshot(engine):
+    datasets = {
+        service: fetch_data(table=snapshot_table("hour", service), engine=engine)
+        for service in SNAPSHOT_SERVICES
+    }
+    # The hourly tables and their daily and monthly rollups, by grain
+    pyramid = dict(hour=datasets, **fetch_rollups(engine, datasets))
+    frames = {
+        snapshot_name(grain, service): df
+        for grain, grain_datasets in pyramid.items()
+        for service, df in grain_datasets.items()
+    }
+    return publish_snapshot(DATA_PLANE_DIR, frames)
+
+
+def ensure_snapshot(engine):
+    # The first process to get here builds the snapshot, the others then map it
+    with snapshot_lock():
+        if current_snapshot() is None:
+            write_snapshot(engine)
+
+
+def map_snapshot(directory, data_version):
+    pyramid = {}
+    for grain in SNAPSHOT_GRAINS:
+        pyramid[grain] = {}
+        for service in SNAPSHOT_SERVICES:
+            path = snapshot_path(directory, data_version, snapshot_name(grain, service))
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+            pyramid[grain][service] = table.to_pandas(split_blocks=True)
+    return pyramid
+
+
+class DataPlane:
+    def __init__(self):
+        self.data_version = None
+        self.pyramid = None
+        self.lock = threading.Lock()
+
+    def get_pyramid(self, engine):
+        snapshot = current_snapshot()
+        if snapshot is None:
+            ensure_snapshot(engine)
+            snapshot = current_snapshot()
+        directory, manifest = snapshot
+        with self.lock:
+            if manifest["data_version"] != self.data_version:
+                try:
+                    self.pyramid = map_snapshot(directory, manifest["data_version"])
+                except FileNotFoundError:
+                    # Superseded between reading the manifest and mapping it
+                    directory, manifest = current_snapshot()
+                    self.pyramid = map_snapshot(directory, manifest["data_version"])
+                self.data_version = manifest["data_version"]
+            return self.data_version, self.pyramid
+
+    def preload(self):
+        # Maps the flow's snapshot at startup, if there is one, so the first
+        # request doesn't wait; never reads the database
+        if SNAPSHOT_DIR and read_manifest(SNAPSHOT_DIR) is not None:
+            try:
+                self.get_pyramid(None)
+            except Exception as e:
+                print(f"Could not map the data snapshot at startup: {e}")
+
+    def get(self, engine):
+        # The hourly datasets only
+        data_version, pyramid = self.get_pyramid(engine)
+        return data_version, pyramid["hour"]
+
+
+DATA_PLANE = DataPlane()
+
+
+def refresh_snapshot(engine):
+    # The flow publishes its snapshots itself
+    if SNAPSHOT_DIR and read_manifest(SNAPSHOT_DIR) is not None:
+        return
+    try:
+        with snapshot_lock():
+            write_snapshot(engine)
+    except Exception as e:
+        print(f"Data snapshot refresh failed: {e}")
+
+
+def wait_for_notifications(engine):
+    # Blocks on LISTEN until the aggregation flow publishes a new data version,
+    # falling back to a refresh every DATA_REFRESH_SECONDS without one
+    raw_conn = engine.raw_connection()
+    try:
+        pg_conn = raw_conn.dbapi_connection
+        pg_conn.autocommit = True
+        with pg_conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {DATA_VERSION_CHANNEL}")
+        # Catch up on anything published before LISTEN took effect
+        refresh_snapshot(engine)
+        while True:
+            ready, _, _ = select.select([pg_conn], [], [], DATA_REFRESH_SECONDS)
+            if ready:
+                pg_conn.poll()
+                versions = [notify.payload for notify in pg_conn.notifies]
+                pg_conn.notifies.clear()
+                print(f"Notified of data versions {versions}")
+            refresh_snapshot(engine)
+    finally:
+        raw_conn.invalidate()
+
+
+def run_refresher(engine):
+    # Every process starts this thread but only the holder of the refresher lock
+    # gets past flock; if it dies, the kernel releases the lock to the next one
+    lock_file = open_lock_file("refresher.lock")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    print(f"Process {os.getpid()} is the data refresher")
+    while True:
+        if engine.dialect.name != "postgresql":
+            refresh_snapshot(engine)
+            time.sleep(DATA_REFRESH_SECONDS)
+            continue
+        try:
+            wait_for_notifications(engine)
+        except Exception as e:
+            print(f"Lost the data version listener, reconnecting: {e}")
+            time.sleep(5)
+
+
+def start_data_refresher(engine):
+    DATA_PLANE.preload()
+    threading.Thread(target=run_refresher, args=(engine,), daemon=True).start()
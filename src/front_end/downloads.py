@@ -0,0 +1,184 @@
+import io
+import os
+import zlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+DOWNLOAD_CHUNK_ROWS = int(os.getenv("DOWNLOAD_CHUNK_ROWS", 50000))
+
+DOWNLOAD_FORMATS = {
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+POSTGRES_ARROW_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "numeric": pa.float64(),
+    "boolean": pa.bool_(),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+    "date": pa.date32(),
+}
+# The DATE_PART columns generate_range_query adds, double precision in Postgres
+RANGE_QUERY_COLUMNS = ["hour_of_day", "day_of_week", "day_of_month", "month"]
+
+
+def generate_range_query(table):
+    return f"""
+    SELECT
+        DATE_PART('hour', pickup_hour) AS hour_of_day,
+        DATE_PART('dow', pickup_hour) AS day_of_week,
+        DATE_PART('day', pickup_hour) AS day_of_month,
+        DATE_PART('month', pickup_hour) AS month,
+        *
+    FROM {table}
+    WHERE pickup_hour >= :start_date AND pickup_hour <= :end_date
+    ORDER BY pickup_hour
+    """
+
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file object that hands back whatever was written since the last
+    # pop, while still reporting the absolute position the writers rely on
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_range_chunks(engine, query, params):
+    # stream_results makes psycopg2 use a server-side cursor, so only one chunk of
+    # rows is held in memory at a time
+    with engine.connect() as conn:
+        conn = conn.execution_options(
+            stream_results=True, max_row_buffer=DOWNLOAD_CHUNK_ROWS
+        )
+        for chunk in pd.read_sql(
+            text(query), conn, params=params, chunksize=DOWNLOAD_CHUNK_ROWS
+        ):
+            yield chunk
+
+
+def table_arrow_schema(conn, table):
+    # Typed from the catalog rather than the first chunk, where sparse columns
+    # such as SR_Flag are often entirely null. pg_attribute also lists the
+    # columns of the materialized views the hourly tables may be.
+    if conn.dialect.name != "postgresql":
+        return None
+    rows = conn.execute(
+        text(
+            """
+            SELECT attname, format_type(atttypid, NULL)
+            FROM pg_attribute
+            WHERE attrelid = to_regclass(:table) AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+            """
+        ),
+        dict(table=table),
+    ).fetchall()
+    if not rows:
+        return None
+    return pa.schema(
+        [
+            pa.field(column_name, POSTGRES_ARROW_TYPES.get(data_type, pa.string()))
+            for column_name, data_type in rows
+        ]
+    )
+
+
+def range_arrow_schema(engine, table):
+    with engine.connect() as conn:
+        schema = table_arrow_schema(conn, table)
+    if schema is None:
+        return None
+    return pa.schema(
+        [pa.field(column, pa.float64()) for column in RANGE_QUERY_COLUMNS]
+        + list(schema)
+    )
+
+
+def arrow_schema_for_chunk(chunk):
+    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+    # A column that is entirely null in the first chunk would otherwise be typed
+    # as null and reject the values of later chunks
+    return pa.schema(
+        [
+            (
+                pa.field(field.name, pa.float64())
+                if pa.types.is_null(field.type)
+                else field
+            )
+            for field in schema
+        ]
+    )
+
+
+def stream_csv_gz(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    header = True
+    for chunk in chunks:
+        data = chunk.to_csv(index=False, header=header).encode()
+        header = False
+        yield compressor.compress(data)
+    yield compressor.flush()
+
+
+def stream_arrow_format(chunks, open_writer, schema):
+    # The writer is opened up front, so a range without rows still makes a
+    # valid, empty file. Without a schema from the catalog the first chunk's
+    # is used, and a file without columns is written if no chunk comes at all.
+    sink = ChunkSink()
+    writer = open_writer(sink, schema) if schema is not None else None
+    for chunk in chunks:
+        if writer is None:
+            schema = arrow_schema_for_chunk(chunk)
+            writer = open_writer(sink, schema)
+        writer.write_table(
+            pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        )
+        yield sink.pop()
+    if writer is None:
+        writer = open_writer(sink, pa.schema([]))
+    writer.close()
+    yield sink.pop()
+
+
+def stream_download(engine, table, start_date, end_date, download_format):
+    chunks = iter_range_chunks(
+        engine,
+        generate_range_query(table),
+        dict(start_date=start_date, end_date=end_date),
+    )
+    if download_format == "csv.gz":
+        return stream_csv_gz(chunks)
+    schema = range_arrow_schema(engine, table)
+    if download_format == "parquet":
+        return stream_arrow_format(
+            chunks,
+            lambda sink, schema: pq.ParquetWriter(sink, schema, compression="zstd"),
+            schema,
+        )
+    return stream_arrow_format(chunks, pa.ipc.new_stream, schema)
@@ -0,0 +1,369 @@
+import fcntl
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from downloads import (
+    DOWNLOAD_CHUNK_ROWS,
+    arrow_schema_for_chunk,
+    iter_range_chunks,
+    table_arrow_schema,
+)
+from sqlalchemy import create_engine, inspect, text
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "/exports")
+EXPORT_MAX_CONCURRENT_JOBS = int(os.getenv("EXPORT_MAX_CONCURRENT_JOBS", 2))
+# Queued and running jobs together; submissions beyond it are turned away
+EXPORT_MAX_QUEUED_JOBS = int(os.getenv("EXPORT_MAX_QUEUED_JOBS", 10))
+EXPORT_RETENTION_HOURS = int(os.getenv("EXPORT_RETENTION_HOURS", 24))
+# A worker touches its job's claim file this often; a claimed job whose file
+# is older than the timeout lost its worker (OOM, restart) and is failed
+EXPORT_HEARTBEAT_SECONDS = int(os.getenv("EXPORT_HEARTBEAT_SECONDS", 10))
+EXPORT_HEARTBEAT_TIMEOUT_SECONDS = int(
+    os.getenv("EXPORT_HEARTBEAT_TIMEOUT_SECONDS", 120)
+)
+EXPORT_SERVICES = ["fhvhv", "fhv", "yellow", "green"]
+# Closed months the aggregation flows moved out of Postgres, as hive-partitioned
+# Parquet: <ARCHIVE_PATH>/<table>/pickup_month=YYYY-MM/
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "/archive")
+
+
+def generate_trip_query(table):
+    return f"""
+    SELECT *
+    FROM {table}
+    WHERE pickup_datetime >= :start_date AND pickup_datetime < :end_date
+    """
+
+
+def is_valid_job_id(job_id):
+    if not isinstance(job_id, str):
+        return False
+    try:
+        return uuid.UUID(hex=job_id).hex == job_id
+    except ValueError:
+        return False
+
+
+def job_path(job_id, *parts):
+    return os.path.join(EXPORT_DIR, job_id, *parts)
+
+
+def read_job(job_id):
+    try:
+        with open(job_path(job_id, "job.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_job(job):
+    # Written to a temporary file and renamed, so pollers never read half a file
+    tmp_path = job_path(job["job_id"], "job.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, job_path(job["job_id"], "job.json"))
+
+
+def fail_abandoned_job(job):
+    # Only the worker moves a job out of queued or running, so a job whose
+    # worker died would otherwise stay there, and count toward the cap, forever
+    if job["status"] not in ("queued", "running"):
+        return job
+    try:
+        heartbeat_at = os.path.getmtime(job_path(job["job_id"], "claimed"))
+    except FileNotFoundError:
+        return job
+    if time.time() - heartbeat_at > EXPORT_HEARTBEAT_TIMEOUT_SECONDS:
+        print(f"Export job {job['job_id']} lost its worker")
+        job["status"] = "failed"
+        job["error"] = "The export worker stopped"
+        job["finished_at"] = datetime.now().isoformat()
+        write_job(job)
+    return job
+
+
+def beat_heartbeat(job_id, stopped):
+    while not stopped.wait(EXPORT_HEARTBEAT_SECONDS):
+        os.utime(job_path(job_id, "claimed"))
+
+
+def remove_expired_jobs():
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    expiry = time.time() - EXPORT_RETENTION_HOURS * 3600
+    for job_id in os.listdir(EXPORT_DIR):
+        path = job_path(job_id)
+        if job_id.startswith(".") or not os.path.isdir(path):
+            continue
+        job = read_job(job_id)
+        if job is not None:
+            job = fail_abandoned_job(job)
+        if job is not None and job["status"] in ("queued", "running"):
+            continue
+        if os.path.getmtime(path) < expiry:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def list_jobs(statuses):
+    # In submission order
+    if not os.path.isdir(EXPORT_DIR):
+        return []
+    jobs = [
+        fail_abandoned_job(job)
+        for job in map(read_job, os.listdir(EXPORT_DIR))
+        if job is not None
+    ]
+    jobs = [job for job in jobs if job["status"] in statuses]
+    return sorted(jobs, key=lambda job: job["submitted_at"])
+
+
+def unclaimed_job_ids():
+    return [
+        job["job_id"]
+        for job in list_jobs(["queued"])
+        if not os.path.exists(job_path(job["job_id"], "claimed"))
+    ]
+
+
+def claim_next_job():
+    # The claim file is created exclusively, so each job runs once however
+    # many export workers look for work
+    for job_id in unclaimed_job_ids():
+        try:
+            os.close(os.open(job_path(job_id, "claimed"), os.O_CREAT | os.O_EXCL))
+            return job_id
+        except FileExistsError:
+            continue
+    return None
+
+
+def submit_export_job(db_url, service, start_date, end_date):
+    # Reap finished workers so they don't linger as zombies
+    multiprocessing.active_children()
+    remove_expired_jobs()
+    if len(list_jobs(["queued", "running"])) >= EXPORT_MAX_QUEUED_JOBS:
+        return None
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(job_path(job_id))
+    write_job(
+        dict(
+            job_id=job_id,
+            service=service,
+            start_date=start_date,
+            end_date=end_date,
+            status="queued",
+            rows_written=0,
+            rows_estimated=None,
+            file_name=None,
+            error=None,
+            submitted_at=datetime.now().isoformat(),
+        )
+    )
+    # Queued jobs wait as records: a worker is only started when a slot is
+    # free, and the workers holding the slots run the queue in order
+    slot = acquire_export_slot()
+    if slot is not None:
+        slot.close()
+        # A fresh interpreter rather than a fork of the (threaded) web server
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_export_jobs, args=(db_url,)
+        )
+        process.start()
+    return job_id
+
+
+def acquire_export_slot():
+    # The slots are file locks, so the limit holds across every server process
+    slots_dir = os.path.join(EXPORT_DIR, ".slots")
+    os.makedirs(slots_dir, exist_ok=True)
+    for slot in range(EXPORT_MAX_CONCURRENT_JOBS):
+        slot_file = open(os.path.join(slots_dir, f"slot-{slot}.lock"), "w")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot_file
+        except BlockingIOError:
+            slot_file.close()
+    return None
+
+
+def estimate_rows(conn, query, params):
+    # The planner's estimate is free, unlike a COUNT(*) over the raw table
+    if conn.dialect.name != "postgresql":
+        return None
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def get_archived_months(conn, table, start_date, end_date):
+    # Only months recorded as archived: the flow records a month in the same
+    # transaction that deletes it from Postgres
+    if not inspect(conn).has_table("archived_months"):
+        return {}
+    rows = conn.execute(
+        text(
+            """
+            SELECT month, row_count FROM archived_months
+            WHERE table_name = :table
+                AND month < :end_date
+                AND month + INTERVAL '1 month' > :start_date
+            """
+        ),
+        dict(table=table, start_date=start_date, end_date=end_date),
+    ).fetchall()
+    return {f"{month:%Y-%m}": row_count for month, row_count in rows}
+
+
+def iter_archived_chunks(table, months, start_date, end_date, schema):
+    if not months:
+        return
+    dataset = ds.dataset(
+        os.path.join(ARCHIVE_PATH, table), format="parquet", partitioning="hive"
+    )
+    row_filter = (
+        ds.field("pickup_month").isin(list(months))
+        & (ds.field("pickup_datetime") >= pd.Timestamp(start_date))
+        & (ds.field("pickup_datetime") < pd.Timestamp(end_date))
+    )
+    columns = schema.names if schema is not None else None
+    for batch in dataset.to_batches(
+        columns=columns, filter=row_filter, batch_size=DOWNLOAD_CHUNK_ROWS
+    ):
+        yield batch.to_pandas()
+
+
+def write_partitions(chunks, parts_dir, job, schema):
+    writers = {}
+    try:
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            if schema is None:
+                schema = arrow_schema_for_chunk(chunk)
+            pickup_months = pd.to_datetime(chunk["pickup_datetime"]).dt.strftime(
+                "%Y-%m"
+            )
+            for pickup_month, month_chunk in chunk.groupby(pickup_months):
+                if pickup_month not in writers:
+                    partition_dir = os.path.join(
+                        parts_dir, f"pickup_month={pickup_month}"
+                    )
+                    os.makedirs(partition_dir)
+                    writers[pickup_month] = pq.ParquetWriter(
+                        os.path.join(partition_dir, "part-0.parquet"),
+                        schema,
+                        compression="zstd",
+                    )
+                writers[pickup_month].write_table(
+                    pa.Table.from_pandas(
+                        month_chunk, schema=schema, preserve_index=False
+                    )
+                )
+            job["rows_written"] += len(chunk)
+            write_job(job)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def bundle_partitions(parts_dir, bundle_path):
+    # Parquet is already compressed, so the parts are only stored in the archive
+    with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_STORED) as bundle:
+        for root, _, files in os.walk(parts_dir):
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                bundle.write(path, os.path.relpath(path, parts_dir))
+
+
+def run_export_jobs(db_url):
+    # Exports are batch work: let the dashboard workers win the CPU
+    os.nice(10)
+    # Runs queued jobs while it holds a slot and exits when none are left
+    while True:
+        slot = acquire_export_slot()
+        if slot is None:
+            return
+        try:
+            job_id = claim_next_job()
+            while job_id is not None:
+                run_export_job(db_url, job_id)
+                job_id = claim_next_job()
+        finally:
+            slot.close()
+        # A job submitted while every slot was held is seen here, after the
+        # slot is released
+        if not unclaimed_job_ids():
+            return
+
+
+def run_export_job(db_url, job_id):
+    job = read_job(job_id)
+    engine = create_engine(db_url)
+    table = f"{job['service']}_tripdata"
+    query = generate_trip_query(table)
+    # The chosen end date is included in full
+    params = dict(
+        start_date=job["start_date"],
+        end_date=date.fromisoformat(job["end_date"][:10]) + timedelta(days=1),
+    )
+    stopped = threading.Event()
+    threading.Thread(target=beat_heartbeat, args=(job_id, stopped), daemon=True).start()
+    try:
+        job["status"] = "running"
+        job["started_at"] = datetime.now().isoformat()
+        with engine.connect() as conn:
+            job["rows_estimated"] = estimate_rows(conn, query, params)
+            schema = table_arrow_schema(conn, table)
+            archived_months = get_archived_months(conn, table, **params)
+        if job["rows_estimated"] is not None:
+            job["rows_estimated"] += sum(archived_months.values())
+        write_job(job)
+
+        # Archived months from their Parquet files, the rest from Postgres
+        chunks = itertools.chain(
+            iter_archived_chunks(table, archived_months, schema=schema, **params),
+            iter_range_chunks(engine, query, params),
+        )
+        parts_dir = job_path(job_id, "parts")
+        write_partitions(chunks, parts_dir, job, schema)
+
+        file_name = (
+            f"{job['service']}_tripdata_from_{job['start_date'][:10]}"
+            f"_to_{job['end_date'][:10]}.zip"
+        )
+        bundle_partitions(parts_dir, job_path(job_id, file_name))
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        job["file_name"] = file_name
+        job["status"] = "done"
+    except Exception as e:
+        print(f"Export job {job_id} failed: {e}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = datetime.now().isoformat()
+        stopped.set()
+        write_job(job)
+        engine.dispose()
+
+
+def job_progress(job):
+    if job["status"] == "done":
+        return 100
+    if job["status"] != "running" or not job["rows_estimated"]:
+        return 0
+    # Never report done from an estimate
+    return min(99, int(100 * job["rows_written"] / job["rows_estimated"]))
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+FIGURE_CACHE_SIZE = int(os.getenv("FIGURE_CACHE_SIZE", 512))
+FIGURE_CACHE_TTL_SECONDS = int(os.getenv("FIGURE_CACHE_TTL_SECONDS", 3600))
+FILTERED_SLICE_CACHE_SIZE = int(os.getenv("FILTERED_SLICE_CACHE_SIZE", 16))
+
+
+class VersionedLRUCache:
+    def __init__(self, name, max_size, ttl_seconds):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.data_version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _set_data_version(self, data_version):
+        # Every entry was built from the previous data, so drop them all at once
+        if data_version != self.data_version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.data_version = data_version
+
+    def get(self, key, data_version):
+        with self.lock:
+            self._set_data_version(data_version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels(self.name, "miss").inc()
+                return None
+            created_at, value = entry
+            if time.monotonic() - created_at > self.ttl_seconds:
+                del self.entries[key]
+                self.misses += 1
+                CACHE_LOOKUPS.labels(self.name, "miss").inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.labels(self.name, "hit").inc()
+            return value
+
+    def put(self, key, data_version, value):
+        with self.lock:
+            self._set_data_version(data_version)
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, data_version, build):
+        value = self.get(key, data_version)
+        if value is None:
+            # Built outside the lock so a slow build doesn't block other callbacks
+            value = build()
+            self.put(key, data_version, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                data_version=self.data_version,
+                size=len(self.entries),
+                max_size=self.max_size,
+                ttl_seconds=self.ttl_seconds,
+                hits=self.hits,
+                misses=self.misses,
+                hit_ratio=round(self.hits / lookups, 4) if lookups else None,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+            )
+
+
+FIGURE_CACHE = VersionedLRUCache(
+    name="figures", max_size=FIGURE_CACHE_SIZE, ttl_seconds=FIGURE_CACHE_TTL_SECONDS
+)
+
+# Date-filtered views of the hourly tables, shared by the callbacks of one
+# interaction. They are views of the mapped snapshot, so entries are cheap.
+FILTERED_SLICE_CACHE = VersionedLRUCache(
+    name="filtered_slices",
+    max_size=FILTERED_SLICE_CACHE_SIZE,
+    ttl_seconds=FIGURE_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = "0.0.0.0:8053"
+
+# Each worker maps the same shared-memory data snapshot (see data_store.py), so
+# adding workers adds CPU without multiplying the dataset in memory
+workers = int(os.getenv("DASH_WORKERS", 4))
+worker_class = "gthread"
+# Dashboards poll /data-version rather than holding a request open, so every
+# thread stays free for callbacks
+threads = int(os.getenv("DASH_THREADS", 4))
+
+# Idle keep-alive connections wait in the gthread poller without holding a
+# thread. The 2 s default closes them between a user's clicks, and a browser
+# reusing a connection just as the server closes it sees a reset request.
+keepalive = 75
+
+# Downloads and exports can stream for a while
+timeout = 300
+graceful_timeout = 30
+
+accesslog = "-"
+
+
+def on_starting(server):
+    # Samples left by the workers of a previous run would be summed in again
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,11 +1,33 @@
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import date, datetime
+from urllib.parse import urlencode
 
 import bcrypt
 import dash_bootstrap_components as dbc
-import pandas as pd
-from dash import Dash, Input, Output, State, callback, dcc, html
-from flask import Flask, redirect, request
+from api import (
+    API_FORMATS,
+    hourly_etag,
+    negotiate_format,
+    parse_date_arg,
+    serialize_hourly,
+)
+from dash import ClientsideFunction, Dash, Input, Output, State, dcc, html, no_update
+from data_store import DATA_PLANE, current_snapshot, start_data_refresher
+from downloads import DOWNLOAD_FORMATS, stream_download
+from exports import (
+    fail_abandoned_job,
+    is_valid_job_id,
+    job_path,
+    job_progress,
+    read_job,
+    submit_export_job,
+)
+from figure_cache import FIGURE_CACHE, FILTERED_SLICE_CACHE
+from flask import Flask, Response, abort, jsonify, redirect, request, send_file
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -14,13 +36,36 @@ from flask_login import (
     login_user,
     logout_user,
 )
+from metrics import instrument_server
+from rollups import GROUPING_GRAINS, range_rows
 from sqlalchemy import create_engine
 from utils import *
+from zones import fetch_zone_options
 
 DB_URL = os.getenv("DB_URL")
 DASHBOARD_USER = os.getenv("DASHBOARD_USER")
 DASHBOARD_PASSWORD = os.getenv("DASHBOARD_PASSWORD")
 
+SERVICES = ["fhvhv", "fhv", "yellow", "green"]
+# How often each open dashboard asks for the data version; new data is
+# published at most hourly
+DATA_VERSION_POLL_SECONDS = int(os.getenv("DATA_VERSION_POLL_SECONDS", 30))
+
+SERVICE_NAMES_MAP = {
+    "FHVHV": "fhvhv",
+    "FHV": "fhv",
+    "Yellow": "yellow",
+    "Green": "green",
+}
+
+DOWNLOAD_FORMAT_MAP = {
+    "Compressed CSV (.csv.gz)": "csv.gz",
+    "Parquet": "parquet",
+    "Arrow IPC stream": "arrow",
+}
+
+KPI_COLS = ["num_trips", "total_amount_payed"]
+
 AGGREGATION_TIME_MAP = {
     "By hour of day": "hour_of_day",
     "By day of week": "day_of_week",
@@ -39,6 +84,14 @@ AVG_METRICS_MAP = {
     "Average taxi request - on scene time, min": "avg_request_to_on_scene_time_min",
 }
 
+TIME_SERIES_METRICS_MAP = {**SUMMED_METRICS_MAP, **AVG_METRICS_MAP}
+
+TRIP_DISTRIBUTION_METRICS_MAP = {
+    "Trip duration, min": "trip_time_min",
+    "Trip distance, miles": "trip_miles",
+    "Amount payed per trip": "amount_payed",
+}
+
 PRICE_CONTRIBUTORS = {
     "fhvhv": [
         "total_base_fare_amount",
@@ -75,6 +128,9 @@ PRICE_CONTRIBUTORS = {
 server = Flask(__name__)
 server.secret_key = os.getenv("SERVER_SECRET_KEY")
 
+engine = create_engine(DB_URL, pool_pre_ping=True)
+start_data_refresher(engine)
+
 # ----------- Flask-Login Setup -----------
 login_manager = LoginManager()
 login_manager.init_app(server)
@@ -93,11 +149,54 @@ USERS = {
 }
 
 
+# Basic credentials already checked with bcrypt, so API clients re-sending them
+# on every request don't pay for a bcrypt round each time. Entries expire, so a
+# leaked or changed password stops working within the TTL, and the least
+# recently used go once the cache is full.
+CREDENTIALS_CACHE_SECONDS = int(os.getenv("CREDENTIALS_CACHE_SECONDS", 300))
+CREDENTIALS_CACHE_SIZE = int(os.getenv("CREDENTIALS_CACHE_SIZE", 1000))
+VERIFIED_CREDENTIALS = OrderedDict()
+VERIFIED_CREDENTIALS_LOCK = threading.Lock()
+
+
+def check_credentials(username, password):
+    if username not in USERS:
+        return False
+    digest = hashlib.sha256(
+        f"{server.secret_key}:{username}:{password}".encode()
+    ).hexdigest()
+    checked_at = time.monotonic()
+    with VERIFIED_CREDENTIALS_LOCK:
+        expires = VERIFIED_CREDENTIALS.get(digest)
+        if expires is not None and expires > checked_at:
+            VERIFIED_CREDENTIALS.move_to_end(digest)
+            return True
+        VERIFIED_CREDENTIALS.pop(digest, None)
+    if not bcrypt.checkpw(password.encode("utf-8"), USERS[username]):
+        return False
+    with VERIFIED_CREDENTIALS_LOCK:
+        VERIFIED_CREDENTIALS[digest] = checked_at + CREDENTIALS_CACHE_SECONDS
+        while len(VERIFIED_CREDENTIALS) > CREDENTIALS_CACHE_SIZE:
+            VERIFIED_CREDENTIALS.popitem(last=False)
+    return True
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User(user_id)
 
 
+@login_manager.request_loader
+def load_user_from_request(request):
+    # HTTP Basic auth for clients without a login session, such as notebooks
+    credentials = request.authorization
+    if credentials is None or credentials.type != "basic":
+        return None
+    if check_credentials(credentials.username, credentials.password):
+        return User(credentials.username)
+    return None
+
+
 now = datetime.now()
 now_2024_date = date(2024, now.month, now.day)
 
@@ -107,6 +206,9 @@ app = Dash(
     server=server,
     url_base_pathname="/dashboard/",
 )
+# Callback timings and payload sizes, served unauthenticated on /metrics for
+# Prometheus
+instrument_server(server, app.callback_map)
 
 app.title = "NYC Taxi Trip Data"
 
@@ -141,6 +243,138 @@ def logout():
     return redirect("/login")
 
 
+@server.route("/cache-stats")
+@login_required
+def cache_stats():
+    return jsonify(
+        dict(figures=FIGURE_CACHE.stats(), filtered_slices=FILTERED_SLICE_CACHE.stats())
+    )
+
+
+@server.route("/data-version")
+@login_required
+def data_version():
+    # Polled by every open dashboard: answered from the snapshot manifest, and
+    # with a 304 while the browser already has the version
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        version = snapshot[1]["data_version"]
+    else:
+        version, _ = DATA_PLANE.get(engine)
+    headers = {"ETag": f'"{version}"', "Cache-Control": "private, no-cache"}
+    if request.if_none_match.contains(version):
+        return Response(status=304, headers=headers)
+    response = jsonify(data_version=version)
+    response.headers.update(headers)
+    return response
+
+
+@server.route("/download/<service>")
+@login_required
+def download(service):
+    download_format = request.args.get("format", "csv.gz")
+    if service not in SERVICES or download_format not in DOWNLOAD_FORMATS:
+        abort(404)
+    try:
+        start_date = datetime.fromisoformat(request.args["start_date"])
+        end_date = datetime.fromisoformat(request.args["end_date"])
+    except (KeyError, ValueError):
+        abort(400)
+    file_name = (
+        f"{service}_from_{start_date.date()}_to_{end_date.date()}.{download_format}"
+    )
+    return Response(
+        stream_download(
+            engine=engine,
+            table=f"{service}_hourly_tripdata",
+            start_date=start_date,
+            end_date=end_date,
+            download_format=download_format,
+        ),
+        mimetype=DOWNLOAD_FORMATS[download_format],
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
+
+
+@server.route("/exports/<job_id>")
+@login_required
+def export_status(job_id):
+    job = read_job(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        abort(404)
+    return jsonify({**job, "progress": job_progress(job)})
+
+
+@server.route("/exports/<job_id>/download")
+@login_required
+def export_download(job_id):
+    job = read_job(job_id) if is_valid_job_id(job_id) else None
+    if job is None or job["status"] != "done":
+        abort(404)
+    # conditional=True answers Range and If-Range requests, so interrupted
+    # downloads of large exports can resume
+    return send_file(
+        job_path(job_id, job["file_name"]),
+        as_attachment=True,
+        download_name=job["file_name"],
+        conditional=True,
+    )
+
+
+@server.route("/api/hourly/<service>")
+def hourly_api(service):
+    # Read-only hourly aggregates from the shared snapshot for other consumers.
+    # Strong ETags let repeat readers revalidate with If-None-Match and get a
+    # 304 without the data being sliced or serialized again.
+    if not current_user.is_authenticated:
+        return Response(
+            "Authentication required",
+            401,
+            {"WWW-Authenticate": 'Basic realm="nyc-taxi"'},
+        )
+    if service not in SERVICES:
+        abort(404)
+    api_format = negotiate_format(request)
+    if api_format is None:
+        abort(406)
+    try:
+        start_date = parse_date_arg(request.args.get("start_date"))
+        end_date = parse_date_arg(request.args.get("end_date"))
+    except ValueError:
+        abort(400)
+
+    data_version, datasets = DATA_PLANE.get(engine)
+    df = datasets[service]
+    columns = list(df.columns)
+    if "columns" in request.args:
+        columns = request.args["columns"].split(",")
+        if not set(columns) <= set(df.columns):
+            abort(400)
+    etag = hourly_etag(data_version, service, start_date, end_date, columns, api_format)
+    headers = {
+        "ETag": f'"{etag}"',
+        "X-Data-Version": data_version,
+        # Authenticated data: browsers may keep it, shared caches may not, and
+        # every reuse is revalidated against the current data version
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept, Authorization, Cookie",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    if len(df) and (start_date is not None or end_date is not None):
+        df = filter_date_range(
+            df,
+            start_date or df["pickup_hour"].iloc[0],
+            end_date or df["pickup_hour"].iloc[-1],
+        )
+    return Response(
+        serialize_hourly(df[columns], api_format),
+        mimetype=API_FORMATS[api_format],
+        headers=headers,
+    )
+
+
 @app.server.before_request
 def restrict_dash():
     if request.path.startswith("/dashboard") and not current_user.is_authenticated:
@@ -403,8 +637,125 @@ app.layout = dbc.Container(
             ],
             className="text-center",
         ),
+        dbc.Row(html.H3("2. Hourly time series"), className="text-center mt-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a service"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(SERVICE_NAMES_MAP.keys()),
+                                    value=list(SERVICE_NAMES_MAP.keys())[0],
+                                    clearable=False,
+                                    style={"color": "black"},
+                                    id="time-series-service",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a metric to visualize"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(TIME_SERIES_METRICS_MAP.keys()),
+                                    value=list(TIME_SERIES_METRICS_MAP.keys())[0],
+                                    clearable=False,
+                                    style={"color": "black"},
+                                    id="time-series-metric",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+            ],
+            justify="center",
+            className="text-center",
+        ),
+        dbc.Row(
+            dbc.Col(
+                dbc.Card(
+                    dbc.CardBody(
+                        dcc.Graph(
+                            figure={},
+                            config={"displaylogo": False},
+                            id="time-series",
+                        )
+                    )
+                ),
+                width=12,
+                className="mt-2",
+            ),
+            className="text-center",
+        ),
+        dbc.Row(html.H3("3. Trips by pickup zone"), className="text-center mt-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a service"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(SERVICE_NAMES_MAP.keys()),
+                                    value=list(SERVICE_NAMES_MAP.keys())[0],
+                                    clearable=False,
+                                    style={"color": "black"},
+                                    id="zone-service",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a pickup zone"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=[],
+                                    placeholder="Pickup zone",
+                                    style={"color": "black"},
+                                    id="zone-location",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+            ],
+            justify="center",
+            className="text-center",
+        ),
+        dbc.Row(
+            dbc.Col(
+                dbc.Card(
+                    dbc.CardBody(
+                        dcc.Graph(
+                            figure={},
+                            config={"displaylogo": False},
+                            id="zone-trips",
+                        )
+                    )
+                ),
+                width=12,
+                className="mt-2",
+            ),
+            className="text-center",
+        ),
         dbc.Row(
-            html.H3("2. Contributions to total prices payed"),
+            html.H3("4. Contributions to total prices payed"),
             className="text-center mt-4",
         ),
         dbc.Row(
@@ -475,7 +826,7 @@ app.layout = dbc.Container(
             ],
             className="text-center",
         ),
-        dbc.Row(html.H3("3. Other metric distribution"), className="text-center mt-4"),
+        dbc.Row(html.H3("5. Other metric distribution"), className="text-center mt-4"),
         dbc.Row(
             [
                 dbc.Col(
@@ -554,7 +905,112 @@ app.layout = dbc.Container(
             ],
             className="text-center",
         ),
-        dbc.Row(html.H3("4. Data download"), className="text-center mt-4"),
+        dbc.Row(html.H3("6. Trip-level distribution"), className="text-center mt-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a metric to visualize"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(TRIP_DISTRIBUTION_METRICS_MAP.keys()),
+                                    value=list(TRIP_DISTRIBUTION_METRICS_MAP.keys())[0],
+                                    placeholder="Choose metric",
+                                    style={"color": "black"},
+                                    id="trip-distribution",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+            ],
+            justify="center",
+            className="text-center",
+        ),
+        dbc.Row(
+            html.H4("", id="trip-distribution-title"), className="text-center mt-4"
+        ),
+        dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        dbc.Card(
+                            [
+                                dbc.CardHeader("FHVHV"),
+                                dbc.CardBody([], id="trip-distribution-fhvhv"),
+                            ]
+                        ),
+                    ],
+                    width=6,
+                    className="mt-2",
+                ),
+                dbc.Col(
+                    [
+                        dbc.Card(
+                            [
+                                dbc.CardHeader("FHV"),
+                                dbc.CardBody([], id="trip-distribution-fhv"),
+                            ]
+                        ),
+                    ],
+                    width=6,
+                    className="mt-2",
+                ),
+                dbc.Col(
+                    [
+                        dbc.Card(
+                            [
+                                dbc.CardHeader("Yellow"),
+                                dbc.CardBody([], id="trip-distribution-yellow"),
+                            ]
+                        ),
+                    ],
+                    width=6,
+                    className="mt-2",
+                ),
+                dbc.Col(
+                    [
+                        dbc.Card(
+                            [
+                                dbc.CardHeader("Green"),
+                                dbc.CardBody([], id="trip-distribution-green"),
+                            ]
+                        ),
+                    ],
+                    width=6,
+                    className="mt-2",
+                ),
+            ],
+            className="text-center",
+        ),
+        dbc.Row(html.H3("7. Data download"), className="text-center mt-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a file format"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(DOWNLOAD_FORMAT_MAP.keys()),
+                                    value=list(DOWNLOAD_FORMAT_MAP.keys())[0],
+                                    clearable=False,
+                                    style={"color": "black"},
+                                    id="download-format",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+            ],
+            justify="center",
+            className="text-center mb-2",
+        ),
         dbc.Row(
             [
                 dbc.Col(
@@ -563,14 +1019,13 @@ app.layout = dbc.Container(
                             [
                                 dbc.CardHeader("FHVHV"),
                                 dbc.CardBody(
-                                    [
-                                        html.Button(
-                                            "Download",
-                                            id="hfvhv-download-button",
-                                            style={"width": "100%"},
-                                        ),
-                                        dcc.Download(id="fhvhv-download-csv"),
-                                    ]
+                                    html.A(
+                                        "Download",
+                                        href="",
+                                        id="fhvhv-download-link",
+                                        className="btn btn-primary",
+                                        style={"width": "100%"},
+                                    )
                                 ),
                             ]
                         ),
@@ -583,14 +1038,13 @@ app.layout = dbc.Container(
                             [
                                 dbc.CardHeader("FHV"),
                                 dbc.CardBody(
-                                    [
-                                        html.Button(
-                                            "Download",
-                                            id="hfv-download-button",
-                                            style={"width": "100%"},
-                                        ),
-                                        dcc.Download(id="fhv-download-csv"),
-                                    ]
+                                    html.A(
+                                        "Download",
+                                        href="",
+                                        id="fhv-download-link",
+                                        className="btn btn-primary",
+                                        style={"width": "100%"},
+                                    )
                                 ),
                             ]
                         ),
@@ -603,14 +1057,13 @@ app.layout = dbc.Container(
                             [
                                 dbc.CardHeader("Yellow"),
                                 dbc.CardBody(
-                                    [
-                                        html.Button(
-                                            "Download",
-                                            id="yellow-download-button",
-                                            style={"width": "100%"},
-                                        ),
-                                        dcc.Download(id="yellow-download-csv"),
-                                    ]
+                                    html.A(
+                                        "Download",
+                                        href="",
+                                        id="yellow-download-link",
+                                        className="btn btn-primary",
+                                        style={"width": "100%"},
+                                    )
                                 ),
                             ]
                         ),
@@ -623,14 +1076,13 @@ app.layout = dbc.Container(
                             [
                                 dbc.CardHeader("Green"),
                                 dbc.CardBody(
-                                    [
-                                        html.Button(
-                                            "Download",
-                                            id="green-download-button",
-                                            style={"width": "100%"},
-                                        ),
-                                        dcc.Download(id="green-download-csv"),
-                                    ]
+                                    html.A(
+                                        "Download",
+                                        href="",
+                                        id="green-download-link",
+                                        className="btn btn-primary",
+                                        style={"width": "100%"},
+                                    )
                                 ),
                             ]
                         ),
@@ -640,19 +1092,90 @@ app.layout = dbc.Container(
             ],
             className="text-center",
         ),
+        dbc.Row(html.H3("8. Trip-level export"), className="text-center mt-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader("Choose a service"),
+                            dbc.CardBody(
+                                dcc.Dropdown(
+                                    options=list(SERVICE_NAMES_MAP.keys()),
+                                    value=list(SERVICE_NAMES_MAP.keys())[0],
+                                    clearable=False,
+                                    style={"color": "black"},
+                                    id="export-service",
+                                )
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=3,
+                ),
+                dbc.Col(
+                    dbc.Card(
+                        [
+                            dbc.CardHeader(
+                                "Export every trip in the chosen date range"
+                            ),
+                            dbc.CardBody(
+                                [
+                                    html.Button(
+                                        "Start export",
+                                        id="export-button",
+                                        className="btn btn-primary mb-2",
+                                        style={"width": "100%"},
+                                    ),
+                                    dbc.Progress(
+                                        value=0,
+                                        label="",
+                                        id="export-progress",
+                                        className="mb-2",
+                                    ),
+                                    html.Div("", id="export-status"),
+                                    html.A(
+                                        "Download export",
+                                        href="",
+                                        id="export-download-link",
+                                        className="btn btn-success mt-2",
+                                        style={"width": "100%", "display": "none"},
+                                    ),
+                                ]
+                            ),
+                        ],
+                        className="h-100",
+                    ),
+                    width=6,
+                ),
+            ],
+            justify="center",
+            className="text-center",
+        ),
+        dcc.Store(id="export-job-id"),
+        dcc.Interval(
+            id="export-poll-component",
+            interval=2 * 1000,
+            n_intervals=0,
+            disabled=True,
+        ),
         # These are not for display, but rather for managing data refreshing
         dcc.Interval(
-            id="data-refresh-component",
-            interval=720 * 1000,  # 1 hour in milliseconds
+            id="data-version-poll",
+            interval=DATA_VERSION_POLL_SECONDS * 1000,
             n_intervals=0,
         ),
+        dcc.Store(id="data-version"),
         dcc.Store(id="global-data-store"),
+        dcc.Store(id="kpi-payload"),
+        dcc.Store(id="time-series-view"),
     ],
     fluid=True,
 )
 
 
-@callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="kpi", function_name="update_stats"),
     Output("num-trips-fhvhv", "children"),
     Output("num-trips-fhv", "children"),
     Output("num-trips-yellow", "children"),
@@ -662,29 +1185,51 @@ app.layout = dbc.Container(
     Output("total-payment-green", "children"),
     Input("date-range", "start_date"),
     Input("date-range", "end_date"),
-    Input("global-data-store", "data"),
+    Input("kpi-payload", "data"),
 )
-def update_stats(start_date, end_date, data):
-    fhvhv_df = pd.DataFrame(data["fhvhv_data"])
-    fhv_df = pd.DataFrame(data["fhv_data"])
-    yellow_df = pd.DataFrame(data["yellow_data"])
-    green_df = pd.DataFrame(data["green_data"])
-    yellow_df_2 = yellow_df.query("@start_date<=pickup_hour<=@end_date")
-    green_df_2 = green_df.query("@start_date<=pickup_hour<=@end_date")
-    fhvhv_df_2 = fhvhv_df.query("@start_date<=pickup_hour<=@end_date")
-    hfv_df_2 = fhv_df.query("@start_date<=pickup_hour<=@end_date")
-    return (
-        fhvhv_df_2["num_trips"].sum(),
-        hfv_df_2["num_trips"].sum(),
-        yellow_df_2["num_trips"].sum(),
-        green_df_2["num_trips"].sum(),
-        round(fhvhv_df_2["total_amount_payed"].sum(), 2),
-        round(yellow_df_2["total_amount_payed"].sum(), 2),
-        round(green_df_2["total_amount_payed"].sum(), 2),
+
+
+@app.callback(Output("kpi-payload", "data"), Input("global-data-store", "data"))
+def update_kpi_payload(data):
+    # Sent once per data version; the KPI cards are then computed in the browser
+    data_version, pyramid = DATA_PLANE.get_pyramid(engine)
+    return FIGURE_CACHE.get_or_build(
+        ("kpi_payload",),
+        data_version,
+        lambda: build_kpi_payload(pyramid, KPI_COLS),
+    )
+
+
+def get_filtered_slices(start_date, end_date):
+    # The single filter stage shared by every callback a date-range change fires
+    data_version, datasets = DATA_PLANE.get(engine)
+    slices = FILTERED_SLICE_CACHE.get_or_build(
+        (start_date, end_date),
+        data_version,
+        lambda: {
+            service: filter_date_range(df, start_date, end_date)
+            for service, df in datasets.items()
+        },
     )
+    return data_version, slices
 
 
-@callback(
+def get_range_rows(start_date, end_date, coarsest):
+    # Per service, the fewest hourly, daily and monthly rollup rows that cover
+    # the date range exactly, for callbacks that only need sums over it
+    data_version, pyramid = DATA_PLANE.get_pyramid(engine)
+    rows = FILTERED_SLICE_CACHE.get_or_build(
+        ("range_rows", start_date, end_date, coarsest),
+        data_version,
+        lambda: {
+            service: range_rows(pyramid, service, start_date, end_date, coarsest)
+            for service in SERVICES
+        },
+    )
+    return data_version, rows
+
+
+@app.callback(
     Output("summed-metric-title", "children"),
     Output("summed-metric-fhvhv", "children"),
     Output("summed-metric-fhv", "children"),
@@ -697,46 +1242,45 @@ def update_stats(start_date, end_date, data):
     Input("global-data-store", "data"),
 )
 def update_summed_metrics(start_date, end_date, summed_metric, time_range, data):
-    fhvhv_df = pd.DataFrame(data["fhvhv_data"])
-    fhv_df = pd.DataFrame(data["fhv_data"])
-    yellow_df = pd.DataFrame(data["yellow_data"])
-    green_df = pd.DataFrame(data["green_data"])
     time_col = AGGREGATION_TIME_MAP[time_range]
+    data_version, slices = get_range_rows(
+        start_date, end_date, GROUPING_GRAINS[time_col]
+    )
     y_col = SUMMED_METRICS_MAP[summed_metric]
     return (
         f"{summed_metric} {time_range}",
         plot_trend(
-            df=fhvhv_df,
+            df=slices["fhvhv"],
             time_col=time_col,
             y_col=y_col,
-            start_date=start_date,
-            end_date=end_date,
+            cache_key=("fhvhv", y_col, time_col, start_date, end_date),
+            data_version=data_version,
         ),
         plot_trend(
-            df=fhv_df,
+            df=slices["fhv"],
             time_col=time_col,
             y_col=y_col,
-            start_date=start_date,
-            end_date=end_date,
+            cache_key=("fhv", y_col, time_col, start_date, end_date),
+            data_version=data_version,
         ),
         plot_trend(
-            df=yellow_df,
+            df=slices["yellow"],
             time_col=time_col,
             y_col=y_col,
-            start_date=start_date,
-            end_date=end_date,
+            cache_key=("yellow", y_col, time_col, start_date, end_date),
+            data_version=data_version,
         ),
         plot_trend(
-            df=green_df,
+            df=slices["green"],
             time_col=time_col,
             y_col=y_col,
-            start_date=start_date,
-            end_date=end_date,
+            cache_key=("green", y_col, time_col, start_date, end_date),
+            data_version=data_version,
         ),
     )
 
 
-@callback(
+@app.callback(
     Output("avg-metric-title", "children"),
     Output("avg-metric-fhvhv", "children"),
     Output("avg-metric-fhv", "children"),
@@ -748,21 +1292,142 @@ def update_summed_metrics(start_date, end_date, summed_metric, time_range, data)
     Input("global-data-store", "data"),
 )
 def update_avg_metrics(start_date, end_date, avg_metric, data):
-    fhvhv_df = pd.DataFrame(data["fhvhv_data"])
-    fhv_df = pd.DataFrame(data["fhv_data"])
-    yellow_df = pd.DataFrame(data["yellow_data"])
-    green_df = pd.DataFrame(data["green_data"])
+    data_version, slices = get_filtered_slices(start_date, end_date)
     x_col = AVG_METRICS_MAP[avg_metric]
     return (
         f"Distribution of the {avg_metric}",
-        plot_histogram(df=fhvhv_df, x=x_col, start_date=start_date, end_date=end_date),
-        plot_histogram(df=fhv_df, x=x_col, start_date=start_date, end_date=end_date),
-        plot_histogram(df=yellow_df, x=x_col, start_date=start_date, end_date=end_date),
-        plot_histogram(df=green_df, x=x_col, start_date=start_date, end_date=end_date),
+        plot_histogram(
+            df=slices["fhvhv"],
+            x=x_col,
+            cache_key=("fhvhv", x_col, "histogram", start_date, end_date),
+            data_version=data_version,
+        ),
+        plot_histogram(
+            df=slices["fhv"],
+            x=x_col,
+            cache_key=("fhv", x_col, "histogram", start_date, end_date),
+            data_version=data_version,
+        ),
+        plot_histogram(
+            df=slices["yellow"],
+            x=x_col,
+            cache_key=("yellow", x_col, "histogram", start_date, end_date),
+            data_version=data_version,
+        ),
+        plot_histogram(
+            df=slices["green"],
+            x=x_col,
+            cache_key=("green", x_col, "histogram", start_date, end_date),
+            data_version=data_version,
+        ),
+    )
+
+
+@app.callback(
+    Output("trip-distribution-title", "children"),
+    Output("trip-distribution-fhvhv", "children"),
+    Output("trip-distribution-fhv", "children"),
+    Output("trip-distribution-yellow", "children"),
+    Output("trip-distribution-green", "children"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+    Input("trip-distribution", "value"),
+    Input("global-data-store", "data"),
+)
+def update_trip_distribution(start_date, end_date, trip_metric, data):
+    # Merged from the per-hour sketches, so these are trip-level percentiles
+    # rather than a distribution of hourly averages
+    data_version, _ = DATA_PLANE.get(engine)
+    metric = TRIP_DISTRIBUTION_METRICS_MAP[trip_metric]
+    return (f"Distribution of the {trip_metric}",) + tuple(
+        plot_trip_distribution(
+            engine=engine,
+            service=service,
+            metric=metric,
+            start_date=start_date,
+            end_date=end_date,
+            cache_key=(service, metric, "trip_distribution", start_date, end_date),
+            data_version=data_version,
+        )
+        for service in SERVICES
     )
 
 
-@callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="time_series", function_name="update_view"),
+    Output("time-series-view", "data"),
+    Input("time-series", "relayoutData"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+    Input("time-series-service", "value"),
+    Input("time-series-metric", "value"),
+    State("time-series-view", "data"),
+)
+
+
+@app.callback(
+    Output("time-series", "figure"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+    Input("time-series-service", "value"),
+    Input("time-series-metric", "value"),
+    Input("time-series-view", "data"),
+    Input("global-data-store", "data"),
+)
+def update_time_series(start_date, end_date, service_name, metric, view, data):
+    data_version, slices = get_filtered_slices(start_date, end_date)
+    service = SERVICE_NAMES_MAP[service_name]
+    y_col = TIME_SERIES_METRICS_MAP[metric]
+    view = view or {}
+    x_range = view.get("x_range")
+    df = slices[service]
+    # A zoom re-queries just the visible hours, so it gains detail down to the
+    # raw hourly points instead of stretching the overview
+    if x_range is not None:
+        df = filter_date_range(df, *x_range)
+    n_points = time_series_points(view.get("width"))
+    return plot_time_series(
+        df=df,
+        y_col=y_col,
+        n_points=n_points,
+        ui_revision=f"{service}-{y_col}-{start_date}-{end_date}",
+        cache_key=(service, y_col, "time_series", start_date, end_date)
+        + (tuple(x_range or ()), n_points),
+        data_version=data_version,
+    )
+
+
+@app.callback(Output("zone-location", "options"), Input("global-data-store", "data"))
+def update_zone_options(data):
+    return fetch_zone_options(engine)
+
+
+@app.callback(
+    Output("zone-trips", "figure"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+    Input("zone-service", "value"),
+    Input("zone-location", "value"),
+    Input("global-data-store", "data"),
+)
+def update_zone_trips(start_date, end_date, service_name, location_id, data):
+    if location_id is None:
+        return {}
+    # Read from the zone cube alone, never from the hourly snapshot
+    data_version, _ = DATA_PLANE.get(engine)
+    service = SERVICE_NAMES_MAP[service_name]
+    return plot_zone_trips(
+        engine=engine,
+        service=service,
+        location_id=location_id,
+        start_date=start_date,
+        end_date=end_date,
+        cache_key=(service, location_id, "zone_trips", start_date, end_date),
+        data_version=data_version,
+    )
+
+
+@app.callback(
     Output("price-conts-fhvhv", "figure"),
     Output("price-conts-yellow", "figure"),
     Output("price-conts-green", "figure"),
@@ -771,101 +1436,125 @@ def update_avg_metrics(start_date, end_date, avg_metric, data):
     Input("global-data-store", "data"),
 )
 def update_price_contributors(start_date, end_date, data):
-    fhvhv_df = pd.DataFrame(data["fhvhv_data"])
-    yellow_df = pd.DataFrame(data["yellow_data"])
-    green_df = pd.DataFrame(data["green_data"])
+    data_version, slices = get_range_rows(start_date, end_date, "month")
     return (
         plot_price_contributors(
-            df=fhvhv_df,
-            start_date=start_date,
-            end_date=end_date,
+            df=slices["fhvhv"],
             cols=PRICE_CONTRIBUTORS["fhvhv"],
+            cache_key=("fhvhv", "price_contributors", None, start_date, end_date),
+            data_version=data_version,
         ),
         plot_price_contributors(
-            df=yellow_df,
-            start_date=start_date,
-            end_date=end_date,
+            df=slices["yellow"],
             cols=PRICE_CONTRIBUTORS["yellow"],
+            cache_key=("yellow", "price_contributors", None, start_date, end_date),
+            data_version=data_version,
         ),
         plot_price_contributors(
-            df=green_df,
-            start_date=start_date,
-            end_date=end_date,
+            df=slices["green"],
             cols=PRICE_CONTRIBUTORS["green"],
+            cache_key=("green", "price_contributors", None, start_date, end_date),
+            data_version=data_version,
         ),
     )
 
 
-@callback(
-    Output("fhvhv-download-csv", "data"),
-    Input("hfvhv-download-button", "n_clicks"),
-    State("date-range", "start_date"),
-    State("date-range", "end_date"),
-    State("global-data-store", "data"),
-    prevent_initial_call=True,
+@app.callback(
+    Output("fhvhv-download-link", "href"),
+    Output("fhv-download-link", "href"),
+    Output("yellow-download-link", "href"),
+    Output("green-download-link", "href"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+    Input("download-format", "value"),
 )
-def download_fhvhv_data(n_clicks, start_date, end_date, data):
-    fhvhv_df = pd.DataFrame(data["fhvhv_data"])
-    return download_data(fhvhv_df, "fhvhv", start_date, end_date)
+def update_download_links(start_date, end_date, download_format):
+    query = urlencode(
+        dict(
+            start_date=start_date,
+            end_date=end_date,
+            format=DOWNLOAD_FORMAT_MAP[download_format],
+        )
+    )
+    return tuple(f"/download/{service}?{query}" for service in SERVICES)
 
 
-@callback(
-    Output("yellow-download-csv", "data"),
-    Input("yellow-download-button", "n_clicks"),
+@app.callback(
+    Output("export-job-id", "data"),
+    Output("export-status", "children", allow_duplicate=True),
+    Input("export-button", "n_clicks"),
+    State("export-service", "value"),
     State("date-range", "start_date"),
     State("date-range", "end_date"),
-    State("global-data-store", "data"),
     prevent_initial_call=True,
 )
-def download_yellow_data(n_clicks, start_date, end_date, data):
-    yellow_df = pd.DataFrame(data["yellow_data"])
-    return download_data(yellow_df, "yellow", start_date, end_date)
+def start_export(n_clicks, service, start_date, end_date):
+    job_id = submit_export_job(
+        db_url=DB_URL,
+        service=SERVICE_NAMES_MAP[service],
+        start_date=start_date,
+        end_date=end_date,
+    )
+    if job_id is None:
+        return no_update, "Too many exports in progress, try again later"
+    return job_id, "Queued"
 
 
-@callback(
-    Output("green-download-csv", "data"),
-    Input("green-download-button", "n_clicks"),
-    State("date-range", "start_date"),
-    State("date-range", "end_date"),
-    State("global-data-store", "data"),
+@app.callback(
+    Output("export-progress", "value"),
+    Output("export-progress", "label"),
+    Output("export-status", "children"),
+    Output("export-download-link", "href"),
+    Output("export-download-link", "style"),
+    Output("export-poll-component", "disabled"),
+    Input("export-poll-component", "n_intervals"),
+    Input("export-job-id", "data"),
+    State("export-download-link", "style"),
     prevent_initial_call=True,
 )
-def download_green_data(n_clicks, start_date, end_date, data):
-    green_df = pd.DataFrame(data["green_data"])
-    return download_data(green_df, "green", start_date, end_date)
+def update_export_progress(n_intervals, job_id, link_style):
+    # The id comes back from the browser's store
+    if not is_valid_job_id(job_id):
+        return (no_update,) * 6
+    job = read_job(job_id)
+    if job is None:
+        return 0, "", "Export not found", "", {**link_style, "display": "none"}, True
+    # So a job whose worker died stops showing as running
+    job = fail_abandoned_job(job)
+    progress = job_progress(job)
+    status = f"{job['status'].capitalize()}: {job['rows_written']:,} trips written"
+    if job["status"] == "failed":
+        status = f"Failed: {job['error']}"
+    finished = job["status"] in ("done", "failed")
+    display = "block" if job["status"] == "done" else "none"
+    return (
+        progress,
+        f"{progress}%",
+        status,
+        f"/exports/{job_id}/download",
+        {**link_style, "display": display},
+        finished,
+    )
 
 
-@callback(
-    Output("fhv-download-csv", "data"),
-    Input("hfv-download-button", "n_clicks"),
-    State("date-range", "start_date"),
-    State("date-range", "end_date"),
-    State("global-data-store", "data"),
-    prevent_initial_call=True,
+app.clientside_callback(
+    ClientsideFunction(namespace="data_version", function_name="poll"),
+    Output("data-version", "data"),
+    Input("data-version-poll", "n_intervals"),
+    State("data-version", "data"),
 )
-def download_fhv_data(n_clicks, start_date, end_date, data):
-    fhv_df = pd.DataFrame(data["fhv_data"])
-    return download_data(fhv_df, "fhv", start_date, end_date)
 
 
-@callback(
-    Output("global-data-store", "data"), Input("data-refresh-component", "n_intervals")
-)
-def update_global_data(n_intervals):
-    engine = create_engine(DB_URL)
-    fhvhv_data = fetch_data(table="fhvhv_hourly_tripdata", engine=engine)
-    fhv_data = fetch_data(table="fhv_hourly_tripdata", engine=engine)
-    yellow_data = fetch_data(table="yellow_hourly_tripdata", engine=engine)
-    green_data = fetch_data(table="green_hourly_tripdata", engine=engine)
-    engine.dispose()
-    return dict(
-        fhvhv_data=fhvhv_data,
-        fhv_data=fhv_data,
-        yellow_data=yellow_data,
-        green_data=green_data,
-    )
+@app.callback(Output("global-data-store", "data"), Input("data-version", "data"))
+def update_global_data(data_version):
+    # The data itself stays on the server, the browser only learns its version,
+    # polled from /data-version in the browser
+    if data_version is None:
+        data_version, _ = DATA_PLANE.get(engine)
+    return dict(data_version=data_version)
 
 
 if __name__ == "__main__":
+    # Development server; production runs gunicorn with gunicorn.conf.py
     print("Starting app")
     app.run(host="0.0.0.0", port=8053)
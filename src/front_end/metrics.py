@@ -0,0 +1,104 @@
+import functools
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Set under gunicorn so every worker writes its samples where /metrics, served by
+# any one of them, can aggregate them (see gunicorn.conf.py)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+DASH_UPDATE_PATH_SUFFIX = "/_dash-update-component"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PAYLOAD_BUCKETS = tuple(2**exponent for exponent in range(8, 26, 2))
+
+CALLBACK_LATENCY = Histogram(
+    "dash_callback_duration_seconds",
+    "Time spent serving a Dash callback request",
+    ["callback"],
+    buckets=LATENCY_BUCKETS,
+)
+CALLBACK_REQUEST_BYTES = Histogram(
+    "dash_callback_request_bytes",
+    "Size of the Dash callback request body",
+    ["callback"],
+    buckets=PAYLOAD_BUCKETS,
+)
+CALLBACK_RESPONSE_BYTES = Histogram(
+    "dash_callback_response_bytes",
+    "Size of the Dash callback response body",
+    ["callback"],
+    buckets=PAYLOAD_BUCKETS,
+)
+DB_FETCH_SECONDS = Histogram(
+    "dash_db_fetch_duration_seconds",
+    "Time spent fetching a table from the database",
+    ["table"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "dash_cache_lookups_total",
+    "Cache lookups by cache and result",
+    ["cache", "result"],
+)
+FIGURE_BUILD_SECONDS = Histogram(
+    "dash_figure_build_duration_seconds",
+    "Time spent building a figure on a cache miss",
+    ["figure"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def callback_name(payload, callback_map):
+    # Named after the first output, e.g. "summed-metric-title.children", which
+    # keeps the label set small and stable across multi-output callbacks. The
+    # body comes from the client: outputs no callback is registered for share
+    # one label, so they can't add label series.
+    output = payload.get("output") if isinstance(payload, dict) else None
+    if not isinstance(output, str) or output not in callback_map:
+        return "unknown"
+    return output.strip(".").split("...")[0]
+
+
+def before_request():
+    if request.path.endswith(DASH_UPDATE_PATH_SUFFIX):
+        g.callback_started = time.perf_counter()
+
+
+def after_request(callback_map, response):
+    started = g.pop("callback_started", None)
+    if started is None:
+        return response
+    callback = callback_name(request.get_json(silent=True), callback_map)
+    CALLBACK_LATENCY.labels(callback).observe(time.perf_counter() - started)
+    CALLBACK_REQUEST_BYTES.labels(callback).observe(request.content_length or 0)
+    if not response.direct_passthrough:
+        CALLBACK_RESPONSE_BYTES.labels(callback).observe(
+            response.calculate_content_length() or 0
+        )
+    return response
+
+
+def metrics():
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument_server(server, callback_map):
+    # callback_map is the Dash app's, filled in as its callbacks are registered
+    server.before_request(before_request)
+    server.after_request(functools.partial(after_request, callback_map))
+    server.add_url_rule("/metrics", "metrics", metrics)
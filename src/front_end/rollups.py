@@ -0,0 +1,114 @@
+import pandas as pd
+from metrics import DB_FETCH_SECONDS
+from snapshots import snapshot_query
+from sqlalchemy import inspect
+
+# Rollup views maintained by the aggregation flow, per grain: table suffix and
+# bucket column. The hourly tables are the finest grain.
+ROLLUP_GRAINS = {
+    "day": ("daily", "pickup_day"),
+    "month": ("monthly", "pickup_month"),
+}
+BUCKET_COLS = {"hour": "pickup_hour", "day": "pickup_day", "month": "pickup_month"}
+
+# The coarsest grain whose buckets each fall inside a single group, so grouping
+# its rows gives the same sums as grouping the hourly rows
+GROUPING_GRAINS = {
+    "hour_of_day": "hour",
+    "day_of_week": "day",
+    "day_of_month": "day",
+    "month": "month",
+}
+
+
+def existing_tables(engine):
+    inspector = inspect(engine)
+    names = set(inspector.get_table_names()) | set(inspector.get_view_names())
+    if engine.dialect.name == "postgresql":
+        names |= set(inspector.get_materialized_view_names())
+    return names
+
+
+def rollup_hourly(df, grain):
+    # Same sums as the flow's rollup views, for databases where they don't
+    # exist yet
+    pickup_hours = pd.to_datetime(df["pickup_hour"])
+    if grain == "day":
+        buckets = pickup_hours.dt.floor("D")
+    else:
+        buckets = pickup_hours.dt.to_period("M").dt.to_timestamp()
+    partials = {}
+    for col in df.columns:
+        if col == "num_trips" or col.startswith("total_"):
+            partials[col] = df[col]
+    bucket_col = BUCKET_COLS[grain]
+    rollup = pd.DataFrame(partials).groupby(buckets.rename(bucket_col)).sum()
+    rollup = rollup.reset_index()
+    rollup.insert(0, "month", rollup[bucket_col].dt.month.astype(float))
+    rollup.insert(0, "day_of_month", rollup[bucket_col].dt.day.astype(float))
+    rollup.insert(
+        0, "day_of_week", ((rollup[bucket_col].dt.dayofweek + 1) % 7).astype(float)
+    )
+    return rollup
+
+
+def fetch_rollups(engine, datasets):
+    tables = existing_tables(engine)
+    rollups = {}
+    for grain, (suffix, _) in ROLLUP_GRAINS.items():
+        rollups[grain] = {}
+        for service, df in datasets.items():
+            table = f"{service}_{suffix}_tripdata"
+            if table not in tables:
+                rollups[grain][service] = rollup_hourly(df, grain)
+                continue
+            with DB_FETCH_SECONDS.labels(table).time():
+                rollups[grain][service] = pd.read_sql(
+                    snapshot_query(grain, table), engine
+                )
+    return rollups
+
+
+def range_segments(start_date, end_date, coarsest):
+    # Splits start_date <= pickup_hour <= end_date into half-open spans of whole
+    # months, whole days and leftover hours, using no grain coarser than asked
+    start = pd.Timestamp(start_date).ceil("h")
+    stop = pd.Timestamp(end_date).floor("h") + pd.Timedelta(hours=1)
+    if start >= stop:
+        return []
+    day_start, day_stop = start.ceil("D"), stop.floor("D")
+    if coarsest == "hour" or day_start >= day_stop:
+        return [("hour", start, stop)]
+    segments = [("hour", start, day_start)]
+    month_start = (day_start - pd.Timedelta(days=1)) + pd.offsets.MonthBegin(1)
+    month_stop = day_stop.to_period("M").to_timestamp()
+    if coarsest == "month" and month_start < month_stop:
+        segments += [
+            ("day", day_start, month_start),
+            ("month", month_start, month_stop),
+            ("day", month_stop, day_stop),
+        ]
+    else:
+        segments.append(("day", day_start, day_stop))
+    segments.append(("hour", day_stop, stop))
+    return [(grain, lo, hi) for grain, lo, hi in segments if lo < hi]
+
+
+def slice_buckets(df, bucket_col, lo, hi):
+    buckets = df[bucket_col]
+    if not pd.api.types.is_datetime64_any_dtype(buckets):
+        # ISO strings, as SQLite returns them, sort like the timestamps
+        lo, hi = lo.isoformat(sep=" "), hi.isoformat(sep=" ")
+    return df.iloc[buckets.searchsorted(lo) : buckets.searchsorted(hi)]
+
+
+def range_rows(pyramid, service, start_date, end_date, coarsest):
+    # The fewest rows, across grains, that cover the date range exactly; their
+    # sums and counts equal those of the hourly rows they stand for
+    frames = [
+        slice_buckets(pyramid[grain][service], BUCKET_COLS[grain], lo, hi)
+        for grain, lo, hi in range_segments(start_date, end_date, coarsest)
+    ]
+    if not frames:
+        return pyramid["hour"][service].iloc[:0]
+    return pd.concat(frames, ignore_index=True, sort=False)
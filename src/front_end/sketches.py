@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+from metrics import DB_FETCH_SECONDS
+from rollups import existing_tables
+from sqlalchemy import text
+from zones import ZONE_SERVICE_IDS
+
+# The aggregation flow's per-hour histogram sketches of trip-level values and
+# their bucket definitions. Bucket 0 counts the trips below the range and
+# num_buckets + 1 those above it.
+SKETCH_TABLE = "hourly_trip_histograms"
+SKETCH_METRICS_TABLE = "trip_histogram_metrics"
+SKETCH_QUANTILES = [0.5, 0.95, 0.99]
+
+
+def fetch_sketch_metrics(engine):
+    tables = existing_tables(engine)
+    if SKETCH_TABLE not in tables or SKETCH_METRICS_TABLE not in tables:
+        return {}
+    with DB_FETCH_SECONDS.labels(SKETCH_METRICS_TABLE).time():
+        df = pd.read_sql(f"SELECT * FROM {SKETCH_METRICS_TABLE}", engine)
+    return {row.metric: row for row in df.itertuples(index=False)}
+
+
+def merge_sketches(engine, service, sketch_metric, start_date, end_date):
+    # Sums the sketches of every hour in the range, bucket by bucket, in the
+    # database; returns the bucket edges and the counts including both outer
+    # buckets
+    query = f"""
+    SELECT bucket, SUM(num_trips) AS num_trips
+    FROM {SKETCH_TABLE}
+    WHERE service_id = :service_id
+        AND metric_id = :metric_id
+        AND pickup_hour >= :start_date
+        AND pickup_hour <= :end_date
+    GROUP BY bucket
+    """
+    params = {
+        "service_id": ZONE_SERVICE_IDS[service],
+        "metric_id": int(sketch_metric.metric_id),
+        "start_date": start_date,
+        "end_date": end_date,
+    }
+    with DB_FETCH_SECONDS.labels(SKETCH_TABLE).time():
+        df = pd.read_sql(text(query), engine, params=params)
+    num_buckets = int(sketch_metric.num_buckets)
+    counts = np.zeros(num_buckets + 2, dtype=np.int64)
+    counts[df["bucket"].to_numpy(dtype=np.int64)] = df["num_trips"].to_numpy()
+    edges = np.linspace(sketch_metric.low, sketch_metric.high, num_buckets + 1)
+    return edges, counts
+
+
+def sketch_quantile(edges, counts, q):
+    # Interpolated within the bucket holding the quantile, as if its trips were
+    # spread evenly; clamped to the range when it falls in an outer bucket
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    cumulative = np.cumsum(counts)
+    bucket = int(np.searchsorted(cumulative, q * total, side="left"))
+    if bucket == 0:
+        return edges[0]
+    if bucket == len(counts) - 1:
+        return edges[-1]
+    below = cumulative[bucket - 1]
+    fraction = (q * total - below) / counts[bucket]
+    return edges[bucket - 1] + fraction * (edges[bucket] - edges[bucket - 1])
@@ -1,72 +1,336 @@
+import base64
+import os
+
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 from dash import dcc
+from figure_cache import FIGURE_CACHE, FILTERED_SLICE_CACHE
+from metrics import DB_FETCH_SECONDS, FIGURE_BUILD_SECONDS
+from sketches import (
+    SKETCH_QUANTILES,
+    fetch_sketch_metrics,
+    merge_sketches,
+    sketch_quantile,
+)
+from snapshots import snapshot_query
+from zones import fetch_zone_trips
 
-
-def generate_query(table):
-    return f"""
-    SELECT
-        DATE_PART('hour', pickup_hour) AS hour_of_day,
-        DATE_PART('dow', pickup_hour) AS day_of_week,
-        DATE_PART('day', pickup_hour) AS day_of_month,
-        DATE_PART('month', pickup_hour) AS month,
-        *
-    FROM {table}
-    ORDER BY pickup_hour
-    """
+HISTOGRAM_BINS = os.getenv("HISTOGRAM_BINS", "auto")
+HISTOGRAM_MAX_BINS = int(os.getenv("HISTOGRAM_MAX_BINS", 60))
+# Points drawn per pixel of plot width, and a ceiling whatever the client claims
+TIME_SERIES_POINTS_PER_PIXEL = float(os.getenv("TIME_SERIES_POINTS_PER_PIXEL", 1))
+TIME_SERIES_MAX_POINTS = int(os.getenv("TIME_SERIES_MAX_POINTS", 4000))
 
 
 def fetch_data(table, engine):
-    df = pd.read_sql(generate_query(table), engine)
-    return df.to_dict("records")
+    with DB_FETCH_SECONDS.labels(table).time():
+        return pd.read_sql(snapshot_query("hour", table), engine)
+
+
+def encode_array(values, dtype):
+    return base64.b64encode(
+        np.ascontiguousarray(values, dtype=dtype).tobytes()
+    ).decode()
+
+
+def build_kpi_payload(pyramid, kpi_cols):
+    # Compact columnar per-day sums for the clientside KPI callback, read from
+    # the daily rollups. The cards filter on start_date <= pickup_hour <=
+    # end_date, which also takes in the midnight hour of the end date, so that
+    # hour is shipped on its own as well, from the hourly rows.
+    # Trip counts fit Float32 exactly; amounts stay Float64 to keep the cents.
+    payload = {}
+    for service, daily in pyramid["day"].items():
+        cols = [col for col in kpi_cols if col in daily]
+        days = pd.to_datetime(daily["pickup_day"]).values.astype("datetime64[D]")
+        hourly = pyramid["hour"][service]
+        pickup_hours = pd.to_datetime(hourly["pickup_hour"]).values
+        is_midnight = pickup_hours == pickup_hours.astype("datetime64[D]")
+        midnight = (
+            hourly.loc[is_midnight, cols]
+            .set_axis(pickup_hours[is_midnight].astype("datetime64[D]"))
+            .reindex(days, fill_value=0)
+        )
+        epoch_days = days.astype(np.int64)
+        payload[service] = dict(days=encode_array(epoch_days, "<i4"))
+        for col in cols:
+            dtype = "<f4" if col == "num_trips" else "<f8"
+            payload[service][col] = encode_array(daily[col].fillna(0), dtype)
+            payload[service][f"midnight_{col}"] = encode_array(
+                midnight[col].fillna(0), dtype
+            )
+    return payload
+
+
+def filter_date_range(df, start_date, end_date):
+    # start_date <= pickup_hour <= end_date as two binary searches, since the
+    # hourly tables are fetched ordered by pickup_hour. The result is a view.
+    pickup_hours = df["pickup_hour"]
+    if pd.api.types.is_datetime64_any_dtype(pickup_hours):
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    start = pickup_hours.searchsorted(start_date, side="left")
+    end = pickup_hours.searchsorted(end_date, side="right")
+    return df.iloc[start:end]
+
+
+def timed_build(build_figure):
+    # Labelled by the plot function the build belongs to, e.g. "plot_trend"
+    figure = build_figure.__qualname__.split(".")[0]
 
+    def build():
+        with FIGURE_BUILD_SECONDS.labels(figure).time():
+            return build_figure()
 
-def plot_trend(df, time_col, y_col, start_date, end_date, agg="sum"):
+    return build
+
+
+def cached_figure(cache_key, data_version, build_figure):
+    if cache_key is None:
+        return timed_build(build_figure)()
+    return FIGURE_CACHE.get_or_build(cache_key, data_version, timed_build(build_figure))
+
+
+def plot_trend(df, time_col, y_col, agg="sum", cache_key=None, data_version=None):
     if not time_col in df or not y_col in df:
         return "DATA NOT AVAILABLE"
-    grouped = (
-        df.query("@start_date<=pickup_hour<=@end_date")
-        .groupby(time_col)
-        .agg({y_col: agg})
-        .reset_index()
-    )
-    fig = px.bar(grouped, x=time_col, y=y_col, text=y_col)
-    fig.update_traces(textposition="outside")
+
+    def build_figure():
+        grouped = df.groupby(time_col).agg({y_col: agg}).reset_index()
+        fig = px.bar(grouped, x=time_col, y=y_col, text=y_col)
+        fig.update_traces(textposition="outside")
+        return fig.to_plotly_json()
+
+    fig = cached_figure(cache_key, data_version, build_figure)
     return dcc.Graph(figure=fig, config={"displayModeBar": False})
 
 
-def plot_price_contributors(df, cols, start_date, end_date):
-    summed_df = (
-        df.query("@start_date<=pickup_hour<=@end_date")[cols]
-        .sum(axis=0)
-        .to_frame()
-        .reset_index()
-        .rename(columns={"index": "expense", 0: "amount"})
+def plot_price_contributors(df, cols, cache_key=None, data_version=None):
+    def build_figure():
+        summed_df = (
+            df[cols]
+            .sum(axis=0)
+            .to_frame()
+            .reset_index()
+            .rename(columns={"index": "expense", 0: "amount"})
+        )
+        summed_df["expense"] = summed_df["expense"].apply(
+            lambda x: x.replace("total_", "")
+        )
+        fig = px.bar(summed_df, x="expense", y="amount", text="amount")
+        return fig.to_plotly_json()
+
+    return cached_figure(cache_key, data_version, build_figure)
+
+
+def sorted_values(df, x, cache_key=None, data_version=None):
+    # Sorted once per (slice, metric, version); quantiles and bin counts are then
+    # binary searches on it
+    def build():
+        values = df[x].to_numpy(dtype=float)
+        return np.sort(values[~np.isnan(values)])
+
+    if cache_key is None:
+        return build()
+    return FILTERED_SLICE_CACHE.get_or_build(
+        ("sorted_values",) + tuple(cache_key), data_version, build
     )
-    summed_df["expense"] = summed_df["expense"].apply(lambda x: x.replace("total_", ""))
-    fig = px.bar(summed_df, x="expense", y="amount", text="amount")
-    return fig
 
 
-def plot_histogram(df, x, start_date, end_date):
+def quantile_from_sorted(values, q):
+    # Same linear interpolation as numpy/pandas quantile
+    position = q * (len(values) - 1)
+    lower = int(np.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def histogram_bins(values):
+    if HISTOGRAM_BINS != "auto":
+        return int(HISTOGRAM_BINS)
+    # Freedman-Diaconis, capped so the figure stays small for wide ranges
+    fd_bins = len(np.histogram_bin_edges(values, bins="fd")) - 1
+    return max(1, min(fd_bins, HISTOGRAM_MAX_BINS))
+
+
+def plot_histogram(df, x, cache_key=None, data_version=None, quantile=0.99):
     if x not in df:
         return "DATA NOT AVAILABLE"
-    df_time_filtered = df.query("@start_date<=pickup_hour<=@end_date")
-    variable_95_percentile = df_time_filtered[x].quantile(0.99)
-    df_percentile_filtered = df_time_filtered[
-        df_time_filtered[x] <= variable_95_percentile
-    ]
-    fig = px.histogram(df_percentile_filtered[x])
-    fig.update_layout(bargap=0.05, showlegend=False)
-    fig.update_traces(texttemplate="%{y}", textposition="outside")
+
+    def build_figure():
+        values = sorted_values(df, x, cache_key, data_version)
+        if len(values) == 0:
+            return go.Figure().to_plotly_json()
+        cutoff = quantile_from_sorted(values, quantile)
+        values = values[: np.searchsorted(values, cutoff, side="right")]
+        edges = np.histogram_bin_edges(values, bins=histogram_bins(values))
+        # Values are sorted, so bin counts are differences of insertion points;
+        # the last bin includes its right edge like np.histogram
+        positions = np.searchsorted(values, edges, side="left")
+        positions[-1] = len(values)
+        counts = np.diff(positions)
+        fig = go.Figure(
+            go.Bar(
+                x=(edges[:-1] + edges[1:]) / 2,
+                y=counts,
+                width=np.diff(edges),
+                text=counts,
+                textposition="outside",
+            )
+        )
+        fig.update_layout(
+            bargap=0.05, showlegend=False, xaxis_title=x, yaxis_title="count"
+        )
+        return fig.to_plotly_json()
+
+    fig = cached_figure(cache_key, data_version, build_figure)
     return dcc.Graph(figure=fig, config={"displayModeBar": False})
 
 
-def download_data(df, df_name, start_date, end_date):
-    return dcc.send_data_frame(
-        df.query("@start_date<=pickup_hour<=@end_date").to_csv,
-        filename=f"{df_name}_from_{start_date}_to_{end_date}.csv",
-    )
+def lttb(x, y, n_out):
+    # Largest-triangle-three-buckets: keeps the first and last points and, from
+    # each bucket in between, the point forming the largest triangle with the
+    # point kept before it and the average of the next bucket
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    bucket_sizes = np.diff(edges)
+    next_avg_x = np.append(np.add.reduceat(x[1 : n - 1], edges[:-1] - 1), x[-1])
+    next_avg_y = np.append(np.add.reduceat(y[1 : n - 1], edges[:-1] - 1), y[-1])
+    next_avg_x[:-1] /= bucket_sizes
+    next_avg_y[:-1] /= bucket_sizes
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        avg_x, avg_y = next_avg_x[bucket + 1], next_avg_y[bucket + 1]
+        # Twice the triangle area; the constant factor doesn't change the argmax
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def time_series_points(width):
+    if not width:
+        return TIME_SERIES_MAX_POINTS // 2
+    # Rounded so nearby widths share a cached figure
+    points = int(round(width * TIME_SERIES_POINTS_PER_PIXEL, -2))
+    return max(100, min(points, TIME_SERIES_MAX_POINTS))
+
+
+def plot_time_series(
+    df, y_col, n_points, ui_revision=None, cache_key=None, data_version=None
+):
+    if y_col not in df:
+        fig = go.Figure()
+        fig.add_annotation(text="DATA NOT AVAILABLE", showarrow=False)
+        return fig.to_plotly_json()
+
+    def build_figure():
+        y = df[y_col].to_numpy(dtype=float)
+        pickup_hours = pd.to_datetime(df["pickup_hour"]).to_numpy()
+        has_value = ~np.isnan(y)
+        y, pickup_hours = y[has_value], pickup_hours[has_value]
+        kept = lttb(pickup_hours.astype(np.int64).astype(float), y, n_points)
+        fig = go.Figure(
+            go.Scattergl(x=pickup_hours[kept], y=y[kept], mode="lines", name=y_col)
+        )
+        fig.update_layout(
+            showlegend=False,
+            xaxis_title="pickup_hour",
+            yaxis_title=y_col,
+            # Keeps the user's zoom when a finer figure replaces this one
+            uirevision=ui_revision,
+            margin=dict(l=40, r=10, t=30, b=40),
+        )
+        return fig.to_plotly_json()
+
+    return cached_figure(cache_key, data_version, build_figure)
+
+
+def plot_zone_trips(
+    engine,
+    service,
+    location_id,
+    start_date,
+    end_date,
+    cache_key=None,
+    data_version=None,
+):
+    def build_figure():
+        df = fetch_zone_trips(engine, service, location_id, start_date, end_date)
+        fig = go.Figure()
+        if df.empty:
+            fig.add_annotation(text="DATA NOT AVAILABLE", showarrow=False)
+            return fig.to_plotly_json()
+        for borough, borough_df in df.groupby("dropoff_borough"):
+            fig.add_trace(
+                go.Bar(
+                    x=borough_df["hour_of_day"], y=borough_df["num_trips"], name=borough
+                )
+            )
+        fig.update_layout(
+            barmode="stack",
+            xaxis_title="hour_of_day",
+            yaxis_title="num_trips",
+            legend_title="dropoff_borough",
+            margin=dict(l=40, r=10, t=30, b=40),
+        )
+        return fig.to_plotly_json()
+
+    return cached_figure(cache_key, data_version, build_figure)
+
+
+def plot_trip_distribution(
+    engine, service, metric, start_date, end_date, cache_key=None, data_version=None
+):
+    def build_figure():
+        sketch_metric = fetch_sketch_metrics(engine).get(metric)
+        fig = go.Figure()
+        if sketch_metric is None:
+            fig.add_annotation(text="DATA NOT AVAILABLE", showarrow=False)
+            return fig.to_plotly_json()
+        edges, counts = merge_sketches(
+            engine, service, sketch_metric, start_date, end_date
+        )
+        if counts.sum() == 0:
+            fig.add_annotation(text="DATA NOT AVAILABLE", showarrow=False)
+            return fig.to_plotly_json()
+        fig.add_trace(
+            go.Bar(
+                x=(edges[:-1] + edges[1:]) / 2,
+                y=counts[1:-1],
+                width=np.diff(edges),
+            )
+        )
+        for q in SKETCH_QUANTILES:
+            value = sketch_quantile(edges, counts, q)
+            # Past the last bucket only a lower bound is known
+            label = f"p{round(q * 100)}" + (" >" if value >= edges[-1] else " ")
+            fig.add_vline(
+                x=value,
+                line_dash="dash",
+                annotation_text=f"{label}{value:.1f}",
+            )
+        fig.update_layout(
+            bargap=0.05,
+            showlegend=False,
+            xaxis_title=metric,
+            yaxis_title="count",
+            # The outer buckets aren't drawn, so say how many trips they hold
+            title=f"{counts[0]} trips below {edges[0]:g}, {counts[-1]} above {edges[-1]:g}",
+        )
+        return fig.to_plotly_json()
+
+    fig = cached_figure(cache_key, data_version, build_figure)
+    return dcc.Graph(figure=fig, config={"displayModeBar": False})
 
 
 LOGIN_FORM = """
@@ -0,0 +1,70 @@
+import pandas as pd
+from metrics import DB_FETCH_SECONDS
+from rollups import existing_tables
+from sqlalchemy import text
+
+# The aggregation flow's service x pickup zone x drop-off borough x hour cube,
+# keyed by the flow's small integer ids
+ZONE_CUBE_TABLE = "zone_hourly_tripdata"
+ZONE_SERVICE_IDS = {"fhvhv": 1, "fhv": 2, "yellow": 3, "green": 4}
+UNKNOWN_BOROUGH = "Unknown"
+
+
+def fetch_zone_options(engine):
+    tables = existing_tables(engine)
+    if ZONE_CUBE_TABLE not in tables:
+        return []
+    if "taxi_zone_lookup" in tables and "taxi_boroughs" in tables:
+        query = """
+        SELECT zones.location_id, boroughs.borough || ' - ' || zones.zone AS label
+        FROM taxi_zone_lookup zones
+        JOIN taxi_boroughs boroughs ON boroughs.borough_id = zones.borough_id
+        ORDER BY label
+        """
+    else:
+        # Without TLC's lookup the cube only knows the zone ids
+        query = f"""
+        SELECT DISTINCT pu_location_id AS location_id,
+            'Zone ' || pu_location_id AS label
+        FROM {ZONE_CUBE_TABLE}
+        ORDER BY location_id
+        """
+    with DB_FETCH_SECONDS.labels("taxi_zone_lookup").time():
+        df = pd.read_sql(query, engine)
+    return [
+        {"label": row.label, "value": int(row.location_id)}
+        for row in df.itertuples(index=False)
+    ]
+
+
+def fetch_zone_trips(engine, service, location_id, start_date, end_date):
+    # One point lookup on the cube's (service_id, pu_location_id, pickup_hour)
+    # index, aggregated to hour of day and drop-off borough in the database
+    tables = existing_tables(engine)
+    if "taxi_boroughs" in tables:
+        borough = f"COALESCE(boroughs.borough, '{UNKNOWN_BOROUGH}')"
+        join = "LEFT JOIN taxi_boroughs boroughs ON boroughs.borough_id = trips.do_borough_id"
+    else:
+        borough, join = f"'{UNKNOWN_BOROUGH}'", ""
+    query = f"""
+    SELECT
+        DATE_PART('hour', trips.pickup_hour) AS hour_of_day,
+        {borough} AS dropoff_borough,
+        SUM(trips.num_trips) AS num_trips
+    FROM {ZONE_CUBE_TABLE} trips
+    {join}
+    WHERE trips.service_id = :service_id
+        AND trips.pu_location_id = :location_id
+        AND trips.pickup_hour >= :start_date
+        AND trips.pickup_hour <= :end_date
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    """
+    params = {
+        "service_id": ZONE_SERVICE_IDS[service],
+        "location_id": location_id,
+        "start_date": start_date,
+        "end_date": end_date,
+    }
+    with DB_FETCH_SECONDS.labels(ZONE_CUBE_TABLE).time():
+        return pd.read_sql(text(query), engine, params=params)
@@ -0,0 +1,81 @@
+import math
+import os
+
+import duckdb
+
+# Closed months of the trip tables move to zstd Parquet under ARCHIVE_PATH,
+# hive-partitioned by pickup_month, keeping the current month and the
+# ARCHIVE_KEEP_MONTHS before it in Postgres
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "/archive")
+ARCHIVE_KEEP_MONTHS = int(os.getenv("ARCHIVE_KEEP_MONTHS", 2))
+
+NUMERIC_TYPES = {"smallint", "integer", "bigint", "real", "double precision", "numeric"}
+TEXT_TYPES = {"text", "character varying", "character"}
+
+
+def month_path(table_name, month):
+    return os.path.join(ARCHIVE_PATH, table_name, f"pickup_month={month:%Y-%m}")
+
+
+def staging_path(table_name, month):
+    # Dataset readers skip directories starting with an underscore
+    return os.path.join(
+        ARCHIVE_PATH, table_name, "_staging", f"pickup_month={month:%Y-%m}"
+    )
+
+
+def checksum_expressions(columns):
+    # The row count, and per column its non-null count and a sum of its values,
+    # epochs or lengths; the same SQL runs on Postgres and on the Parquet files
+    expressions = {"rows": "COUNT(*)"}
+    for column_name, data_type in columns:
+        column = f'"{column_name}"'
+        expressions[f"{column_name}.count"] = f"COUNT({column})"
+        if data_type in NUMERIC_TYPES:
+            expressions[f"{column_name}.sum"] = f"SUM({column})::float8"
+        elif data_type.startswith("timestamp") or data_type == "date":
+            expressions[f"{column_name}.sum"] = (
+                f"SUM(EXTRACT(EPOCH FROM {column}))::float8"
+            )
+        elif data_type in TEXT_TYPES:
+            expressions[f"{column_name}.sum"] = f"SUM(LENGTH({column}))::float8"
+        elif data_type == "boolean":
+            expressions[f"{column_name}.sum"] = f"SUM({column}::int)::float8"
+    return expressions
+
+
+def checksums_query(expressions, relation):
+    return f"SELECT {', '.join(expressions.values())} FROM {relation}"
+
+
+def postgres_checksums(cursor, table_name, month, month_end, expressions):
+    cursor.execute(
+        checksums_query(expressions, table_name)
+        + " WHERE pickup_datetime >= %s AND pickup_datetime < %s",
+        (month, month_end),
+    )
+    return dict(zip(expressions, cursor.fetchone()))
+
+
+def parquet_checksums(path, expressions):
+    con = duckdb.connect()
+    relation = f"read_parquet('{os.path.join(path, '*.parquet')}')"
+    row = con.execute(checksums_query(expressions, relation)).fetchone()
+    con.close()
+    return dict(zip(expressions, row))
+
+
+def checksum_mismatches(expected, written):
+    # Counts must be equal; float sums only up to the order they were added in
+    return [
+        name
+        for name, value in expected.items()
+        if not (
+            value == written[name]
+            or (
+                value is not None
+                and written[name] is not None
+                and math.isclose(value, written[name], rel_tol=1e-9, abs_tol=1e-6)
+            )
+        )
+    ]
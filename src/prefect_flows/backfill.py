@@ -0,0 +1,18 @@
+import argparse
+
+from main import BACKFILL_PARALLELISM, SERVICE_IDS, backfill_history
+
+# Loads months of history outside the hourly schedule, e.g.
+#   python backfill.py --services yellow green --start-month 2023-01 --end-month 2023-12
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk-load month files of trips, then refresh the aggregates"
+    )
+    parser.add_argument(
+        "--services", nargs="+", choices=list(SERVICE_IDS), default=list(SERVICE_IDS)
+    )
+    parser.add_argument("--start-month", required=True, help="YYYY-MM")
+    parser.add_argument("--end-month", required=True, help="YYYY-MM")
+    parser.add_argument("--parallelism", type=int, default=BACKFILL_PARALLELISM)
+    args = parser.parse_args()
+    backfill_history(args.services, args.start_month, args.end_month, args.parallelism)
@@ -0,0 +1,85 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+
+# Ingestion, refresh and archival runs take a session advisory lock per trip
+# table they write or read, so the same table is never loaded and aggregated
+# at once while different tables still run in parallel. Locks are two-key:
+# this namespace and hashtext(table_name).
+LOCK_NAMESPACE = 2024
+# Give up on a lock held for longer than this (Postgres interval syntax)
+LOCK_TIMEOUT = os.getenv("LOCK_TIMEOUT", "2h")
+RUNS_TABLE = "pipeline_runs"
+
+
+def create_runs_table(cursor):
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {RUNS_TABLE} (
+            run_id BIGSERIAL PRIMARY KEY,
+            process TEXT NOT NULL,
+            run_name TEXT NOT NULL,
+            table_names TEXT[] NOT NULL,
+            status TEXT NOT NULL,
+            requested_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            acquired_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            lock_wait_seconds DOUBLE PRECISION
+        )
+        """
+    )
+
+
+def tables_read_by(query, table_names):
+    # fhv_tripdata doesn't match inside fhvhv_tripdata or fhv_hourly_tripdata
+    return [name for name in table_names if re.search(rf"\b{name}\b", query)]
+
+
+@contextmanager
+def table_locks(conn, process, run_name, table_names):
+    # Holds the locks on a connection of its own, in autocommit so the run row
+    # shows a waiting run to others. Locks are taken in one order to avoid
+    # deadlocks, and are released on exit or when the connection drops.
+    table_names = sorted(set(table_names))
+    conn.autocommit = True
+    cursor = conn.cursor()
+    create_runs_table(cursor)
+    cursor.execute(
+        f"""
+        INSERT INTO {RUNS_TABLE} (process, run_name, table_names, status)
+        VALUES (%s, %s, %s, 'waiting')
+        RETURNING run_id
+        """,
+        (process, run_name, table_names),
+    )
+    run_id = cursor.fetchone()[0]
+    status = "failed"
+    try:
+        cursor.execute("SELECT set_config('lock_timeout', %s, false)", (LOCK_TIMEOUT,))
+        start = time.perf_counter()
+        for table_name in table_names:
+            cursor.execute(
+                "SELECT pg_advisory_lock(%s, hashtext(%s))",
+                (LOCK_NAMESPACE, table_name),
+            )
+        lock_wait = time.perf_counter() - start
+        cursor.execute(
+            f"""
+            UPDATE {RUNS_TABLE}
+            SET status = 'running', acquired_at = NOW(), lock_wait_seconds = %s
+            WHERE run_id = %s
+            """,
+            (lock_wait, run_id),
+        )
+        if lock_wait >= 1:
+            print(f"Waited {lock_wait:.1f} s for the locks on {', '.join(table_names)}")
+        yield
+        status = "succeeded"
+    finally:
+        cursor.execute(
+            f"UPDATE {RUNS_TABLE} SET status = %s, finished_at = NOW() WHERE run_id = %s",
+            (status, run_id),
+        )
+        cursor.execute("SELECT pg_advisory_unlock_all()")
+        cursor.close()
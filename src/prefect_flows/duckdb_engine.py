@@ -0,0 +1,196 @@
+import io
+import os
+
+import duckdb
+import pyarrow.csv as pa_csv
+
+DUCKDB_THREADS = os.getenv("DUCKDB_THREADS")
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT")
+# Rows DuckDB hands over at a time when copying into Postgres, and the bytes
+# copy_expert sends per message
+COPY_BATCH_ROWS = int(os.getenv("COPY_BATCH_ROWS", 100_000))
+COPY_READ_BYTES = int(os.getenv("COPY_READ_BYTES", 1024 * 1024))
+
+# Postgres column types of the DuckDB results copied into it
+POSTGRES_TYPES = {
+    "SMALLINT": "SMALLINT",
+    "INTEGER": "INTEGER",
+    "BIGINT": "BIGINT",
+    "HUGEINT": "NUMERIC",
+    "FLOAT": "REAL",
+    "DOUBLE": "DOUBLE PRECISION",
+    "DATE": "DATE",
+    "TIMESTAMP": "TIMESTAMP",
+    "TIMESTAMP_NS": "TIMESTAMP",
+    "TIMESTAMP WITH TIME ZONE": "TIMESTAMPTZ",
+    "VARCHAR": "TEXT",
+    "BOOLEAN": "BOOLEAN",
+}
+
+
+def connect(threads=None):
+    con = duckdb.connect()
+    threads = threads or DUCKDB_THREADS
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    if DUCKDB_MEMORY_LIMIT:
+        con.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    # The views' SQL is written for Postgres, where e.g. trip_time / 60 on a
+    # bigint drops the remainder
+    con.execute("SET integer_division = true")
+    con.execute(
+        """
+        CREATE MACRO width_bucket(operand, low, high, count) AS
+        CASE
+            WHEN operand IS NULL THEN NULL
+            WHEN operand < low THEN 0
+            WHEN operand >= high THEN count + 1
+            ELSE CAST(FLOOR((operand - low) / (high - low) * count) AS INTEGER) + 1
+        END
+        """
+    )
+    return con
+
+
+def sql_string(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def register_trip_table(con, table_name, files):
+    # A view over the table's monthly files holding the rows the Spark ingestion
+    # would load: files is (path, start_time, end_time), with the times set for
+    # the month only loaded between them. Parquet scans through the view read
+    # only the columns a query uses.
+    paths = [path for path, _, _ in files]
+    source = (
+        f"read_parquet([{', '.join(sql_string(path) for path in paths)}],"
+        " union_by_name = true, filename = true)"
+    )
+    columns = [
+        row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()
+    ]
+    pickup_col = [col for col in columns if "pickup_datetime" in col.lower()][0]
+    dropoff_col = [col for col in columns if "dropoff_datetime" in col.lower()][0]
+    renames = ", ".join(
+        f'"{col}" AS {name}'
+        for col, name in [
+            (pickup_col, "pickup_datetime"),
+            (dropoff_col, "dropoff_datetime"),
+        ]
+        if col != name
+    )
+    whole_files = [
+        sql_string(path) for path, start_time, _ in files if start_time is None
+    ]
+    conditions = [f"filename IN ({', '.join(whole_files)})"] if whole_files else []
+    conditions += [
+        f"(filename = {sql_string(path)}"
+        f' AND "{pickup_col}" > {sql_string(start_time)}'
+        f' AND "{pickup_col}" < {sql_string(end_time)})'
+        for path, start_time, end_time in files
+        if start_time is not None
+    ]
+    con.execute(
+        f"""
+        CREATE OR REPLACE VIEW {table_name} AS
+        SELECT * EXCLUDE (filename) {f"RENAME ({renames})" if renames else ""}
+        FROM {source}
+        WHERE {" OR ".join(conditions)}
+        """
+    )
+
+
+def load_zone_lookup(con, rows):
+    # The zone to borough ids the zone cube joins on, as loaded in Postgres
+    con.execute(
+        "CREATE OR REPLACE TABLE taxi_zone_lookup (location_id SMALLINT, borough_id SMALLINT)"
+    )
+    if rows:
+        con.executemany("INSERT INTO taxi_zone_lookup VALUES (?, ?)", rows)
+
+
+def build_table(con, name, mat_view_query):
+    # The flow's materialized view query, run as a DuckDB table
+    query = mat_view_query.replace(
+        "CREATE MATERIALIZED VIEW IF NOT EXISTS", "CREATE OR REPLACE TABLE", 1
+    )
+    con.execute(query)
+    return con.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+
+def postgres_type(duckdb_type):
+    if duckdb_type.startswith("DECIMAL"):
+        return duckdb_type.replace("DECIMAL", "NUMERIC", 1)
+    return POSTGRES_TYPES[duckdb_type]
+
+
+def parquet_column_bytes(con, path):
+    # Compressed bytes of each column over the file's row groups, i.e. what a
+    # scan reading only that column fetches
+    rows = con.execute(
+        "SELECT path_in_schema, SUM(total_compressed_size)"
+        f" FROM parquet_metadata({sql_string(path)}) GROUP BY path_in_schema"
+    ).fetchall()
+    return {column: int(size) for column, size in rows}
+
+
+def postgres_column_defs(con, relation):
+    columns = con.execute(f"DESCRIBE {relation}").fetchall()
+    return ", ".join(f'"{row[0]}" {postgres_type(row[1])}' for row in columns)
+
+
+class CsvBatchReader:
+    # A file for copy_expert over a query's rows, encoded to CSV one record
+    # batch at a time as it is read, so no more than a batch is held in memory
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.buffer = memoryview(b"")
+        self.options = pa_csv.WriteOptions(include_header=False)
+
+    def read(self, size=-1):
+        while not self.buffer:
+            batch = next(self.batches, None)
+            if batch is None:
+                return b""
+            sink = io.BytesIO()
+            pa_csv.write_csv(batch, sink, self.options)
+            self.buffer = sink.getbuffer()
+        size = len(self.buffer) if size < 0 else size
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return bytes(chunk)
+
+
+def copy_query_to_postgres(con, cursor, query, table_name, columns):
+    # Bulk loads the query's rows with COPY, streamed from DuckDB in record
+    # batches; returns the number of rows loaded
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    batches = con.execute(query).fetch_record_batch(COPY_BATCH_ROWS)
+    cursor.copy_expert(
+        f"COPY {table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+        CsvBatchReader(batches),
+        size=COPY_READ_BYTES,
+    )
+    return cursor.rowcount
+
+
+def copy_table_to_postgres(con, conn, name, idx_col_name):
+    # Loads a staging table and swaps it in within one transaction, so readers
+    # see either the previous rows or the new ones. A materialized view of the
+    # same name, left by the Postgres engine, is replaced along with its
+    # dependents, which are rebuilt later in the same run.
+    columns = [row[0] for row in con.execute(f"DESCRIBE {name}").fetchall()]
+    staging = f"{name}_staging"
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+    cursor.execute(f"CREATE TABLE {staging} ({postgres_column_defs(con, name)})")
+    copy_query_to_postgres(con, cursor, f"SELECT * FROM {name}", staging, columns)
+    cursor.execute(f"CREATE UNIQUE INDEX {staging}_idx ON {staging} ({idx_col_name})")
+    cursor.execute("SELECT 1 FROM pg_matviews WHERE matviewname = %s", (name,))
+    if cursor.fetchone():
+        cursor.execute(f"DROP MATERIALIZED VIEW {name} CASCADE")
+    else:
+        cursor.execute(f"DROP TABLE IF EXISTS {name}")
+    cursor.execute(f"ALTER TABLE {staging} RENAME TO {name}")
+    cursor.execute(f"ALTER INDEX {staging}_idx RENAME TO {name}_idx")
+    conn.commit()
+    cursor.close()
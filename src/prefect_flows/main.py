@@ -1,11 +1,26 @@
+import csv
+import hashlib
+import json
 import multiprocessing
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+import archive
+import coordination
+import duckdb_engine
+import maintenance
+import profiling
 import psycopg2
+import snapshot
+import source_files
+import spark_cluster
 from prefect import flow, task
 from prefect.client.schemas.schedules import IntervalSchedule
-from pyspark.sql import SparkSession
 
 # Database connection parameters from environment variables
 DB_URL = os.getenv("DB_URL")
@@ -15,10 +30,65 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DATA_FILES_PATH = os.getenv("DATA_FILES_PATH")
+# "postgres" builds the aggregates as materialized views over the ingested trip
+# tables, "duckdb" builds them straight from the parquet files
+AGGREGATION_ENGINE = os.getenv("AGGREGATION_ENGINE", "postgres")
+# Raw trips in Postgres are only needed by the postgres engine and trip exports
+INGEST_RAW_TRIPS = os.getenv("INGEST_RAW_TRIPS", "true").lower() == "true"
+# Columns loaded from the trip files: "full" for all of them, "dashboard" for
+# only those the aggregates read (see profile_columns). A table created with
+# the dashboard profile can't be loaded with the full one later.
+INGEST_PROFILE = os.getenv("INGEST_PROFILE", "full")
+PROJECTION_PROFILES = ["full", "dashboard"]
+# Month files a backfill loads at once
+BACKFILL_PARALLELISM = int(os.getenv("BACKFILL_PARALLELISM", os.cpu_count() or 1))
+# TLC's zone lookup, published next to the trip files
+TAXI_ZONE_LOOKUP_FILE = "taxi_zone_lookup.csv"
+
+# Small integer keys of the zone cube, shared with the dashboard
+SERVICE_IDS = {"fhvhv": 1, "fhv": 2, "yellow": 3, "green": 4}
+
+# Fixed-width histogram sketches of trip-level values, per service and hour:
+# metric id, lower and upper bound, number of buckets. Changing a definition
+# needs the hourly_trip_histograms view dropped and rebuilt.
+HISTOGRAM_SKETCHES = {
+    "trip_time_min": (1, 0, 120, 120),
+    "trip_miles": (2, 0, 50, 100),
+    "amount_payed": (3, 0, 200, 100),
+}
+
+
+# The aggregates read straight from the trip tables. Their rows for archived
+# months are kept in <view>_archived tables, since the trips are gone.
+ARCHIVED_VIEWS = [f"{service}_hourly_tripdata" for service in SERVICE_IDS] + [
+    "zone_hourly_tripdata",
+    "hourly_trip_histograms",
+]
+
+
+def trip_source(service, month_of=None):
+    # The trips an aggregate reads: the whole table or, with month_of set to a
+    # service and month, only that month of that service's trips
+    if month_of is None:
+        return f"{service}_tripdata"
+    if service != month_of[0]:
+        return f"(SELECT * FROM {service}_tripdata WHERE FALSE)"
+    return f"""(
+        SELECT * FROM {service}_tripdata
+        WHERE pickup_datetime >= '{month_of[1]}'
+            AND pickup_datetime < TIMESTAMP '{month_of[1]}' + INTERVAL '1 month'
+    )"""
+
+
+def select_of(mat_view_query):
+    return re.sub(
+        r"^\s*CREATE MATERIALIZED VIEW IF NOT EXISTS \w+ AS", "", mat_view_query
+    )
 
 
 def extract_db_name_from_file_name(file_name):
-    return file_name.split("_2024")[0]
+    # <table>_<YYYY>-<MM>.parquet, for 2024 and for backfilled years
+    return re.sub(r"_\d{4}-\d{2}\.parquet$", "", file_name)
 
 
 def get_existing_tables(cursor):
@@ -30,7 +100,13 @@ def get_existing_tables(cursor):
     return tables
 
 
-def get_latest_updatetime_for_table(cursor, table):
+def get_latest_updatetime_for_table(cursor, table, since=None):
+    if since is not None:
+        cursor.execute(
+            f"SELECT MAX(pickup_datetime) FROM {table} WHERE pickup_datetime >= %s",
+            (since,),
+        )
+        return cursor.fetchone()[0]
     cursor.execute(f"SELECT MAX(pickup_datetime) FROM {table}")
     result = cursor.fetchone()[0]
     return result
@@ -87,17 +163,73 @@ def get_files_to_process(table_name, start_time):
     return all_files_to_process
 
 
-@task(log_prints=True)
-def discover_files():
-    all_files = os.listdir(DATA_FILES_PATH)
-    all_potential_tables = list(
+def profile_columns(profile, table_name, columns):
+    # The columns of a trip file, as renamed at ingestion, that a profile loads
+    if profile not in PROJECTION_PROFILES:
+        raise ValueError(f"Unknown projection profile {profile}")
+    if profile == "full":
+        return list(columns)
+    mat_views_queries, _ = generate_aggregation_queries(include_archived=False)
+    used = " ".join(
+        query
+        for query in mat_views_queries.values()
+        if coordination.tables_read_by(query, [table_name])
+    )
+    # Postgres folds unquoted names to lower case
+    return [
+        column
+        for column in columns
+        if column in ("pickup_datetime", "dropoff_datetime")
+        or re.search(rf"\b{re.escape(column)}\b", used, re.IGNORECASE)
+    ]
+
+
+def get_table_size(cursor, table_name):
+    cursor.execute("SELECT pg_total_relation_size(%s)", (table_name,))
+    return cursor.fetchone()[0]
+
+
+def connect_db():
+    # Statements are timed while a flow is profiled; see profiling.py
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        cursor_factory=profiling.TimedCursor if profiling.PROFILE_FLOWS else None,
+    )
+
+
+@contextmanager
+def locked_tables(process, run_name, table_names):
+    # See coordination.table_locks; the locks live on their own connection
+    conn = connect_db()
+    try:
+        with coordination.table_locks(conn, process, run_name, table_names):
+            yield
+    finally:
+        conn.close()
+
+
+def list_trip_tables():
+    # Only the monthly trip files; the folder also holds the zone lookup
+    all_files = [
+        file_name
+        for file_name in os.listdir(DATA_FILES_PATH)
+        if file_name.endswith(".parquet")
+    ]
+    return list(
         set([extract_db_name_from_file_name(file_name) for file_name in all_files])
     )
+
+
+@task(log_prints=True)
+def discover_files():
+    all_potential_tables = list_trip_tables()
     print("All potential tables: ", all_potential_tables)
 
-    conn = psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-    )
+    conn = connect_db()
     cursor = conn.cursor()
 
     existing_tables = get_existing_tables(cursor)
@@ -106,11 +238,15 @@ def discover_files():
     tables_not_existing = list(set(all_potential_tables) - set(existing_tables))
     print("Tables not existing: ", tables_not_existing)
 
+    # Only the trip tables: the flows keep their bookkeeping in the same schema.
+    # The files ingested are those of the current year, so the watermark is
+    # too: months backfilled from earlier years don't move it.
+    year_start = datetime(current_data_month().year, 1, 1)
     tables_start_times = {
         **{table: None for table in tables_not_existing},
         **{
-            table: get_latest_updatetime_for_table(cursor, table)
-            for table in existing_tables
+            table: get_latest_updatetime_for_table(cursor, table, since=year_start)
+            for table in set(existing_tables) & set(all_potential_tables)
         },
     }
     print("Table start times: ", tables_start_times)
@@ -126,27 +262,55 @@ def discover_files():
     return files_to_process
 
 
+def read_trip_file(spark, file_path, table_name, start_time=None, end_time=None):
+    # The file's rows the ingestion loads, and the file's names of the renamed
+    # columns. Nothing is read until an action runs.
+    df = spark.read.parquet(file_path)
+
+    pickup_col = [col for col in df.columns if "pickup_datetime" in col.lower()][0]
+    dropoff_col = [col for col in df.columns if "dropoff_datetime" in col.lower()][0]
+    df = df.withColumnsRenamed(
+        {pickup_col: "pickup_datetime", dropoff_col: "dropoff_datetime"}
+    )
+    # Selected before any action, so the parquet scan only decodes these
+    df = df.select(*profile_columns(INGEST_PROFILE, table_name, df.columns))
+
+    if start_time is not None and end_time is not None:
+        df = df.filter(
+            (df["pickup_datetime"] > start_time) & (df["pickup_datetime"] < end_time)
+        )
+    return df, {"pickup_datetime": pickup_col, "dropoff_datetime": dropoff_col}
+
+
 @flow(log_prints=True, flow_run_name="{file_name}", retries=5)
 def ingest_data_from_file(spark, file_name, table_name, start_time, end_time):
     file_path = os.path.join(DATA_FILES_PATH, file_name)
+    rows_written = 0
     try:
         # Read the Parquet file
         print(f"Reading Parquet file from {file_path} ...")
-        df = spark.read.parquet(file_path)
-
-        pickup_col = [col for col in df.columns if "pickup_datetime" in col.lower()][0]
-        dropoff_col = [col for col in df.columns if "dropoff_datetime" in col.lower()][
-            0
-        ]
-        df = df.withColumnsRenamed(
-            {pickup_col: "pickup_datetime", dropoff_col: "dropoff_datetime"}
+        profiling.describe_spark_jobs(spark, file_name)
+        df, source_names = read_trip_file(
+            spark, file_path, table_name, start_time, end_time
         )
-
-        if start_time is not None and end_time is not None:
-            df = df.filter(
-                (df["pickup_datetime"] > start_time)
-                & (df["pickup_datetime"] < end_time)
+        columns = df.columns
+        print(f"Loading {len(columns)} columns ({INGEST_PROFILE} profile)")
+        if profiling.PROFILE_FLOWS:
+            # The bytes the projection saves, from the file's footer: only
+            # worth the extra read when the run is profiled
+            con = duckdb_engine.connect(1)
+            column_bytes = duckdb_engine.parquet_column_bytes(con, file_path)
+            con.close()
+            read_bytes = sum(
+                column_bytes.get(source_names.get(column, column), 0)
+                for column in columns
+            )
+            print(
+                f"Loading {read_bytes / 1e6:.1f} of"
+                f" {sum(column_bytes.values()) / 1e6:.1f} MB of the file's"
+                f" {len(column_bytes)} columns"
             )
+        start = time.perf_counter()
 
         num_rows = df.count()
 
@@ -159,69 +323,670 @@ def ingest_data_from_file(spark, file_name, table_name, start_time, end_time):
             print(
                 f"Writing {num_rows} DataFrame rows to PostgreSQL table '{table_name}' at {DB_URL} ..."
             )
-            df.write.format("jdbc").option("url", DB_URL).option(
-                "dbtable", table_name
-            ).option("user", DB_USER).option("password", DB_PASSWORD).option(
-                "driver", "org.postgresql.Driver"
-            ).mode(
-                "append"
-            ).save()
+            # Not while a view over the table is refreshed or it is archived
+            with locked_tables("ingestion", file_name, [table_name]):
+                spark_cluster.write_trips(
+                    df,
+                    table_name,
+                    DB_URL,
+                    DB_USER,
+                    DB_PASSWORD,
+                    dict(
+                        host=DB_HOST,
+                        port=DB_PORT,
+                        dbname=DB_NAME,
+                        user=DB_USER,
+                        password=DB_PASSWORD,
+                    ),
+                )
+            rows_written = num_rows
 
             print(f"✅ Data successfully written data from {file_path} to PostgreSQL!")
+            print(f"{num_rows / (time.perf_counter() - start):.0f} rows/s")
 
     except Exception as e:
         print(f"❌ Error: {e}")
 
+    return rows_written
+
+
+@flow(log_prints=True)
+def maintain_tables(rows_written):
+    # Targeted ANALYZE/VACUUM of the tables the ingestion wrote to, so the next
+    # refresh plans with fresh statistics; see maintenance.py
+    conn = connect_db()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    maintenance.create_maintenance_tables(cursor)
+    for table_name, num_rows in rows_written.items():
+        if num_rows == 0:
+            continue
+        for (
+            relation,
+            live_rows,
+            modified_rows,
+            unvacuumed_rows,
+        ) in maintenance.relation_stats(cursor, table_name):
+            # The statistics counters are flushed asynchronously and may not
+            # include this run's rows yet
+            modified_rows = max(modified_rows, num_rows)
+            unvacuumed_rows = max(unvacuumed_rows, num_rows)
+            action, reason = maintenance.plan_maintenance(
+                live_rows, modified_rows, unvacuumed_rows
+            )
+            if action is None:
+                print(f"No maintenance needed for {relation} ({live_rows} rows)")
+                continue
+            seconds = maintenance.run_maintenance(
+                cursor, table_name, relation, action, reason, num_rows
+            )
+            print(f"{action} {relation} in {seconds:.1f} s: {reason}")
+    cursor.close()
+    conn.close()
+
+
+def replace_month(table_name, file_name, month, end_time, fingerprint):
+    # Swaps the month's trips for the corrected file's: they are staged in a
+    # table of their own first, then one transaction deletes the month's rows
+    # and moves the staged ones in, so readers never see the month half done
+    start = time.perf_counter()
+    file_path = os.path.join(DATA_FILES_PATH, file_name)
+    con = duckdb_engine.connect()
+    duckdb_engine.register_trip_table(con, "trips", [(file_path, None, None)])
+    conn = connect_db()
+    cursor = conn.cursor()
+    columns = loaded_columns(con, cursor, table_name)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    staging = f"{table_name}_staging_{month:%Y%m}"
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+    cursor.execute(f"CREATE UNLOGGED TABLE {staging} (LIKE {table_name})")
+    num_rows = duckdb_engine.copy_query_to_postgres(
+        con,
+        cursor,
+        f"SELECT {column_list} FROM trips WHERE pickup_datetime >= '{month}'"
+        f" AND pickup_datetime < '{end_time}'",
+        staging,
+        columns,
+    )
+    conn.commit()
+    con.close()
+
+    # Not while the table is loaded, archived or a view over it refreshed
+    with locked_tables("correction", file_name, [table_name]):
+        cursor.execute(
+            f"DELETE FROM {table_name}"
+            " WHERE pickup_datetime >= %s AND pickup_datetime < %s",
+            (month, end_time),
+        )
+        num_deleted = cursor.rowcount
+        cursor.execute(
+            f"INSERT INTO {table_name} ({column_list})"
+            f" SELECT {column_list} FROM {staging}"
+        )
+        cursor.execute(f"DROP TABLE {staging}")
+        source_files.record_fingerprint(cursor, file_name, table_name, fingerprint)
+        conn.commit()
+    cursor.close()
+    conn.close()
+    print(
+        f"✅ Replaced {num_deleted} rows of {table_name} for {month:%Y-%m} with"
+        f" {num_rows} from {file_name} in {time.perf_counter() - start:.1f} s"
+    )
+    return num_rows
+
+
+@flow(log_prints=True)
+def replace_corrected_months():
+    # The MAX(pickup_datetime) watermark only finds new trips, so republished
+    # files of loaded months are found by their fingerprints instead
+    conn = connect_db()
+    cursor = conn.cursor()
+    source_files.create_source_files_table(cursor)
+    existing_tables = get_existing_tables(cursor)
+    trip_files = sorted(
+        file_name
+        for file_name in os.listdir(DATA_FILES_PATH)
+        if file_name.endswith(".parquet")
+        and extract_db_name_from_file_name(file_name) in existing_tables
+    )
+    changed_files = source_files.find_changed_files(
+        cursor, DATA_FILES_PATH, trip_files, extract_db_name_from_file_name
+    )
+    conn.commit()
+    print("Changed source files: ", [file_name for file_name, _ in changed_files])
+    archived = set()
+    if "archived_months" in existing_tables:
+        cursor.execute("SELECT table_name, month FROM archived_months")
+        archived = {(table_name, month) for table_name, month in cursor.fetchall()}
+
+    rows_replaced = {}
+    for file_name, fingerprint in changed_files:
+        table_name = extract_db_name_from_file_name(file_name)
+        month = source_files.file_month(file_name)
+        if (table_name, month.date()) in archived:
+            # Kept unrecorded, so it is reported again until dealt with
+            print(f"⚠️ {file_name} changed but {month:%Y-%m} is archived. Skipping")
+            continue
+        # Only what the ingestion has loaded so far; newer trips are left to it
+        latest = get_latest_updatetime_for_table(cursor, table_name)
+        end_time = months_after(month, 1)
+        if latest is not None:
+            end_time = min(end_time, latest + timedelta(microseconds=1))
+        if latest is None or end_time <= month:
+            print(f"{file_name} changed before its month was loaded")
+            source_files.record_fingerprint(cursor, file_name, table_name, fingerprint)
+            conn.commit()
+            continue
+        rows_replaced[table_name] = rows_replaced.get(table_name, 0) + replace_month(
+            table_name, file_name, month, end_time, fingerprint
+        )
+    cursor.close()
+    conn.close()
+    return rows_replaced
+
 
 @flow(log_prints=True, retries=5)
+@profiling.profiled
 def ingest_data():
     # Identify which files need to be read
     print("Discovering the files to read")
     all_files = discover_files()
 
     # Initialize Spark session
-    spark = (
-        SparkSession.builder.appName("ParquetToPostgres")
-        .config("spark.jars", "/opt/spark/jars/postgresql-42.5.0.jar")
-        .getOrCreate()
-    )
+    spark = spark_cluster.build_session("ParquetToPostgres")
 
     # Ingest data from each file
+    rows_written = {file_data["table_name"]: 0 for file_data in all_files}
     for file_data in all_files:
-        ingest_data_from_file(spark, **file_data)
+        table_name = file_data["table_name"]
+        rows_written[table_name] += ingest_data_from_file(spark, **file_data)
 
-    # Stop Spark session
+    # Stop Spark session, after reading its stage metrics
+    profiling.record_spark_stages(spark)
     spark.stop()
     print("Spark session stopped.")
 
+    print("Rows written per table: ", rows_written)
+    rows_replaced = replace_corrected_months()
+    for table_name, num_rows in rows_replaced.items():
+        rows_written[table_name] = rows_written.get(table_name, 0) + num_rows
+    maintain_tables(rows_written)
+
+    conn = connect_db()
+    cursor = conn.cursor()
+    existing_tables = get_existing_tables(cursor)
+    for table_name in rows_written:
+        if table_name in existing_tables:
+            size = get_table_size(cursor, table_name)
+            print(f"{table_name} ({INGEST_PROFILE} profile): {size / 1e6:.1f} MB")
+    cursor.close()
+    conn.close()
+
+    # Corrections are aggregated now rather than at the next scheduled refresh
+    if rows_replaced:
+        create_or_update_all_materialized_views(changed_tables=sorted(rows_replaced))
+
 
 @flow(log_prints=True, flow_run_name="{mat_view_name}", retries=5)
-def create_or_update_mat_view(
-    mat_view_name, mat_view_query, idx_col_name, conn, existing_mat_views
-):
+def create_or_update_mat_view(mat_view_name, mat_view_query, idx_col_name, conn):
+    # Reads the trip tables in the query, so not while they are being loaded
+    trip_tables = coordination.tables_read_by(mat_view_query, list_trip_tables())
+    with locked_tables("aggregation", mat_view_name, trip_tables):
+        # The view's comment holds a hash of the query it was created from, so a
+        # changed definition is recreated rather than refreshed
+        definition = hashlib.md5(mat_view_query.encode()).hexdigest()
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT obj_description(matviewname::regclass, 'pg_class')
+            FROM pg_matviews WHERE matviewname = %s
+            """,
+            (mat_view_name,),
+        )
+        existing = cursor.fetchone()
+        if existing is not None and existing[0] != definition:
+            print(
+                f"Materialized view {mat_view_name} has a new definition. Recreating it"
+            )
+            cursor.execute(f"DROP MATERIALIZED VIEW {mat_view_name} CASCADE;")
+            conn.commit()
+            existing = None
+        if existing is not None:
+            print(f"Materialized view {mat_view_name} already exists. Refreshing it")
+            plan = maintenance.explain(cursor, select_of(mat_view_query))
+            start = time.perf_counter()
+            cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {mat_view_name};")
+            refresh_seconds = time.perf_counter() - start
+            maintenance.create_maintenance_tables(cursor)
+            if maintenance.record_refresh_plan(
+                cursor, mat_view_name, plan, refresh_seconds
+            ):
+                print(f"The plan of {mat_view_name} changed since its last refresh")
+            conn.commit()
+            print(
+                f"Successfully refreshed the materialized view {mat_view_name}"
+                f" in {refresh_seconds:.1f} s"
+            )
+        else:
+            print(f"Materialized view {mat_view_name} doesn't exist. Creating it")
+            # A table of the same name is the duckdb engine's result
+            cursor.execute(f"DROP TABLE IF EXISTS {mat_view_name} CASCADE;")
+            cursor.execute(mat_view_query)
+            cursor.execute(
+                f"COMMENT ON MATERIALIZED VIEW {mat_view_name} IS %s;", (definition,)
+            )
+            conn.commit()
+            print(
+                f"Done creating {mat_view_name} materialized view. Going to create unique index"
+            )
+            cursor.execute(
+                f"CREATE UNIQUE INDEX {mat_view_name}_idx ON {mat_view_name} ({idx_col_name});"
+            )
+            conn.commit()
+        cursor.close()
+
+
+# Rollups over the hourly views keep sums only, which any set of days or
+# months merges exactly. The hourly averages skip NULLs while num_trips counts
+# every trip, so they can't be turned into mergeable partials here; averages
+# are read from the hourly views.
+ROLLUP_SUMMED_COLUMNS = {
+    "fhvhv": [
+        "num_trips",
+        "total_base_fare_amount",
+        "total_tolls",
+        "total_black_car_fund",
+        "total_tax",
+        "total_congestion_surcharge",
+        "total_airport_fees",
+        "total_tips",
+        "total_driver_pay",
+        "total_amount_payed",
+    ],
+    "fhv": ["num_trips"],
+    "yellow": [
+        "num_trips",
+        "total_base_fare_amount",
+        "total_extra",
+        "total_tax",
+        "total_tips",
+        "total_tolls",
+        "total_improvement_surcharge",
+        "total_congestion_surcharge",
+        "total_airport_fees",
+        "total_amount_payed",
+    ],
+    "green": [
+        "num_trips",
+        "total_base_fare_amount",
+        "total_extra",
+        "total_tax",
+        "total_tips",
+        "total_tolls",
+        "total_improvement_surcharge",
+        "total_congestion_surcharge",
+        "total_amount_payed",
+    ],
+}
+
+
+def generate_daily_rollup_query(service):
+    # Built from the hourly view rather than the trip table, so it costs a scan
+    # of a few thousand rows and its sums match summing the hourly rows
+    sums = [f"SUM({col}) AS {col}" for col in ROLLUP_SUMMED_COLUMNS[service]]
+    return f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS {service}_daily_tripdata AS
+        SELECT
+            DATE_TRUNC('day', pickup_hour) AS pickup_day,
+            {", ".join(sums)}
+        FROM {service}_hourly_tripdata
+        GROUP BY pickup_day
+    """
+
+
+def generate_monthly_rollup_query(service):
+    sums = [f"SUM({col}) AS {col}" for col in ROLLUP_SUMMED_COLUMNS[service]]
+    return f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS {service}_monthly_tripdata AS
+        SELECT
+            DATE_TRUNC('month', pickup_day) AS pickup_month,
+            {", ".join(sums)}
+        FROM {service}_daily_tripdata
+        GROUP BY pickup_month
+    """
+
+
+def load_taxi_zone_lookup(conn):
+    # Zones and boroughs with small integer keys for the zone cube. Borough ids
+    # are assigned once and kept, so cube rows stay valid across reloads; id 0
+    # stands for a drop-off zone that is unknown or missing from the lookup.
     cursor = conn.cursor()
-    if mat_view_name in existing_mat_views:
-        print(f"Materialized view {mat_view_name} already exists. Refreshing it")
-        cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {mat_view_name};")
-        conn.commit()
-        print(f"Successfully refreshed the materialized view {mat_view_name}")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS taxi_boroughs (
+            borough_id SMALLSERIAL PRIMARY KEY,
+            borough TEXT NOT NULL UNIQUE
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS taxi_zone_lookup (
+            location_id SMALLINT PRIMARY KEY,
+            borough_id SMALLINT NOT NULL REFERENCES taxi_boroughs (borough_id),
+            zone TEXT,
+            service_zone TEXT
+        )
+        """
+    )
+    lookup_path = os.path.join(DATA_FILES_PATH, TAXI_ZONE_LOOKUP_FILE)
+    if os.path.exists(lookup_path):
+        with open(lookup_path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            cursor.execute(
+                "INSERT INTO taxi_boroughs (borough) VALUES (%s) ON CONFLICT DO NOTHING",
+                (row["Borough"],),
+            )
+            cursor.execute(
+                """
+                INSERT INTO taxi_zone_lookup (location_id, borough_id, zone, service_zone)
+                SELECT %s, borough_id, %s, %s FROM taxi_boroughs WHERE borough = %s
+                ON CONFLICT (location_id) DO UPDATE SET
+                    borough_id = EXCLUDED.borough_id,
+                    zone = EXCLUDED.zone,
+                    service_zone = EXCLUDED.service_zone
+                """,
+                (row["LocationID"], row["Zone"], row["service_zone"], row["Borough"]),
+            )
+        print(f"Loaded {len(rows)} taxi zones from {lookup_path}")
     else:
-        print(f"Materialized view {mat_view_name} doesn't exist. Creating it")
-        cursor.execute(mat_view_query)
-        conn.commit()
-        print(
-            f"Done creating {mat_view_name} materialized view. Going to create unique index"
+        print(f"No {TAXI_ZONE_LOOKUP_FILE} in {DATA_FILES_PATH}, boroughs stay unknown")
+    conn.commit()
+    cursor.close()
+
+
+def generate_zone_cube_query(month_of=None):
+    # Trips per service x pickup zone x drop-off borough x hour, keyed by small
+    # integers and stored as int/real to keep the cube compact. FHV files spell
+    # the location columns PUlocationID/DOlocationID.
+    trip_time = "EXTRACT(EPOCH FROM (dropoff_datetime::timestamp - pickup_datetime::timestamp)) / 60"
+    # Measures summed the same way as in the hourly views
+    sources = {
+        "fhvhv": (
+            '"PULocationID"',
+            '"DOLocationID"',
+            "SUM(trip_time / 60)",
+            "SUM(trip_miles)",
+            "SUM(base_passenger_fare) + SUM(tolls) + SUM(bcf) + SUM(sales_tax)"
+            " + SUM(congestion_surcharge) + SUM(airport_fee) + SUM(tips)",
+        ),
+        "fhv": (
+            '"PUlocationID"',
+            '"DOlocationID"',
+            f"SUM({trip_time})",
+            "NULL",
+            "NULL",
+        ),
+        "yellow": (
+            '"PULocationID"',
+            '"DOLocationID"',
+            f"SUM({trip_time})",
+            "SUM(trip_distance)",
+            "SUM(fare_amount) + SUM(extra) + SUM(mta_tax) + SUM(tip_amount)"
+            " + SUM(tolls_amount) + SUM(improvement_surcharge)"
+            ' + SUM(congestion_surcharge) + SUM("Airport_fee")',
+        ),
+        "green": (
+            '"PULocationID"',
+            '"DOLocationID"',
+            f"SUM({trip_time})",
+            "SUM(trip_distance)",
+            "SUM(fare_amount) + SUM(extra) + SUM(mta_tax) + SUM(tip_amount)"
+            " + SUM(tolls_amount) + SUM(improvement_surcharge)"
+            " + SUM(congestion_surcharge)",
+        ),
+    }
+    selects = [
+        f"""
+        SELECT
+            {SERVICE_IDS[service]}::SMALLINT AS service_id,
+            COALESCE(trips.{pu_col}, 0)::SMALLINT AS pu_location_id,
+            COALESCE(zones.borough_id, 0)::SMALLINT AS do_borough_id,
+            DATE_TRUNC('hour', trips.pickup_datetime) AS pickup_hour,
+            COUNT(*)::INTEGER AS num_trips,
+            ({total_trip_time})::REAL AS total_trip_time_min,
+            ({total_trip_miles})::REAL AS total_trip_miles,
+            ({total_amount_payed})::REAL AS total_amount_payed
+        FROM {trip_source(service, month_of)} trips
+        LEFT JOIN taxi_zone_lookup zones ON zones.location_id = trips.{do_col}
+        GROUP BY 1, 2, 3, 4
+        """
+        for service, (
+            pu_col,
+            do_col,
+            total_trip_time,
+            total_trip_miles,
+            total_amount_payed,
+        ) in sources.items()
+    ]
+    return (
+        "CREATE MATERIALIZED VIEW IF NOT EXISTS zone_hourly_tripdata AS"
+        + " UNION ALL ".join(selects)
+    )
+
+
+def load_histogram_metrics(conn):
+    # The sketches' bucket definitions, so readers can turn buckets into values
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS trip_histogram_metrics (
+            metric_id SMALLINT PRIMARY KEY,
+            metric TEXT NOT NULL UNIQUE,
+            low DOUBLE PRECISION NOT NULL,
+            high DOUBLE PRECISION NOT NULL,
+            num_buckets SMALLINT NOT NULL
         )
+        """
+    )
+    for metric, (metric_id, low, high, num_buckets) in HISTOGRAM_SKETCHES.items():
         cursor.execute(
-            f"CREATE UNIQUE INDEX {mat_view_name}_idx ON {mat_view_name} ({idx_col_name});"
+            """
+            INSERT INTO trip_histogram_metrics (metric_id, metric, low, high, num_buckets)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (metric_id) DO UPDATE SET
+                metric = EXCLUDED.metric,
+                low = EXCLUDED.low,
+                high = EXCLUDED.high,
+                num_buckets = EXCLUDED.num_buckets
+            """,
+            (metric_id, metric, low, high, num_buckets),
         )
-        conn.commit()
+    conn.commit()
     cursor.close()
 
 
-@flow(log_prints=True, retries=5)
-def create_or_update_all_materialized_views():
-    fhvhv_hourly_tripdata = """
+def generate_histogram_sketch_query(month_of=None):
+    # Trips per service, metric, hour and width_bucket bucket. Bucket 0 and
+    # num_buckets + 1 hold the values below and above the range, so no trip is
+    # lost and sketches of any set of hours merge by summing their counts.
+    trip_time = "EXTRACT(EPOCH FROM (dropoff_datetime::timestamp - pickup_datetime::timestamp)) / 60"
+
+    def amount(cols):
+        return " + ".join(f"COALESCE({col}, 0)" for col in cols)
+
+    sources = {
+        "fhvhv": (
+            "trip_time / 60",
+            "trip_miles",
+            amount(
+                [
+                    "base_passenger_fare",
+                    "tolls",
+                    "bcf",
+                    "sales_tax",
+                    "congestion_surcharge",
+                    "airport_fee",
+                    "tips",
+                ]
+            ),
+        ),
+        "fhv": (trip_time, "NULL", "NULL"),
+        "yellow": (
+            trip_time,
+            "trip_distance",
+            amount(
+                [
+                    "fare_amount",
+                    "extra",
+                    "mta_tax",
+                    "tip_amount",
+                    "tolls_amount",
+                    "improvement_surcharge",
+                    "congestion_surcharge",
+                    '"Airport_fee"',
+                ]
+            ),
+        ),
+        "green": (
+            trip_time,
+            "trip_distance",
+            amount(
+                [
+                    "fare_amount",
+                    "extra",
+                    "mta_tax",
+                    "tip_amount",
+                    "tolls_amount",
+                    "improvement_surcharge",
+                    "congestion_surcharge",
+                ]
+            ),
+        ),
+    }
+    trips = " UNION ALL ".join(
+        f"""
+        SELECT
+            {SERVICE_IDS[service]}::SMALLINT AS service_id,
+            DATE_TRUNC('hour', pickup_datetime) AS pickup_hour,
+            ({values[0]})::DOUBLE PRECISION AS trip_time_min,
+            ({values[1]})::DOUBLE PRECISION AS trip_miles,
+            ({values[2]})::DOUBLE PRECISION AS amount_payed
+        FROM {trip_source(service, month_of)}
+        """
+        for service, values in sources.items()
+    )
+    buckets = ", ".join(
+        f"({metric_id}, width_bucket(trips.{metric}, {low}::DOUBLE PRECISION,"
+        f" {high}::DOUBLE PRECISION, {num_buckets}))"
+        for metric, (metric_id, low, high, num_buckets) in HISTOGRAM_SKETCHES.items()
+    )
+    return f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS hourly_trip_histograms AS
+    SELECT
+        trips.service_id,
+        buckets.metric_id::SMALLINT AS metric_id,
+        trips.pickup_hour,
+        buckets.bucket::SMALLINT AS bucket,
+        COUNT(*)::INTEGER AS num_trips
+    FROM ({trips}) trips
+    CROSS JOIN LATERAL (VALUES {buckets}) AS buckets (metric_id, bucket)
+    WHERE buckets.bucket IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    """
+
+
+def publish_data_version(conn):
+    # Bumps the version row and notifies listeners (the dashboard) on commit
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO data_versions (name, version, updated_at)
+        VALUES ('hourly_tripdata', 1, NOW())
+        ON CONFLICT (name)
+        DO UPDATE SET version = data_versions.version + 1, updated_at = NOW()
+        RETURNING version
+        """
+    )
+    version = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_notify('data_version', %s)", (str(version),))
+    conn.commit()
+    cursor.close()
+    print(f"Published data version {version}")
+
+
+def aggregate_with_duckdb(conn, mat_views_queries, mat_views_idx_cols):
+    # Runs the views' SQL in embedded DuckDB over the parquet files the ingestion
+    # would load, then writes only the small results to Postgres
+    con = duckdb_engine.connect()
+    for table_name in list_trip_tables():
+        files = [
+            (
+                os.path.join(DATA_FILES_PATH, file_data["file_name"]),
+                file_data["start_time"],
+                file_data["end_time"],
+            )
+            for file_data in get_files_to_process(table_name, None)
+            if os.path.exists(os.path.join(DATA_FILES_PATH, file_data["file_name"]))
+        ]
+        if files:
+            duckdb_engine.register_trip_table(con, table_name, files)
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT location_id, borough_id FROM taxi_zone_lookup")
+    duckdb_engine.load_zone_lookup(con, cursor.fetchall())
+    cursor.close()
+
+    for name, query in mat_views_queries.items():
+        start = datetime.now()
+        num_rows = duckdb_engine.build_table(con, name, query)
+        print(f"Built {name} in DuckDB: {num_rows} rows in {datetime.now() - start}")
+        duckdb_engine.copy_table_to_postgres(con, conn, name, mat_views_idx_cols[name])
+        print(f"Successfully wrote {name} to PostgreSQL")
+    con.close()
+
+
+def create_archived_tables(conn):
+    # Empty until a month is archived, with the columns of the views they extend
+    mat_views_queries, _ = generate_aggregation_queries(include_archived=False)
+    cursor = conn.cursor()
+    for name in ARCHIVED_VIEWS:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {name}_archived AS"
+            f" {select_of(mat_views_queries[name])} WITH NO DATA"
+        )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_months (
+            table_name TEXT NOT NULL,
+            month DATE NOT NULL,
+            row_count BIGINT NOT NULL,
+            checksums JSONB NOT NULL,
+            path TEXT NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (table_name, month)
+        )
+        """
+    )
+    conn.commit()
+    cursor.close()
+
+
+def generate_aggregation_queries(month_of=None, include_archived=True):
+    # Every aggregate the dashboard reads, in build order, with its unique index.
+    # With month_of, the aggregates that read trips only read that service and
+    # month; with include_archived, they add the rows frozen by archiving.
+    fhvhv_hourly_tripdata = f"""
         CREATE MATERIALIZED VIEW IF NOT EXISTS fhvhv_hourly_tripdata AS
         SELECT
             DATE_TRUNC('hour', pickup_datetime) AS pickup_hour,
@@ -238,21 +1003,21 @@ def create_or_update_all_materialized_views():
             SUM(tips) AS total_tips,
             SUM(driver_pay) AS total_driver_pay,
             SUM(base_passenger_fare) + SUM(tolls) + SUM(bcf) + SUM(sales_tax) + SUM(congestion_surcharge) + SUM(airport_fee) + SUM(tips) AS total_amount_payed
-        FROM fhvhv_tripdata
+        FROM {trip_source("fhvhv", month_of)}
         GROUP BY pickup_hour
     """
 
-    fhv_hourly_tripdata = """
+    fhv_hourly_tripdata = f"""
         CREATE MATERIALIZED VIEW IF NOT EXISTS fhv_hourly_tripdata AS
         SELECT
             DATE_TRUNC('hour', pickup_datetime) AS pickup_hour,
             COUNT(*) AS num_trips,
             AVG(EXTRACT(EPOCH FROM (dropoff_datetime::timestamp - pickup_datetime::timestamp)) / 60) AS avg_trip_time_min
-        FROM fhv_tripdata
+        FROM {trip_source("fhv", month_of)}
         GROUP BY pickup_hour
     """
 
-    yellow_hourly_tripdata = """
+    yellow_hourly_tripdata = f"""
         CREATE MATERIALIZED VIEW IF NOT EXISTS yellow_hourly_tripdata AS
             SELECT
             DATE_TRUNC('hour', pickup_datetime) AS pickup_hour,
@@ -268,11 +1033,11 @@ def create_or_update_all_materialized_views():
             SUM(congestion_surcharge) AS total_congestion_surcharge,
             SUM("Airport_fee") AS total_airport_fees,
             SUM(fare_amount) + SUM(extra) + SUM(mta_tax) + SUM(tip_amount) + SUM(tolls_amount) + SUM(improvement_surcharge) + SUM(congestion_surcharge) + SUM("Airport_fee") AS total_amount_payed
-        FROM yellow_tripdata
+        FROM {trip_source("yellow", month_of)}
         GROUP BY pickup_hour
     """
 
-    green_hourly_tripdata = """
+    green_hourly_tripdata = f"""
         CREATE MATERIALIZED VIEW IF NOT EXISTS green_hourly_tripdata AS
         SELECT
             DATE_TRUNC('hour', pickup_datetime) AS pickup_hour,
@@ -287,7 +1052,7 @@ def create_or_update_all_materialized_views():
             SUM(improvement_surcharge) AS total_improvement_surcharge,
             SUM(congestion_surcharge) AS total_congestion_surcharge,
             SUM(fare_amount) + SUM(extra) + SUM(mta_tax) + SUM(tip_amount) + SUM(tolls_amount) + SUM(improvement_surcharge) + SUM(congestion_surcharge) AS total_amount_payed
-        FROM green_tripdata
+        FROM {trip_source("green", month_of)}
         GROUP BY pickup_hour
     """
 
@@ -297,24 +1062,415 @@ def create_or_update_all_materialized_views():
         "yellow_hourly_tripdata": yellow_hourly_tripdata,
         "green_hourly_tripdata": green_hourly_tripdata,
     }
+    mat_views_idx_cols = {name: "pickup_hour" for name in mat_views_queries}
+    # Refreshed after the hourly views they roll up, days before months
+    for service in ROLLUP_SUMMED_COLUMNS:
+        mat_views_queries[f"{service}_daily_tripdata"] = generate_daily_rollup_query(
+            service
+        )
+        mat_views_idx_cols[f"{service}_daily_tripdata"] = "pickup_day"
+    for service in ROLLUP_SUMMED_COLUMNS:
+        mat_views_queries[f"{service}_monthly_tripdata"] = (
+            generate_monthly_rollup_query(service)
+        )
+        mat_views_idx_cols[f"{service}_monthly_tripdata"] = "pickup_month"
+    # Ordered for point lookups: one service and pickup zone over a time range
+    mat_views_queries["zone_hourly_tripdata"] = generate_zone_cube_query(month_of)
+    mat_views_idx_cols["zone_hourly_tripdata"] = (
+        "service_id, pu_location_id, pickup_hour, do_borough_id"
+    )
+    # Ordered so merging one service and metric over a time range is a range scan
+    mat_views_queries["hourly_trip_histograms"] = generate_histogram_sketch_query(
+        month_of
+    )
+    mat_views_idx_cols["hourly_trip_histograms"] = (
+        "service_id, metric_id, pickup_hour, bucket"
+    )
+    if include_archived:
+        for name in ARCHIVED_VIEWS:
+            mat_views_queries[name] += f" UNION ALL SELECT * FROM {name}_archived"
+    return mat_views_queries, mat_views_idx_cols
 
-    # Creating connection to the DB
-    conn = psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+
+def views_over(mat_views_queries, table_names):
+    # The views reading any of the tables, directly or through another view.
+    # A materialized view is refreshed as a whole, so the others are left be.
+    names = list(table_names)
+    selected = {}
+    for name, query in mat_views_queries.items():
+        if coordination.tables_read_by(query, names):
+            selected[name] = query
+            names.append(name)
+    return selected
+
+
+def current_data_month():
+    # The trip files are for 2024, so today's month is taken in 2024
+    return datetime(2024, datetime.now().month, 1)
+
+
+def months_after(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def get_table_columns(cursor, table):
+    cursor.execute(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,),
     )
+    return cursor.fetchall()
+
+
+@flow(log_prints=True, flow_run_name="{table_name}-{month:%Y-%m}", retries=2)
+def archive_month(spark, conn, table_name, month):
+    service = table_name[: -len("_tripdata")]
+    month_end = months_after(month, 1)
     cursor = conn.cursor()
-    cursor.execute("SELECT matviewname FROM pg_matviews")
-    results = cursor.fetchall()
-    existing_mat_views = [result[0] for result in results]
-    for name, query in mat_views_queries.items():
-        print(f"Working on {name} materialized view")
-        create_or_update_mat_view(
-            mat_view_name=name,
-            mat_view_query=query,
-            idx_col_name="pickup_hour",
-            conn=conn,
-            existing_mat_views=existing_mat_views,
+    expressions = archive.checksum_expressions(get_table_columns(cursor, table_name))
+    expected = archive.postgres_checksums(
+        cursor, table_name, month, month_end, expressions
+    )
+    print(f"Archiving {expected['rows']} rows of {table_name} for {month:%Y-%m}")
+
+    staging_path = archive.staging_path(table_name, month)
+    shutil.rmtree(staging_path, ignore_errors=True)
+    df = (
+        spark.read.format("jdbc")
+        .option("url", DB_URL)
+        .option(
+            "query",
+            f"SELECT * FROM {table_name} WHERE pickup_datetime >= '{month}'"
+            f" AND pickup_datetime < '{month_end}'",
+        )
+        .option("user", DB_USER)
+        .option("password", DB_PASSWORD)
+        .option("driver", "org.postgresql.Driver")
+        .option("fetchsize", 50000)
+        # Kept as written in Postgres, with no time zone applied
+        .option("preferTimestampNTZ", "true")
+        .load()
+    )
+    df.write.option("compression", "zstd").parquet(staging_path)
+
+    written = archive.parquet_checksums(staging_path, expressions)
+    mismatches = archive.checksum_mismatches(expected, written)
+    if mismatches:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise ValueError(
+            f"Archive of {table_name} for {month:%Y-%m} doesn't match Postgres: "
+            + ", ".join(mismatches)
+        )
+    path = archive.month_path(table_name, month)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(staging_path, path)
+    print(f"Verified {path} against {len(expressions)} checksums")
+
+    # One transaction: readers see the month either in Postgres or archived,
+    # with its aggregates frozen, never both or neither
+    mat_views_queries, _ = generate_aggregation_queries(
+        month_of=(service, month), include_archived=False
+    )
+    for name in ARCHIVED_VIEWS:
+        cursor.execute(
+            f"INSERT INTO {name}_archived {select_of(mat_views_queries[name])}"
+        )
+    cursor.execute(
+        f"DELETE FROM {table_name} WHERE pickup_datetime >= %s AND pickup_datetime < %s",
+        (month, month_end),
+    )
+    cursor.execute(
+        """
+        INSERT INTO archived_months (table_name, month, row_count, checksums, path)
+        VALUES (%s, %s, %s, %s, %s)
+        """,
+        (table_name, month, expected["rows"], json.dumps(expected), path),
+    )
+    conn.commit()
+    cursor.close()
+    print(f"✅ Archived {table_name} for {month:%Y-%m} and removed it from PostgreSQL")
+
+
+@flow(log_prints=True, retries=5)
+@profiling.profiled
+def archive_closed_months():
+    conn = connect_db()
+    cursor = conn.cursor()
+    trip_tables = sorted(set(list_trip_tables()) & set(get_existing_tables(cursor)))
+    if not trip_tables:
+        print("No trip tables in PostgreSQL, nothing to archive")
+        cursor.close()
+        conn.close()
+        return
+    create_archived_tables(conn)
+
+    cutoff = months_after(current_data_month(), -archive.ARCHIVE_KEEP_MONTHS)
+    months_to_archive = []
+    for table_name in trip_tables:
+        cursor.execute(
+            f"""
+            SELECT DISTINCT DATE_TRUNC('month', pickup_datetime)
+            FROM {table_name}
+            WHERE pickup_datetime < %s
+            ORDER BY 1
+            """,
+            (cutoff,),
+        )
+        months_to_archive += [(table_name, row[0]) for row in cursor.fetchall()]
+    cursor.close()
+    print(f"Closed months to archive before {cutoff:%Y-%m}: ", months_to_archive)
+
+    if months_to_archive:
+        spark = spark_cluster.build_session(
+            "PostgresToParquetArchive", {"spark.sql.session.timeZone": "UTC"}
         )
+        for table_name, month in months_to_archive:
+            # The month is deleted from the table, so not during its ingestion
+            # or a refresh of the views over it
+            with locked_tables("archival", f"{table_name}-{month:%Y-%m}", [table_name]):
+                archive_month(spark, conn, table_name, month)
+        profiling.record_spark_stages(spark)
+        spark.stop()
+    conn.close()
+
+
+def month_range(start_month, end_month):
+    month = datetime.strptime(start_month, "%Y-%m")
+    end = datetime.strptime(end_month, "%Y-%m")
+    months = []
+    while month <= end:
+        months.append(month)
+        month = months_after(month, 1)
+    return months
+
+
+def create_backfill_table(cursor):
+    # The months a backfill has loaded, written in the transaction loading them
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backfill_months (
+            table_name TEXT NOT NULL,
+            month DATE NOT NULL,
+            row_count BIGINT NOT NULL,
+            seconds DOUBLE PRECISION NOT NULL,
+            loaded_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (table_name, month)
+        )
+        """
+    )
+
+
+def create_trip_table(cursor, table_name, file_path):
+    # Typed as the Spark ingestion would create it from the same file
+    con = duckdb_engine.connect(1)
+    duckdb_engine.register_trip_table(con, "trips", [(file_path, None, None)])
+    columns = [row[0] for row in con.execute("DESCRIBE trips").fetchall()]
+    column_list = ", ".join(
+        f'"{column}"' for column in profile_columns(INGEST_PROFILE, table_name, columns)
+    )
+    con.execute(f"CREATE VIEW profiled_trips AS SELECT {column_list} FROM trips")
+    column_defs = duckdb_engine.postgres_column_defs(con, "profiled_trips")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({column_defs})")
+    con.close()
+
+
+def loaded_columns(con, cursor, table_name):
+    # The columns of DuckDB's trips the table has, in the ingestion's profile
+    table_columns = {column for column, _ in get_table_columns(cursor, table_name)}
+    file_columns = [row[0] for row in con.execute("DESCRIBE trips").fetchall()]
+    return [
+        column
+        for column in profile_columns(INGEST_PROFILE, table_name, file_columns)
+        if column in table_columns
+    ]
+
+
+def backfill_month(table_name, month, file_path, threads):
+    # Replaces the month's trips with the file's in one transaction, bulk
+    # loaded with COPY. An interrupted month leaves nothing behind.
+    start = time.perf_counter()
+    month_end = months_after(month, 1)
+    con = duckdb_engine.connect(threads)
+    duckdb_engine.register_trip_table(con, "trips", [(file_path, None, None)])
+    conn = connect_db()
+    cursor = conn.cursor()
+    # A crash loses the last commits as a whole, month and bookkeeping together
+    cursor.execute("SET synchronous_commit = off")
+    columns = loaded_columns(con, cursor, table_name)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    query = (
+        f"SELECT {column_list} FROM trips WHERE pickup_datetime >= '{month}'"
+        f" AND pickup_datetime < '{month_end}'"
+    )
+    cursor.execute(
+        f"DELETE FROM {table_name} WHERE pickup_datetime >= %s AND pickup_datetime < %s",
+        (month, month_end),
+    )
+    num_rows = duckdb_engine.copy_query_to_postgres(
+        con, cursor, query, table_name, columns
+    )
+    cursor.execute(
+        """
+        INSERT INTO backfill_months (table_name, month, row_count, seconds)
+        VALUES (%s, %s, %s, %s)
+        """,
+        (table_name, month, num_rows, time.perf_counter() - start),
+    )
+    conn.commit()
+    cursor.close()
+    conn.close()
+    con.close()
+    return num_rows
+
+
+@flow(log_prints=True)
+@profiling.profiled
+def backfill_history(
+    services, start_month, end_month, parallelism=BACKFILL_PARALLELISM
+):
+    # Loads whole months of history, several files at once, and leaves the
+    # statistics and the aggregates to one pass at the end. Rerunning resumes:
+    # months already loaded by a backfill are skipped.
+    conn = connect_db()
+    cursor = conn.cursor()
+    create_backfill_table(cursor)
+    conn.commit()
+    cursor.execute("SELECT table_name, month FROM backfill_months")
+    loaded = {(table_name, month) for table_name, month in cursor.fetchall()}
+    archived = set()
+    if "archived_months" in get_existing_tables(cursor):
+        cursor.execute("SELECT table_name, month FROM archived_months")
+        archived = {(table_name, month) for table_name, month in cursor.fetchall()}
+
+    months_to_load = []
+    for service in services:
+        table_name = f"{service}_tripdata"
+        for month in month_range(start_month, end_month):
+            file_path = os.path.join(
+                DATA_FILES_PATH, f"{table_name}_{month:%Y-%m}.parquet"
+            )
+            if month >= current_data_month():
+                print(f"Skipping {table_name} {month:%Y-%m}: left to the ingestion")
+            elif (table_name, month.date()) in loaded:
+                print(f"Skipping {table_name} {month:%Y-%m}: already backfilled")
+            elif (table_name, month.date()) in archived:
+                print(f"Skipping {table_name} {month:%Y-%m}: archived")
+            elif not os.path.exists(file_path):
+                print(f"Skipping {table_name} {month:%Y-%m}: no file {file_path}")
+            else:
+                months_to_load.append((table_name, month, file_path))
+    if not months_to_load:
+        print("Nothing to backfill")
+        cursor.close()
+        conn.close()
+        return
+
+    table_names = sorted({table_name for table_name, _, _ in months_to_load})
+    existing_tables = get_existing_tables(cursor)
+    for table_name, _, file_path in months_to_load:
+        if table_name not in existing_tables:
+            create_trip_table(cursor, table_name, file_path)
+            existing_tables.append(table_name)
+    conn.commit()
+
+    total_bytes = sum(os.path.getsize(path) for _, _, path in months_to_load)
+    print(
+        f"Backfilling {len(months_to_load)} months ({total_bytes / 1e9:.2f} GB)"
+        f" of {', '.join(table_names)}, {parallelism} at a time"
+    )
+    # Refreshes and ingestion of these tables wait until the load is done
+    with locked_tables("backfill", f"{start_month}..{end_month}", table_names):
+        for table_name in table_names:
+            cursor.execute(f"ALTER TABLE {table_name} SET (autovacuum_enabled = false)")
+        conn.commit()
+        start = time.perf_counter()
+        loaded_bytes, loaded_rows = 0, 0
+        threads = max(1, (os.cpu_count() or 1) // parallelism)
+        executor = ThreadPoolExecutor(max_workers=parallelism)
+        try:
+            futures = {
+                executor.submit(backfill_month, table_name, month, path, threads): (
+                    table_name,
+                    month,
+                    path,
+                )
+                for table_name, month, path in months_to_load
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                table_name, month, path = futures[future]
+                num_rows = future.result()
+                loaded_rows += num_rows
+                loaded_bytes += os.path.getsize(path)
+                elapsed = time.perf_counter() - start
+                progress = (
+                    f"[{done}/{len(months_to_load)}] {table_name} {month:%Y-%m}:"
+                    f" {num_rows} rows, {loaded_rows / elapsed:.0f} rows/s"
+                )
+                # Projected from the bytes loaded so far, once there are some
+                if loaded_bytes:
+                    remaining = elapsed * (total_bytes - loaded_bytes) / loaded_bytes
+                    progress += (
+                        f". {loaded_bytes / total_bytes:.0%} done, about"
+                        f" {timedelta(seconds=round(remaining))} left (ETA"
+                        f" {datetime.now() + timedelta(seconds=remaining):%H:%M:%S})"
+                    )
+                print(progress)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for table_name in table_names:
+                cursor.execute(f"ALTER TABLE {table_name} RESET (autovacuum_enabled)")
+            conn.commit()
+
+        # Deferred statistics, once per table rather than as autovacuum goes
+        conn.autocommit = True
+        for table_name in table_names:
+            print(f"Vacuuming and analyzing {table_name}")
+            cursor.execute(f"VACUUM (ANALYZE) {table_name}")
+    cursor.close()
+    conn.close()
+    print(f"Loaded {loaded_rows} rows in {timedelta(seconds=round(elapsed))}")
+
+    # Deferred aggregates, in a single pass over everything loaded
+    create_or_update_all_materialized_views()
+
+
+@flow(log_prints=True, retries=5)
+@profiling.profiled
+def create_or_update_all_materialized_views(changed_tables=None):
+    # The duckdb engine reads every month from the source files
+    mat_views_queries, mat_views_idx_cols = generate_aggregation_queries(
+        include_archived=AGGREGATION_ENGINE != "duckdb"
+    )
+    if changed_tables is not None:
+        mat_views_queries = views_over(mat_views_queries, changed_tables)
+
+    # Creating connection to the DB
+    conn = connect_db()
+    load_taxi_zone_lookup(conn)
+    load_histogram_metrics(conn)
+    cursor = conn.cursor()
+    if AGGREGATION_ENGINE == "duckdb":
+        aggregate_with_duckdb(conn, mat_views_queries, mat_views_idx_cols)
+    else:
+        create_archived_tables(conn)
+        for name, query in mat_views_queries.items():
+            print(f"Working on {name} materialized view")
+            create_or_update_mat_view(
+                mat_view_name=name,
+                mat_view_query=query,
+                idx_col_name=mat_views_idx_cols[name],
+                conn=conn,
+            )
+    # Only reached when every view was refreshed successfully. The snapshot
+    # is in place before the dashboards are notified.
+    if snapshot.SNAPSHOT_DIR:
+        snapshot.write_snapshot(conn)
+    publish_data_version(conn)
     # Closing connection to the DB
     cursor.close()
     conn.close()
@@ -334,11 +1490,27 @@ if __name__ == "__main__":
             schedules=[IntervalSchedule(interval=timedelta(minutes=60))],
         )
 
-    p1 = multiprocessing.Process(target=serve1)
-    p2 = multiprocessing.Process(target=serve2)
+    def serve3():
+        archive_closed_months.serve(
+            name="data-archival-deployment",
+            schedules=[IntervalSchedule(interval=timedelta(hours=24))],
+        )
+
+    def serve4():
+        # Unscheduled: run with services and a month range from the UI, or use
+        # backfill.py
+        backfill_history.serve(name="data-backfill-deployment")
+
+    processes = [
+        multiprocessing.Process(target=serve2),
+        multiprocessing.Process(target=serve3),
+        multiprocessing.Process(target=serve4),
+    ]
+    if INGEST_RAW_TRIPS:
+        processes.append(multiprocessing.Process(target=serve1))
 
-    p1.start()
-    p2.start()
+    for p in processes:
+        p.start()
 
-    p1.join()
-    p2.join()
+    for p in processes:
+        p.join()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import time
+
+# After ingestion, the touched trip tables (each leaf partition, if any) are
+# analyzed once the rows changed since their last ANALYZE pass this fraction of
+# their live rows, and vacuumed once the rows inserted or dead since their last
+# VACUUM do, ahead of autovacuum's defaults. Smaller changes are left alone.
+MAINTENANCE_ANALYZE_FRACTION = float(os.getenv("MAINTENANCE_ANALYZE_FRACTION", 0.05))
+MAINTENANCE_VACUUM_FRACTION = float(os.getenv("MAINTENANCE_VACUUM_FRACTION", 0.1))
+MAINTENANCE_MIN_ROWS = int(os.getenv("MAINTENANCE_MIN_ROWS", 10000))
+
+
+def create_maintenance_tables(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            run_id BIGSERIAL PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            relation TEXT NOT NULL,
+            action TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            rows_written BIGINT NOT NULL,
+            live_rows BIGINT,
+            seconds DOUBLE PRECISION NOT NULL,
+            ran_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    # The plan each refresh ran with, to spot plans changed by new statistics
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS refresh_plans (
+            mat_view_name TEXT NOT NULL,
+            plan_hash TEXT NOT NULL,
+            plan_changed BOOLEAN NOT NULL,
+            total_cost DOUBLE PRECISION,
+            refresh_seconds DOUBLE PRECISION NOT NULL,
+            plan JSONB NOT NULL,
+            refreshed_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+
+
+def relation_stats(cursor, table_name):
+    # One row per leaf partition, or the table itself when it isn't partitioned
+    cursor.execute(
+        """
+        SELECT
+            tree.relid::regclass::text,
+            stats.n_live_tup,
+            stats.n_mod_since_analyze,
+            stats.n_ins_since_vacuum + stats.n_dead_tup
+        FROM pg_partition_tree(%s::regclass) tree
+        JOIN pg_stat_user_tables stats ON stats.relid = tree.relid
+        WHERE tree.isleaf
+        """,
+        (table_name,),
+    )
+    return cursor.fetchall()
+
+
+def plan_maintenance(live_rows, modified_rows, unvacuumed_rows):
+    # The action a relation needs, if any, and why
+    live_rows = max(live_rows, 1)
+    if (
+        unvacuumed_rows >= MAINTENANCE_MIN_ROWS
+        and unvacuumed_rows >= MAINTENANCE_VACUUM_FRACTION * live_rows
+    ):
+        return "VACUUM (ANALYZE)", f"{unvacuumed_rows} rows since the last vacuum"
+    if (
+        modified_rows >= MAINTENANCE_MIN_ROWS
+        and modified_rows >= MAINTENANCE_ANALYZE_FRACTION * live_rows
+    ):
+        return "ANALYZE", f"{modified_rows} rows changed since the last analyze"
+    return None, None
+
+
+def run_maintenance(cursor, table_name, relation, action, reason, rows_written):
+    # cursor must be in autocommit, VACUUM can't run in a transaction
+    cursor.execute(
+        "SELECT n_live_tup FROM pg_stat_user_tables WHERE relid = %s::regclass",
+        (relation,),
+    )
+    live_rows = cursor.fetchone()[0]
+    start = time.perf_counter()
+    cursor.execute(f"{action} {relation}")
+    seconds = time.perf_counter() - start
+    cursor.execute(
+        """
+        INSERT INTO maintenance_runs
+            (table_name, relation, action, reason, rows_written, live_rows, seconds)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """,
+        (table_name, relation, action, reason, rows_written, live_rows, seconds),
+    )
+    return seconds
+
+
+def explain(cursor, select_query):
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {select_query}")
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def plan_shape(plan):
+    # The plan without its estimates: node types, strategies, relations and
+    # indexes, which is what changes when the planner picks another plan
+    keys = ["Node Type", "Strategy", "Join Type", "Relation Name", "Index Name"]
+    node = [plan.get(key) for key in keys]
+    return [node, [plan_shape(child) for child in plan.get("Plans", [])]]
+
+
+def record_refresh_plan(cursor, mat_view_name, plan, refresh_seconds):
+    # Returns whether the plan differs from the one of the previous refresh
+    plan_hash = hashlib.md5(json.dumps(plan_shape(plan)).encode()).hexdigest()
+    cursor.execute(
+        """
+        SELECT plan_hash FROM refresh_plans
+        WHERE mat_view_name = %s
+        ORDER BY refreshed_at DESC
+        LIMIT 1
+        """,
+        (mat_view_name,),
+    )
+    previous = cursor.fetchone()
+    plan_changed = previous is not None and previous[0] != plan_hash
+    cursor.execute(
+        """
+        INSERT INTO refresh_plans
+            (mat_view_name, plan_hash, plan_changed, total_cost, refresh_seconds, plan)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """,
+        (
+            mat_view_name,
+            plan_hash,
+            plan_changed,
+            plan.get("Total Cost"),
+            refresh_seconds,
+            json.dumps(plan),
+        ),
+    )
+    return plan_changed
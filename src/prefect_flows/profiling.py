@@ -0,0 +1,303 @@
+import functools
+import html
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import psycopg2.extensions
+import requests
+from prefect.artifacts import create_markdown_artifact, create_table_artifact
+
+# Opt-in profiling of the flows: a sampling profile of the driver's Python,
+# Spark's per-stage metrics and the time of every Postgres statement, attached
+# to the flow run as artifacts. The flamegraph is written to PROFILE_DIR.
+PROFILE_FLOWS = os.getenv("PROFILE_FLOWS", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.01))
+PROFILE_TOP_ROWS = int(os.getenv("PROFILE_TOP_ROWS", 25))
+
+# The run being profiled; subflows are profiled as part of the outermost one
+active = None
+# Statements are recorded from the executors' threads too
+statements_lock = threading.Lock()
+
+
+class Sampler(threading.Thread):
+    # Samples the stacks of the thread that started it and of every thread
+    # started after it (executor workers), not those of Prefect's own threads
+    def __init__(self, interval):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.excluded = set(sys._current_frames()) - {threading.get_ident()}
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in self.excluded or thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Records the time of each statement while a run is profiled
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_statement(sql, time.perf_counter() - start, self.rowcount)
+
+
+def record_statement(query, seconds, rowcount):
+    run = active
+    if run is None:
+        return
+    if isinstance(query, bytes):
+        query = query.decode()
+    # Quoted strings and numbers become "?", so statements differing only in
+    # their values are summed together; those on different tables stay apart
+    statement = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", "?", str(query))
+    statement = re.sub(r"\s+", " ", statement).strip()[:200]
+    with statements_lock:
+        calls, total, longest, rows = run["statements"].get(statement, (0, 0, 0, 0))
+        run["statements"][statement] = (
+            calls + 1,
+            total + seconds,
+            max(longest, seconds),
+            rows + max(rowcount, 0),
+        )
+
+
+def frame_totals(stacks):
+    # Samples a function is on the stack for (total) and at the top of (self)
+    totals, selfs = Counter(), Counter()
+    for stack, count in stacks.items():
+        for name in set(stack):
+            totals[name] += count
+        selfs[stack[-1]] += count
+    return totals, selfs
+
+
+def flamegraph_html(title, stacks, interval):
+    # A self-contained icicle graph: callers above callees, widths proportional
+    # to the samples, details in each frame's tooltip
+    tree = {}
+    for stack, count in stacks.items():
+        node = tree
+        for name in stack:
+            entry = node.setdefault(name, [0, {}])
+            entry[0] += count
+            node = entry[1]
+    total = sum(stacks.values()) or 1
+
+    def render(children, parent_count):
+        parts = []
+        for name, (count, grandchildren) in sorted(
+            children.items(), key=lambda item: -item[1][0]
+        ):
+            label = html.escape(name)
+            tooltip = (
+                f"{label}: {count} samples, {count * interval:.2f} s,"
+                f" {count / total:.1%}"
+            )
+            parts.append(
+                f'<div class="node" style="flex: {count}">'
+                f'<div class="frame" title="{tooltip}">{label}</div>'
+                f'<div class="children">{render(grandchildren, count)}</div></div>'
+            )
+        rest = parent_count - sum(count for count, _ in children.values())
+        if rest > 0:
+            parts.append(f'<div style="flex: {rest}"></div>')
+        return "".join(parts)
+
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>
+<style>
+body {{ font: 11px monospace; margin: 8px; }}
+.children {{ display: flex; }}
+.node {{ min-width: 0; }}
+.frame {{ background: #f4a261; border: 1px solid #fff; overflow: hidden;
+         white-space: nowrap; text-overflow: ellipsis; padding: 1px 2px; }}
+.frame:hover {{ background: #e76f51; }}
+</style></head><body>
+<h3>{html.escape(title)}: {total} samples every {interval * 1000:.0f} ms</h3>
+<div class="children">{render(tree, total)}</div>
+</body></html>
+"""
+
+
+def spark_stage_metrics(spark):
+    # From the driver's REST API, with each task's run time at the median and
+    # the maximum: a max far above the median is a skewed stage
+    base = spark.sparkContext.uiWebUrl
+    if base is None:
+        print("The Spark UI is disabled, no stage metrics")
+        return []
+    app = f"{base}/api/v1/applications/{spark.sparkContext.applicationId}"
+    rows = []
+    for stage in requests.get(f"{app}/stages", timeout=30).json():
+        if stage["status"] != "COMPLETE":
+            continue
+        summary = requests.get(
+            f"{app}/stages/{stage['stageId']}/{stage['attemptId']}/taskSummary",
+            params={"quantiles": "0.5,1.0"},
+            timeout=30,
+        ).json()
+        median_ms, max_ms = summary["executorRunTime"]
+        rows.append(
+            {
+                "stage": stage["stageId"],
+                "description": stage.get("description") or stage["name"],
+                "tasks": stage["numTasks"],
+                "run_s": round(stage["executorRunTime"] / 1000, 2),
+                "gc_s": round(stage["jvmGcTime"] / 1000, 2),
+                "input_mb": round(stage["inputBytes"] / 1e6, 1),
+                "input_rows": stage["inputRecords"],
+                "shuffle_read_mb": round(stage["shuffleReadBytes"] / 1e6, 1),
+                "shuffle_write_mb": round(stage["shuffleWriteBytes"] / 1e6, 1),
+                "task_median_s": round(median_ms / 1000, 2),
+                "task_max_s": round(max_ms / 1000, 2),
+                "skew": round(max_ms / median_ms, 1) if median_ms else None,
+            }
+        )
+    return sorted(rows, key=lambda row: row["stage"])
+
+
+def record_spark_stages(spark):
+    # Called before the session stops, which takes its REST API with it
+    if active is None:
+        return
+    try:
+        active["stages"] += spark_stage_metrics(spark)
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f"Could not read the Spark stage metrics: {e}")
+
+
+def describe_spark_jobs(spark, description):
+    # Names the jobs that follow (e.g. after the file they read) in the stages
+    if active is not None:
+        spark.sparkContext.setJobDescription(description)
+
+
+def artifact_key(name):
+    return re.sub(r"[^a-z0-9-]+", "-", name.lower()).strip("-")
+
+
+def publish(name, sampler, seconds):
+    totals, selfs = frame_totals(sampler.stacks)
+    interval = sampler.interval
+    # Stacks of all sampled threads, so busy threads in parallel add up
+    stack_samples = max(sum(sampler.stacks.values()), 1)
+    top_functions = [
+        {
+            "function": function,
+            "total_s": round(count * interval, 2),
+            "self_s": round(selfs[function] * interval, 2),
+            "total_pct": round(100 * count / stack_samples, 1),
+        }
+        for function, count in totals.most_common(PROFILE_TOP_ROWS)
+    ]
+    statements = sorted(active["statements"].items(), key=lambda item: -item[1][1])[
+        :PROFILE_TOP_ROWS
+    ]
+    statement_rows = [
+        {
+            "statement": statement,
+            "calls": calls,
+            "total_s": round(total, 3),
+            "max_s": round(longest, 3),
+            "rows": rows,
+        }
+        for statement, (calls, total, longest, rows) in statements
+    ]
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(
+        PROFILE_DIR, f"{artifact_key(name)}-{datetime.now():%Y%m%dT%H%M%S}.html"
+    )
+    with open(path, "w") as f:
+        f.write(flamegraph_html(name, sampler.stacks, interval))
+
+    key = artifact_key(name)
+    create_markdown_artifact(
+        key=f"{key}-profile",
+        markdown=(
+            f"### Profile of {name}\n\n"
+            f"{seconds:.1f} s, {sampler.samples} samples every"
+            f" {interval * 1000:.0f} ms. Flamegraph: `{path}`\n\n"
+            f"{len(active['stages'])} Spark stages,"
+            f" {sum(calls for calls, _, _, _ in active['statements'].values())}"
+            f" Postgres statements"
+            f" ({sum(total for _, total, _, _ in active['statements'].values()):.1f} s)"
+        ),
+        description=f"Profile summary of {name}",
+    )
+    create_table_artifact(
+        key=f"{key}-python",
+        table=top_functions,
+        description="Driver functions by samples on the stack",
+    )
+    if active["stages"]:
+        create_table_artifact(
+            key=f"{key}-spark-stages",
+            table=active["stages"],
+            description="Spark stages, with task run time skew (max / median)",
+        )
+    if statement_rows:
+        create_table_artifact(
+            key=f"{key}-postgres",
+            table=statement_rows,
+            description="Postgres statements by total time",
+        )
+    print(f"Profile of {name} attached to the flow run, flamegraph at {path}")
+
+
+def profiled(fn):
+    # Wraps a flow's function, under its @flow decorator
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global active
+        if not PROFILE_FLOWS or active is not None:
+            return fn(*args, **kwargs)
+        active = {"stages": [], "statements": {}}
+        sampler = Sampler(PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sampler.stop()
+            try:
+                publish(fn.__name__, sampler, time.perf_counter() - start)
+            except Exception as e:
+                print(f"Could not publish the profile of {fn.__name__}: {e}")
+            active = None
+
+    return wrapper
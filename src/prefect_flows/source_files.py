@@ -0,0 +1,78 @@
+import hashlib
+import os
+import re
+from datetime import datetime
+
+# Fingerprints of the trip files as last loaded, to notice the corrected files
+# TLC republishes for months already in the tables
+SOURCE_FILES_TABLE = "source_files"
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def create_source_files_table(cursor):
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {SOURCE_FILES_TABLE} (
+            file_name TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            month DATE NOT NULL,
+            size BIGINT NOT NULL,
+            mtime DOUBLE PRECISION NOT NULL,
+            content_hash TEXT NOT NULL,
+            recorded_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+
+
+def file_month(file_name):
+    year, month = re.search(r"_(\d{4})-(\d{2})\.parquet$", file_name).groups()
+    return datetime(int(year), int(month), 1)
+
+
+def content_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def record_fingerprint(cursor, file_name, table_name, fingerprint):
+    size, mtime, file_hash = fingerprint
+    cursor.execute(
+        f"""
+        INSERT INTO {SOURCE_FILES_TABLE}
+            (file_name, table_name, month, size, mtime, content_hash)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (file_name) DO UPDATE SET
+            size = EXCLUDED.size,
+            mtime = EXCLUDED.mtime,
+            content_hash = EXCLUDED.content_hash,
+            recorded_at = NOW()
+        """,
+        (file_name, table_name, file_month(file_name), size, mtime, file_hash),
+    )
+
+
+def find_changed_files(cursor, files_path, file_names, table_name_of):
+    # Files whose content differs from their fingerprint, with the new one.
+    # Size and mtime are checked first and the content only hashed when either
+    # moved; files seen for the first time are recorded as they are.
+    cursor.execute(
+        f"SELECT file_name, size, mtime, content_hash FROM {SOURCE_FILES_TABLE}"
+    )
+    recorded = {row[0]: row[1:] for row in cursor.fetchall()}
+    changed = []
+    for file_name in file_names:
+        stat = os.stat(os.path.join(files_path, file_name))
+        previous = recorded.get(file_name)
+        if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime):
+            continue
+        file_hash = content_hash(os.path.join(files_path, file_name))
+        fingerprint = (stat.st_size, stat.st_mtime, file_hash)
+        if previous is not None and previous[2] != file_hash:
+            changed.append((file_name, fingerprint))
+        else:
+            record_fingerprint(cursor, file_name, table_name_of(file_name), fingerprint)
+    return changed
@@ -0,0 +1,119 @@
+import csv
+import io
+import os
+
+from pyspark.sql import SparkSession
+
+# Where Spark runs: unset for local mode in this container, a standalone
+# master such as spark://spark-master:7077 (see docker-compose), or
+# local-cluster[workers,cores,memory_mb] to try a cluster on one machine
+SPARK_MASTER = os.getenv("SPARK_MASTER")
+# The address executors reach this driver at, in cluster mode
+SPARK_DRIVER_HOST = os.getenv("SPARK_DRIVER_HOST")
+SPARK_EXECUTOR_CORES = os.getenv("SPARK_EXECUTOR_CORES")
+SPARK_EXECUTOR_MEMORY = os.getenv("SPARK_EXECUTOR_MEMORY")
+# Parquet work units: files are split into tasks of about this many bytes
+# (whole row groups), so one month file spreads over every executor
+SPARK_MAX_PARTITION_BYTES = os.getenv("SPARK_MAX_PARTITION_BYTES", "32m")
+# How long a task waits for a slot on an executor local to its data before
+# running elsewhere. Only HDFS-like storage reports locality; with the trip
+# files on a volume every worker mounts, any executor reads any split.
+SPARK_LOCALITY_WAIT = os.getenv("SPARK_LOCALITY_WAIT", "3s")
+# Concurrent writers to Postgres, each on its own connection from the executor
+# that read the split; defaults to the cluster's parallelism
+SPARK_WRITE_PARTITIONS = os.getenv("SPARK_WRITE_PARTITIONS")
+# "jdbc" for batched INSERTs, "copy" for COPY from each executor
+SPARK_WRITE_METHOD = os.getenv("SPARK_WRITE_METHOD", "jdbc")
+JDBC_BATCH_SIZE = int(os.getenv("JDBC_BATCH_SIZE", 10000))
+COPY_BATCH_ROWS = int(os.getenv("COPY_BATCH_ROWS", 100000))
+
+
+def build_session(app_name, config=None, master=None):
+    builder = SparkSession.builder.appName(app_name).config(
+        "spark.jars", "/opt/spark/jars/postgresql-42.5.0.jar"
+    )
+    master = master or SPARK_MASTER
+    if master:
+        builder = builder.master(master)
+    settings = {
+        "spark.sql.files.maxPartitionBytes": SPARK_MAX_PARTITION_BYTES,
+        "spark.locality.wait": SPARK_LOCALITY_WAIT,
+        "spark.executor.cores": SPARK_EXECUTOR_CORES,
+        "spark.executor.memory": SPARK_EXECUTOR_MEMORY,
+        **(config or {}),
+    }
+    if SPARK_DRIVER_HOST and master and not master.startswith("local"):
+        settings["spark.driver.host"] = SPARK_DRIVER_HOST
+        settings["spark.driver.bindAddress"] = "0.0.0.0"
+    for key, value in settings.items():
+        if value is not None:
+            builder = builder.config(key, value)
+    spark = builder.getOrCreate()
+    # Executors import this module to run the COPY writers
+    spark.sparkContext.addPyFile(os.path.abspath(__file__))
+    return spark
+
+
+def write_partitions(df):
+    return int(
+        SPARK_WRITE_PARTITIONS or df.sparkSession.sparkContext.defaultParallelism
+    )
+
+
+def copy_partition(rows, table_name, columns, conn_params):
+    # Runs on an executor: COPYs its partition in batches of COPY_BATCH_ROWS
+    import psycopg2
+
+    conn = psycopg2.connect(**conn_params)
+    cursor = conn.cursor()
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    batch_rows = 0
+
+    def flush():
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        writer.writerow(row)
+        batch_rows += 1
+        if batch_rows == COPY_BATCH_ROWS:
+            flush()
+            batch_rows = 0
+    if batch_rows:
+        flush()
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def write_trips(df, table_name, db_url, db_user, db_password, conn_params):
+    # Each partition is written by the executor that read it, with no shuffle
+    # unless there are fewer partitions than writers
+    num_writers = write_partitions(df)
+    if df.rdd.getNumPartitions() < num_writers:
+        df = df.repartition(num_writers)
+    separator = "&" if "?" in db_url else "?"
+    jdbc_options = {
+        "url": f"{db_url}{separator}reWriteBatchedInserts=true",
+        "dbtable": table_name,
+        "user": db_user,
+        "password": db_password,
+        "driver": "org.postgresql.Driver",
+        "batchsize": JDBC_BATCH_SIZE,
+        "numPartitions": num_writers,
+    }
+    if SPARK_WRITE_METHOD == "jdbc":
+        df.write.format("jdbc").options(**jdbc_options).mode("append").save()
+        return
+    # COPY needs the table; an empty JDBC write creates it as Spark would
+    df.limit(0).write.format("jdbc").options(**jdbc_options).mode("append").save()
+    columns = df.columns
+    df.foreachPartition(
+        lambda rows: copy_partition(rows, table_name, columns, conn_params)
+    )
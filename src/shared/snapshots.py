@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+
+# The dashboard's data snapshots: the hourly tables and their daily and monthly
+# rollups as Arrow files, one directory per data version, and a manifest naming
+# the current one. Written by the aggregation flow and, when it has none, by
+# the dashboard itself; both images install this module so the queries, file
+# layout and version hash are the same on either side.
+SNAPSHOT_SERVICES = ["fhvhv", "fhv", "yellow", "green"]
+# Grain: table suffix, bucket column and snapshot name suffix
+SNAPSHOT_GRAINS = {
+    "hour": ("hourly", "pickup_hour", ""),
+    "day": ("daily", "pickup_day", "_daily"),
+    "month": ("monthly", "pickup_month", "_monthly"),
+}
+
+
+def snapshot_table(grain, service):
+    return f"{service}_{SNAPSHOT_GRAINS[grain][0]}_tripdata"
+
+
+def snapshot_name(grain, service):
+    return f"{service}{SNAPSHOT_GRAINS[grain][2]}"
+
+
+def snapshot_query(grain, table):
+    bucket_col = SNAPSHOT_GRAINS[grain][1]
+    # Rollup buckets span whole days, so only the hourly rows have an hour
+    hour_of_day = (
+        f"DATE_PART('hour', {bucket_col}) AS hour_of_day," if grain == "hour" else ""
+    )
+    return f"""
+    SELECT
+        {hour_of_day}
+        DATE_PART('dow', {bucket_col}) AS day_of_week,
+        DATE_PART('day', {bucket_col}) AS day_of_month,
+        DATE_PART('month', {bucket_col}) AS month,
+        *
+    FROM {table}
+    ORDER BY {bucket_col}
+    """
+
+
+def manifest_path(directory):
+    return os.path.join(directory, "manifest.json")
+
+
+def snapshot_path(directory, data_version, name):
+    return os.path.join(directory, data_version, f"{name}.arrow")
+
+
+def read_manifest(directory):
+    try:
+        with open(manifest_path(directory)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def dataframe_to_arrow(df):
+    # Float columns keep NaN as a value instead of becoming Arrow nulls, so every
+    # numeric column can be mapped into pandas without a copy
+    return pa.table(
+        {
+            col: pa.array(df[col].to_numpy(), from_pandas=df[col].dtype == object)
+            for col in df.columns
+        }
+    )
+
+
+def compute_data_version(frames):
+    # Fingerprint of the fetched rows, so the version only changes when the data does
+    version_hash = hashlib.sha1()
+    for name in sorted(frames):
+        version_hash.update(name.encode())
+        version_hash.update(
+            pd.util.hash_pandas_object(frames[name], index=False).values.tobytes()
+        )
+    return version_hash.hexdigest()[:16]
+
+
+def publish_snapshot(directory, frames):
+    data_version = compute_data_version(frames)
+    previous = read_manifest(directory)
+    if previous is not None and previous["data_version"] == data_version:
+        print(f"Data snapshot {data_version} is unchanged")
+        return data_version
+
+    os.makedirs(os.path.join(directory, data_version), exist_ok=True)
+    for name, df in frames.items():
+        path = snapshot_path(directory, data_version, name)
+        table = dataframe_to_arrow(df)
+        with pa.OSFile(path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + ".tmp", path)
+
+    # The manifest goes last: readers only ever see complete snapshots
+    with open(manifest_path(directory) + ".tmp", "w") as f:
+        json.dump(
+            dict(data_version=data_version, created_at=datetime.now().isoformat()), f
+        )
+    os.replace(manifest_path(directory) + ".tmp", manifest_path(directory))
+
+    # The version just superseded stays until the next publish, for readers that
+    # read the old manifest but haven't mapped its files yet. Older ones go;
+    # processes still mapping them keep reading, as unlinked files stay mapped.
+    keep = {data_version}
+    if previous is not None:
+        keep.add(previous["data_version"])
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    print(f"Published data snapshot {data_version} to {directory}")
+    return data_version